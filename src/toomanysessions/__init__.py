@@ -1,10 +1,57 @@
+import importlib
+import os
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader
 
-DEBUG = True
-CWD_TEMPLATER = Environment(loader=FileSystemLoader(Path(__file__).parent))
+# set TOOMANYSESSIONS_DEBUG=0 in production to silence the verbose per-request logging
+DEBUG = os.environ.get("TOOMANYSESSIONS_DEBUG", "1").strip().lower() not in ("0", "false", "no", "off", "")
+TEMPLATES = Path(__file__).parent / "templates"
 
-from .sessions import Session, Sessions, authenticate
-from .users import User, Users
-from .core import SessionedServer
-from .msft_oauth import MicrosoftOAuth
+# public names are resolved on first access (PEP 562), so `import toomanysessions` stays cheap and
+# passkey-only or no-auth deployments never import the Azure/Graph stack
+_LAZY = {
+    "SessionBackend": ".store",
+    "SessionStore": ".store",
+    "Session": ".session",
+    "Sessions": ".sessions",
+    "authenticate": ".sessions",
+    "User": ".users",
+    "Users": ".users",
+    "HTTPPool": ".clients",
+    "SessionedServer": ".core",
+    "MicrosoftOAuth": ".msft_oauth",
+    "SessionCodec": ".backends",
+    "SQLiteBackend": ".backends",
+    "RedisBackend": ".backends",
+    "SnapshotLog": ".snapshot",
+    "TokenRefresher": ".refresh",
+    "Whitelist": ".whitelist",
+    "PendingAuthorizations": ".pending",
+    "Throttle": ".throttle",
+    "CookieCodec": ".cookies",
+    "StatelessSessions": ".cookies",
+    "configure_logging": ".logs",
+}
+
+__all__ = ["DEBUG", "TEMPLATES", "BYTECODE_CACHE", "CWD_TEMPLATER", *_LAZY]
+
+
+def _templater(name: str):
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+    if name == "BYTECODE_CACHE": return FileSystemBytecodeCache()  # shared by every worker on the host
+    from . import BYTECODE_CACHE
+    return Environment(loader=FileSystemLoader(TEMPLATES), bytecode_cache=BYTECODE_CACHE, auto_reload=False)
+
+
+def __getattr__(name: str):
+    if name in ("BYTECODE_CACHE", "CWD_TEMPLATER"):
+        value = _templater(name)
+    elif name in _LAZY:
+        value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
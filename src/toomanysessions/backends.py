@@ -0,0 +1,432 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, fields, is_dataclass
+from pathlib import Path
+from typing import Any, Iterator, Type
+
+from loguru import logger as log
+
+from . import DEBUG
+from .sessions import Session
+from .store import SessionBackend
+
+UNSERIALIZED_FIELDS = {"user", "oauth_token_data"}
+
+
+class RedisError(RuntimeError):
+    """An error reply from the Redis server"""
+
+
+class SessionCodec:
+    """JSON (de)serialization of sessions, their token responses and hydrated users"""
+
+    def __init__(self, session_model: Type[Session] = Session, user_model: Type | None = None):
+        self.session_model = session_model
+        self.user_model = user_model
+        self._fields: dict[type, tuple[str, ...]] = {}
+
+    def __repr__(self):
+        return "[TooManySessions.SessionCodec]"
+
+    def field_names(self, session: Session) -> tuple[str, ...]:
+        names = self._fields.get(type(session))
+        if names is None:
+            names = self._fields[type(session)] = tuple(
+                f.name for f in fields(session) if f.name not in UNSERIALIZED_FIELDS)
+        return names
+
+    def dump(self, session: Session) -> dict:
+        data = {name: getattr(session, name) for name in self.field_names(session)}
+        oauth_token_data = session.oauth_token_data
+        if oauth_token_data is not None:
+            data["oauth_token_data"] = asdict(oauth_token_data) if is_dataclass(oauth_token_data) else oauth_token_data
+        user = session.user
+        if user is not None:
+            me, org = getattr(user, "me", None), getattr(user, "org", None)
+            data["user"] = {
+                "me": dict(me) if me is not None else None,
+                "org": dict(org) if org is not None else None
+            }
+        return data
+
+    def load(self, data: dict) -> Session:
+        oauth_token_data = data.pop("oauth_token_data", None)
+        user = data.pop("user", None)
+        data.pop("request", None)  # written by releases that still kept the request on the session
+        data.pop("throttle", None)  # per-session attempt counts now live in the Throttle's buckets
+        session = self.session_model(**data)
+        if oauth_token_data is not None:
+            from .msft_oauth import MSFTOAuthTokenResponse
+            session.oauth_token_data = MSFTOAuthTokenResponse(**oauth_token_data)
+        if user is not None:
+            from pyzurecli import Me, Organization
+            from .users import User
+            user_model = self.user_model or User
+            session.user = user_model(
+                session,
+                me=Me(**user["me"]) if user["me"] is not None else None,
+                org=Organization(**user["org"]) if user["org"] is not None else None
+            )
+        return session
+
+    def encode(self, session: Session) -> bytes:
+        return json.dumps(self.dump(session), separators=(",", ":")).encode("utf-8")
+
+    def decode(self, raw: bytes | str) -> Session:
+        return self.load(json.loads(raw))
+
+
+class RemoteBackend(SessionBackend):
+    """Base for out-of-process backends: serializes sessions and batches buffered writes"""
+    blocking = True
+    shared = True
+
+    def __init__(
+            self,
+            codec: SessionCodec = None,
+            flush_interval: float | None = None,
+            sweep_interval: float | None = 60.0,
+            verbose: bool = DEBUG
+    ):
+        super().__init__(sweep_interval=sweep_interval, verbose=verbose)
+        self.codec = codec or SessionCodec()
+        self.flush_interval = flush_interval
+        self._pending: dict[str, Session] = {}
+        self._pending_lock = threading.Lock()
+        if flush_interval is not None and (sweep_interval is None or flush_interval < sweep_interval):
+            self.sweep_interval = flush_interval
+
+    def _load(self, token: str) -> bytes | None:
+        raise NotImplementedError
+
+    def _store_many(self, records: list[tuple[str, float | None, bytes]]) -> None:
+        raise NotImplementedError
+
+    def _delete(self, token: str) -> None:
+        raise NotImplementedError
+
+    def _tokens(self) -> list[str]:
+        raise NotImplementedError
+
+    def _exists(self, token: str) -> bool:
+        raise NotImplementedError
+
+    def get(self, token: str, default: Any = None) -> Any:
+        with self._pending_lock:
+            session = self._pending.get(token)
+        if session is None:
+            raw = self._load(token)
+            if raw is None:
+                self.stats.misses += 1
+                return default
+            session = self.codec.decode(raw)
+        if session.is_expired:
+            self.stats.expired += 1
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return session
+
+    def __getitem__(self, token: str) -> Any:
+        session = self.get(token)
+        if session is None: raise KeyError(token)
+        return session
+
+    def __setitem__(self, token: str, session: Session) -> None:
+        self.stats.inserts += 1
+        if self.flush_interval is None:
+            self._store_many([(token, session.expires_at, self.codec.encode(session))])
+            return
+        with self._pending_lock:
+            self._pending[token] = session
+        self.start()
+
+    def set_many(self, sessions: list[Session]) -> None:
+        self.stats.inserts += len(sessions)
+        self._store_many([(s.token, s.expires_at, self.codec.encode(s)) for s in sessions])
+
+    def flush(self) -> None:
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending: return
+        self._store_many([(token, s.expires_at, self.codec.encode(s)) for token, s in pending.items()])
+        if self.verbose: log.debug(f"{self}: Flushed {len(pending)} buffered session writes")
+
+    def __delitem__(self, token: str) -> None:
+        with self._pending_lock:
+            self._pending.pop(token, None)
+        self._delete(token)
+
+    def __contains__(self, token: object) -> bool:
+        with self._pending_lock:
+            if token in self._pending: return True
+        return isinstance(token, str) and self._exists(token)
+
+    def __iter__(self) -> Iterator[str]:
+        with self._pending_lock:
+            pending = list(self._pending)
+        return iter(dict.fromkeys(pending + self._tokens()))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def private_opener(path: str, flags: int) -> int:
+    """`opener` for the builtin `open` that creates files readable and writable by their owner only"""
+    return os.open(path, flags, 0o600)
+
+
+def private_file(path: Path) -> Path:
+    """Create `path` for the owner only, tightening the mode of a file an older release left world-readable"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "ab", opener=private_opener): pass
+    os.chmod(path, 0o600)
+    return path
+
+
+class SQLiteBackend(RemoteBackend):
+    """Session backend on a WAL-mode SQLite file, shareable by every worker on one host"""
+
+    def __init__(
+            self,
+            path: Path | str,
+            codec: SessionCodec = None,
+            flush_interval: float | None = None,
+            sweep_interval: float | None = 60.0,
+            verbose: bool = DEBUG
+    ):
+        super().__init__(codec=codec, flush_interval=flush_interval, sweep_interval=sweep_interval, verbose=verbose)
+        self.path = private_file(Path(path))  # sessions carry bearer tokens; SQLite gives -wal/-shm the same mode
+        self._local = threading.local()
+        with self.connection as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(token TEXT PRIMARY KEY, expires_at REAL, data BLOB NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stash "
+                "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, data BLOB NOT NULL)"
+            )
+        self.start()
+
+    def __repr__(self):
+        return f"[TooManySessions.SQLiteBackend.{self.path.name}]"
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _load(self, token: str) -> bytes | None:
+        row = self.connection.execute("SELECT data FROM sessions WHERE token = ?", (token,)).fetchone()
+        return None if row is None else row[0]
+
+    def _store_many(self, records: list[tuple[str, float | None, bytes]]) -> None:
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO sessions (token, expires_at, data) VALUES (?, ?, ?)", records)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _delete(self, token: str) -> None:
+        self.connection.execute("DELETE FROM sessions WHERE token = ?", (token,))
+
+    def _exists(self, token: str) -> bool:
+        return self.connection.execute(
+            "SELECT 1 FROM sessions WHERE token = ? AND expires_at > ?", (token, time.time())).fetchone() is not None
+
+    def stash(self, key: str, data: bytes, ttl: float) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO stash (key, expires_at, data) VALUES (?, ?, ?)", (key, time.time() + ttl, data))
+
+    def claim(self, key: str) -> bytes | None:
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")  # read and delete under one write lock, so only one worker gets the record
+        try:
+            row = conn.execute("SELECT data, expires_at FROM stash WHERE key = ?", (key,)).fetchone()
+            if row is not None: conn.execute("DELETE FROM stash WHERE key = ?", (key,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row[0] if row is not None and row[1] > time.time() else None
+
+    def _tokens(self) -> list[str]:
+        rows = self.connection.execute("SELECT token FROM sessions WHERE expires_at > ?", (time.time(),))
+        return [row[0] for row in rows]
+
+    def __len__(self) -> int:
+        self.flush()
+        row = self.connection.execute("SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)).fetchone()
+        return row[0]
+
+    def census(self, now: float = None) -> dict:
+        now = time.time() if now is None else now
+        self.flush()
+        live, expired = self.connection.execute(
+            "SELECT COALESCE(SUM(expires_at > ?), 0), COALESCE(SUM(expires_at <= ?), 0) FROM sessions", (now, now)
+        ).fetchone()
+        return {"live": live, "authenticated": None, "expired": expired, "memory_bytes": None}
+
+    def sweep(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        removed = self.connection.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        self.connection.execute("DELETE FROM stash WHERE expires_at <= ?", (now,))
+        self.stats.swept += removed
+        if removed and self.verbose: log.debug(f"{self}: Swept {removed} expired sessions")
+        return removed
+
+    def close(self) -> None:
+        super().close()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisBackend(RemoteBackend):
+    """Session backend speaking the Redis (RESP2) protocol, shareable across hosts"""
+
+    def __init__(
+            self,
+            host: str = "localhost",
+            port: int = 6379,
+            db: int = 0,
+            prefix: str = "toomanysessions:",
+            stash_prefix: str = "toomanysessions-stash:",
+            codec: SessionCodec = None,
+            flush_interval: float | None = None,
+            timeout: float = 5.0,
+            verbose: bool = DEBUG
+    ):
+        super().__init__(codec=codec, flush_interval=flush_interval, sweep_interval=None, verbose=verbose)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.prefix = prefix
+        # outside the session prefix, so a crafted cookie can never name a stashed record
+        self.stash_prefix = stash_prefix
+        self.timeout = timeout
+        self._sock: socket.socket | None = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[TooManySessions.RedisBackend.{self.host}:{self.port}/{self.db}]"
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = self._sock.makefile("rb")
+        if self.db:
+            self._send([("SELECT", self.db)])
+            if isinstance(reply := self._read(), RedisError): raise reply
+
+    def _send(self, commands: list[tuple]) -> None:
+        out = bytearray()
+        for command in commands:
+            out += b"*%d\r\n" % len(command)
+            for arg in command:
+                if not isinstance(arg, bytes): arg = str(arg).encode("utf-8")
+                out += b"$%d\r\n%s\r\n" % (len(arg), arg)
+        self._sock.sendall(out)
+
+    def _read(self) -> Any:
+        line = self._file.readline()
+        if not line: raise ConnectionError(f"{self}: Connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+": return payload.decode("utf-8")
+        if kind == b"-": return RedisError(f"{self}: {payload.decode('utf-8')}")  # raised once the pipeline is drained
+        if kind == b":": return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1: return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length == -1: return None
+            return [self._read() for _ in range(length)]
+        raise RuntimeError(f"{self}: Unexpected reply {line!r}")
+
+    def execute(self, *commands: tuple) -> list[Any]:
+        """Pipeline one or more commands and return their replies in order, raising the first error reply"""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None: self._connect()
+                    self._send(list(commands))
+                    # every reply is read before raising, so none is left for the next caller to pick up
+                    replies = [self._read() for _ in commands]
+                except (ConnectionError, OSError):
+                    self._close_socket()
+                    if attempt: raise
+                    continue
+                except BaseException:
+                    self._close_socket()
+                    raise
+                for reply in replies:
+                    if isinstance(reply, RedisError):
+                        self._close_socket()
+                        raise reply
+                return replies
+
+    def _close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock, self._file = None, None
+
+    def _key(self, token: str) -> str:
+        return self.prefix + token
+
+    def _load(self, token: str) -> bytes | None:
+        return self.execute(("GET", self._key(token)))[0]
+
+    def _store_many(self, records: list[tuple[str, float | None, bytes]]) -> None:
+        now = time.time()
+        commands = []
+        for token, expires_at, data in records:
+            if expires_at is None:
+                commands.append(("SET", self._key(token), data))
+            elif expires_at > now:
+                commands.append(("SET", self._key(token), data, "PX", max(1, int((expires_at - now) * 1000))))
+        if commands: self.execute(*commands)
+
+    def _delete(self, token: str) -> None:
+        self.execute(("DEL", self._key(token)))
+
+    def _exists(self, token: str) -> bool:
+        return self.execute(("EXISTS", self._key(token)))[0] == 1
+
+    def stash(self, key: str, data: bytes, ttl: float) -> None:
+        self.execute(("SET", self.stash_prefix + key, data, "PX", max(1, int(ttl * 1000))))
+
+    def claim(self, key: str) -> bytes | None:
+        # GET and DEL in one transaction, so a state replayed to two workers at once is honoured only once
+        return self.execute(("MULTI",), ("GET", self.stash_prefix + key), ("DEL", self.stash_prefix + key), ("EXEC",))[-1][0]
+
+    def _tokens(self) -> list[str]:
+        tokens, cursor = [], b"0"
+        while True:
+            cursor, keys = self.execute(("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 1000))[0]
+            tokens.extend(key.decode("utf-8")[len(self.prefix):] for key in keys)
+            if cursor == b"0": return tokens
+
+    def close(self) -> None:
+        super().close()
+        with self._lock:
+            self._close_socket()
@@ -0,0 +1,45 @@
+import httpx
+from loguru import logger as log
+
+from . import DEBUG
+
+
+class HTTPPool:
+    """Server-scoped keep-alive connection pool shared by the OAuth, Graph and authentication calls"""
+
+    def __init__(
+            self,
+            timeout: float = 10.0,
+            connect_timeout: float = 5.0,
+            max_connections: int = 100,
+            max_keepalive_connections: int = 20,
+            keepalive_expiry: float = 30.0,
+            verbose: bool = DEBUG
+    ):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.verbose = verbose
+        self._client: httpx.AsyncClient | None = None
+
+    def __repr__(self):
+        return "[TooManySessions.HTTPPool]"
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+            if self.verbose: log.debug(f"{self}: Opened pooled client with limits {self.limits}")
+        return self._client
+
+    async def open(self):
+        _ = self.client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            if self.verbose: log.debug(f"{self}: Closed pooled client")
@@ -0,0 +1,223 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import zlib
+from typing import Any, Type
+
+from loguru import logger as log
+
+from . import DEBUG
+from .sessions import Session, Sessions
+
+AUTHENTICATED, WHITELISTED, WELCOMED = 1, 2, 4
+CLAIM_LIMITS = {"oid": 64, "tid": 64, "upn": 256, "name": 128}
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class CookieCodec:
+    """HMAC-signed, optionally AES-GCM encrypted, size-bounded encoding of hot session fields"""
+
+    def __init__(self, keys: list[str | bytes], encrypt: bool = False, max_size: int = 3800):
+        if not keys: raise ValueError("At least one cookie key is required!")
+        self.keys = [key.encode("utf-8") if isinstance(key, str) else key for key in keys]
+        self.key_ids = {self.key_id(key): key for key in self.keys}
+        self.primary = self.key_id(self.keys[0])
+        self.encrypt = encrypt
+        self.max_size = max_size
+        if encrypt:
+            try:
+                from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+            except ImportError as e:
+                raise ImportError(
+                    "Encrypted cookie sessions require 'cryptography', install toomanysessions[cookies]") from e
+            self._aead = {kid: AESGCM(self.derive(key, b"encrypt")) for kid, key in self.key_ids.items()}
+
+    def __repr__(self):
+        return "[TooManySessions.CookieCodec]"
+
+    @staticmethod
+    def key_id(key: bytes) -> str:
+        return hashlib.sha256(key).hexdigest()[:8]
+
+    @staticmethod
+    def derive(key: bytes, purpose: bytes) -> bytes:
+        return hmac.new(key, purpose, hashlib.sha256).digest()
+
+    def dump(self, session: Session) -> dict:
+        flags = (
+                (AUTHENTICATED if session.authenticated else 0)
+                | (WHITELISTED if session.whitelisted else 0)
+                | (WELCOMED if session.welcomed else 0)
+        )
+        data = {"t": session.token, "c": int(session.created_at), "e": int(session.expires_at), "f": flags}
+        if session.verifier: data["v"] = session.verifier
+        # lets the server tell which whitelist generation admitted this cookie
+        if session.admission_epoch: data["a"] = session.admission_epoch
+        if session.claims:
+            data["i"] = {
+                k: str(v)[:limit] for k, limit in CLAIM_LIMITS.items() if (v := session.claims.get(k)) is not None
+            }
+        return data
+
+    def load(self, data: dict, session_model: Type[Session] = Session) -> Session:
+        flags = data["f"]
+        session = session_model(
+            token=data["t"],
+            created_at=data["c"],
+            expires_at=data["e"],
+            authenticated=bool(flags & AUTHENTICATED),
+            whitelisted=bool(flags & WHITELISTED),
+            welcomed=bool(flags & WELCOMED),
+            claims=data.get("i"),
+            verifier=data.get("v"),
+            admission_epoch=data.get("a", 0)
+        )
+        return session
+
+    def encode(self, session: Session) -> str:
+        payload = json.dumps(self.dump(session), separators=(",", ":")).encode("utf-8")
+        compressed = zlib.compress(payload, 9)
+        if len(compressed) < len(payload):
+            payload, fmt = compressed, "z"
+        else:
+            fmt = "j"
+        key, kid = self.keys[0], self.primary
+        if self.encrypt:
+            nonce = os.urandom(12)
+            body = b64encode(nonce + self._aead[kid].encrypt(nonce, payload, kid.encode("ascii")))
+            fmt = "e" + fmt
+        else:
+            body = b64encode(payload)
+        signed = f"{fmt}.{kid}.{body}"
+        mac = hmac.new(self.derive(key, b"sign"), signed.encode("ascii"), hashlib.sha256).digest()
+        value = f"{signed}.{b64encode(mac)}"
+        if len(value) > self.max_size: raise ValueError(
+            f"{self}: Encoded session is {len(value)} bytes, over the {self.max_size} byte limit!")
+        return value
+
+    def is_primary(self, value: str) -> bool:
+        """Whether a cookie was signed with the current key, rather than one kept only to verify older cookies"""
+        return value.split(".", 2)[1:2] == [self.primary]
+
+    def decode(self, value: str, session_model: Type[Session] = Session) -> Session | None:
+        """Return the session encoded in a cookie, or None if it is malformed, forged or expired"""
+        try:
+            if len(value) > self.max_size: return None
+            signed, _, mac = value.rpartition(".")
+            fmt, kid, body = signed.split(".")
+            key = self.key_ids.get(kid)
+            if key is None: return None
+            expected = hmac.new(self.derive(key, b"sign"), signed.encode("ascii"), hashlib.sha256).digest()
+            if not hmac.compare_digest(expected, b64decode(mac)): return None
+            raw = b64decode(body)
+            if fmt.startswith("e"):
+                if not self.encrypt: return None
+                raw = self._aead[kid].decrypt(raw[:12], raw[12:], kid.encode("ascii"))
+                fmt = fmt[1:]
+            if fmt == "z": raw = zlib.decompress(raw)
+            session = self.load(json.loads(raw), session_model)
+        except Exception:
+            return None
+        if session.is_expired: return None
+        return session
+
+
+class StatelessSessions(Sessions):
+    """Sessions carried entirely in a signed cookie, so no store lookups or shared state are needed"""
+    stateless = True
+
+    def __init__(
+            self,
+            keys: list[str | bytes] = None,
+            encrypt: bool = False,
+            max_cookie_size: int = 3800,
+            session_model: Type[Session] = Session,
+            session_name: str = "session",
+            max_age: int = 3600 * 8,
+            public_metrics: bool = False,
+            verbose: bool = DEBUG
+    ):
+        super().__init__(
+            session_model=session_model,
+            session_name=session_name,
+            max_age=max_age,
+            max_sessions=1,
+            sweep_interval=None,
+            public_metrics=public_metrics,
+            verbose=verbose
+        )
+        if not keys:
+            log.warning(f"{self}: No cookie keys were provided! Generating a random key, which will not be shared "
+                        f"between workers or survive restarts.")
+            keys = [secrets.token_bytes(32)]
+        self.codec = CookieCodec(keys, encrypt=encrypt, max_size=max_cookie_size)
+
+    def __repr__(self):
+        return "[TooManySessions.StatelessSessions]"
+
+    def __getitem__(self, session_or_token: Any):
+        if isinstance(session_or_token, Session): return session_or_token
+        if not isinstance(session_or_token, str): raise TypeError(
+            f"Expected token, got {type(session_or_token)}")
+        session = self.codec.decode(session_or_token, self.session_model)
+        if session is None: return self.issue()
+        self.stats.hits += 1
+        return session
+
+    def issue(self) -> Session:
+        self.stats.misses += 1
+        self.stats.created += 1
+        if self.verbose: log.debug(f"{self}: No valid session cookie, issuing a new session")
+        return self.session_model.create(secrets.token_urlsafe(32), max_age=self.max_age)
+
+    def census(self) -> dict:
+        # sessions live only in client cookies, so only issuance can be counted
+        return {"created_total": self.stats.created}
+
+    def get(self, token: str | None) -> Session | None:
+        if not token: return None
+        return self.codec.decode(token, self.session_model)
+
+    def authorization_state(self, session: Session, verifier: str, client: str = None) -> str:
+        # the verifier rides along in the cookie, which is why the 'msft' server requires encrypted cookies
+        session.verifier = verifier
+        return session.token
+
+    async def for_cookie(self, cookie: str | None) -> tuple[Session, Any]:
+        session = self.get(cookie)
+        if session is None: return self.issue(), None
+        self.stats.hits += 1
+        # a cookie under a retired key gets no state, so it is re-signed with the primary key on the way out
+        if not self.codec.is_primary(cookie): return session, None
+        # compared as decoded fields, encrypted cookies never encode to the same value twice
+        return session, self.codec.dump(session)
+
+    def changed(self, session: Session, cookie_state: Any) -> bool:
+        return self.codec.dump(session) != cookie_state
+
+    def for_state(self, state: str, cookie: str | None) -> Session | None:
+        session = self.get(cookie)
+        if session is None or not hmac.compare_digest(session.token, state): return None
+        return session
+
+    def is_provisional(self, session: Session) -> bool:
+        return False
+
+    def commit(self, session: Session) -> Session:
+        return session
+
+    def discard(self, token: str) -> None:
+        return None
+
+    def cookie_value(self, session: Session) -> str:
+        return self.codec.encode(session)
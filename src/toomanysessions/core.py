@@ -1,23 +1,32 @@
-import asyncio
-import secrets
+import time
 from functools import cached_property
 from pathlib import Path
-from typing import Type
+from typing import Type, TYPE_CHECKING
 
 from fastapi import APIRouter
 from fastj2 import FastJ2
 from loguru import logger as log
-from pyzurecli import GraphAPI
 from starlette.requests import Request
 from starlette.responses import Response, RedirectResponse
 from toomanyconfigs import CWD
-from toomanyports import PortManager
 from toomanythreads import ThreadedServer
 
-from . import DEBUG, Session, Sessions, CWD_TEMPLATER
+from . import DEBUG, Session, Sessions, SessionBackend, SessionStore, CWD_TEMPLATER, BYTECODE_CACHE
 from . import Users, User
-from .msft_oauth import MicrosoftOAuth, MSFTOAuthTokenResponse
-from .passkey import Passkey
+from .backends import SessionCodec, RemoteBackend, SQLiteBackend, RedisBackend
+from .cookies import StatelessSessions
+from .clients import HTTPPool
+from .graph import GraphClient, GRAPH_URL
+from .logs import enabled, sampled
+from .middleware import RouteClassifier, SessionedMiddleware, without_dispatch
+from .render import RenderCache, compile_templates
+from .singleflight import SingleFlight
+from .throttle import Throttle
+from .whitelist import Whitelist, admission_epoch
+
+if TYPE_CHECKING:
+    from pyzurecli import Me, Organization
+    from .msft_oauth import MSFTOAuthTokenResponse
 
 
 def no_auth(session: Session):
@@ -26,21 +35,57 @@ def no_auth(session: Session):
 
 
 REQUEST = None
+ERROR_MESSAGES = {
+    400: "Bad request - something went wrong with your request.",
+    401: "Unauthorized - you need to log in to access this.",
+    403: "Forbidden - you don't have permission to access this.",
+    404: "Page not found - this page doesn't exist.",
+    429: "Too many requests - please wait a moment and try again.",
+    500: "Internal server error - something went wrong on our end.",
+    503: "Service unavailable - we're temporarily down for maintenance."
+}
+UNAUTHORIZED_MESSAGE = ("You're not authorized to access this website.\n"
+                        "Either log into a different account or contact a system administrator.")
+BYPASS_PATHS = ["/microsoft_oauth", "/authenticated/", "/favicon.ico", "/logout", "/passkey"]
 
 
 class SessionedServer(CWD, ThreadedServer):
     def __init__(
             self,
             host: str = "localhost",
-            port: int = PortManager().random_port(),
+            port: int = None,
+            # a free port is picked at construction when no port is given
             session_name: str = "session",
             session_age: int = (3600 * 8),
-            session_model: Type[Session] = Session,
+            max_sessions: int = 100_000,
+            lazy_sessions: bool = False,
+            session_backend: str | SessionBackend = "memory",
+            # available session backends are 'memory', 'sqlite' and 'redis'
+            session_snapshot: Path | str | bool = None,
+            # snapshot the 'memory' backend to disk so restarts keep their sessions, True for ./sessions.snapshot
+            session_model: Type[Session] | str = Session,
+            # pass session_model='cookie' to carry sessions in signed cookies instead of a backend
+            cookie_keys: list = None,
+            encrypt_cookies: bool = False,
+            # 'msft' with cookie sessions requires encrypt_cookies, the PKCE verifier is carried in the cookie
             authentication_model: str | Type[APIRouter] | None = "msft",
             # available auth models are 'msft', 'pass', and None
             user_model: Type[User] | None = User,
-            user_whitelist: list = None,
-            tenant_whitelist: list = None,
+            user_whitelist: list | str | Path | Whitelist = None,
+            tenant_whitelist: list | str | Path | Whitelist = None,
+            # whitelists may be lists, or paths to files with one entry per line that are reloaded when they change
+            graph_url: str = GRAPH_URL,
+            precompile_templates: bool = True,
+            http_timeout: float = 10.0,
+            http_max_connections: int = 100,
+            eager_hydration: bool = False,
+            # fetch every user's Graph profile at login, instead of only when identity claims are missing or /me is hit
+            refresh_tokens: bool = True,
+            # keep Microsoft access tokens fresh in the background using their refresh tokens
+            public_metrics: bool = False,
+            # expose /sessions/metrics without authentication, e.g. for a Prometheus scraper
+            throttle: Throttle = None,
+            # e.g. Throttle(trusted_proxies=["10.0.0.0/8"]) to rate limit by client address behind a load balancer
             verbose: bool = DEBUG,
             **kwargs
     ):
@@ -50,26 +95,77 @@ class SessionedServer(CWD, ThreadedServer):
         # simple declarations
         self.verbose = verbose
         self.host = host
+        if port is None:
+            from toomanyports import PortManager
+            port = PortManager().random_port()
         self.port = port
         self.session_name = session_name
         self.session_age = session_age
+        self.admission_generation = 0  # bumped by manual invalidations, on top of the whitelist contents
+        self.admission_epoch = self.admission_digest()
+        self.throttle = throttle or Throttle()
+        self.flights = SingleFlight()
+        self.http = HTTPPool(timeout=http_timeout, max_connections=http_max_connections, verbose=verbose)
+        self.graph_client = GraphClient(base_url=graph_url, pool=self.http, verbose=verbose)
+        self.refresher = None
+        self.eager_hydration = eager_hydration
         for kwarg in kwargs:
             setattr(self, kwarg, kwargs.get(kwarg))
 
+        self.stateless = session_model == "cookie"
+        if self.stateless: session_model = Session
+
         if not getattr(self, "session_model", None):
             self.session_model = session_model
             if not self.session_model.create: raise ValueError(f"{self}: Session models require a create function!")
 
         log.debug(f"{self}: Initialized session_model as {self.session_model}!")
 
+        if isinstance(session_backend, str):
+            if session_backend == "memory":
+                session_backend = None
+                if session_snapshot:
+                    from .snapshot import SnapshotLog
+                    path = self.cwd / "sessions.snapshot" if session_snapshot is True else session_snapshot
+                    session_backend = SessionStore(
+                        max_size=max_sessions,
+                        snapshot=SnapshotLog(path, codec=SessionCodec(self.session_model), verbose=verbose),
+                        verbose=verbose
+                    )
+            elif session_backend == "sqlite":
+                session_backend = SQLiteBackend(self.cwd / "sessions.db", codec=SessionCodec(self.session_model))
+            elif session_backend == "redis":
+                session_backend = RedisBackend(codec=SessionCodec(self.session_model))
+            else:
+                raise ValueError(f"{self}: Unknown session backend '{session_backend}'!")
+
+        if not getattr(self, "sessions", None) and self.stateless:
+            self.sessions = StatelessSessions(
+                keys=cookie_keys,
+                encrypt=encrypt_cookies,
+                session_model=self.session_model,
+                session_name=self.session_name,
+                max_age=self.session_age,
+                public_metrics=public_metrics,
+                verbose=self.verbose
+            )
+
         if not getattr(self, "sessions", None):
             self.sessions = Sessions(
                 session_model=self.session_model,
                 session_name=self.session_name,
+                max_age=self.session_age,
+                max_sessions=max_sessions,
+                lazy=lazy_sessions,
+                backend=session_backend,
+                public_metrics=public_metrics,
                 verbose=self.verbose
             )
 
         log.debug(f"{self}: Initialized sessions as {self.sessions}!")
+        self.metrics = self.sessions.metrics
+        self.metrics.lookups["graph_me"] = self.graph_client.me_cache.stats
+        self.metrics.lookups["graph_org"] = self.graph_client.org_cache.stats
 
         if not getattr(self, "authentication_model", None):
             self.authentication_model = authentication_model
@@ -79,14 +175,22 @@ class SessionedServer(CWD, ThreadedServer):
             self.is_noauth = False #(self.authentication_model == no_auth)
             if isinstance(authentication_model, str):
                 if authentication_model == "pass":
+                    from .passkey import Passkey
                     self.authentication_model: Passkey = Passkey(self)
                     user_model = None
                     self.is_passkey = True
                 if authentication_model == "msft":
-                    self.authentication_model: MicrosoftOAuth = MicrosoftOAuth(self)
+                    if self.stateless and not self.sessions.codec.encrypt: raise ValueError(
+                        f"{self}: Microsoft sign-in keeps its PKCE verifier in the session cookie, "
+                        f"pass encrypt_cookies=True with session_model='cookie'!")
+                    from .msft_oauth import MicrosoftOAuth
+                    self.authentication_model: MicrosoftOAuth = MicrosoftOAuth(self, verbose=verbose)
                     if not getattr(self, "redirect_uri", None):
                         self.redirect_uri = f"{self.url}/microsoft_oauth/callback"
                     self.is_msft = True
+                    if refresh_tokens and not self.stateless:
+                        from .refresh import TokenRefresher
+                        self.refresher = TokenRefresher(self.authentication_model, self.sessions, self.http, verbose=verbose)
             elif self.is_custom:
                 self.authentication_model = authentication_model
                 self.is_custom = True
@@ -107,15 +211,20 @@ class SessionedServer(CWD, ThreadedServer):
                     self.user_model.create,
                 )
                 if not self.user_model.create: raise ValueError(f"{self}: User models require a create function!")
+                if isinstance(self.sessions.cache, RemoteBackend): self.sessions.cache.codec.user_model = self.user_model
+                if getattr(self.sessions.cache, "snapshot", None) is not None:
+                    self.sessions.cache.snapshot.codec.user_model = self.user_model
 
                 if self.is_msft:
-                    self.user_whitelist = user_whitelist
+                    self.user_whitelist = Whitelist.coerce(user_whitelist, self.rekey_admissions, verbose)
                     log.debug(f"{self}: Initialized user_whitelist:\n  - whitelist={self.user_whitelist}")
 
-                    if tenant_whitelist:
-                        self.tenant_whitelist = [self.authentication_model.azure_cli.tenant_id] + tenant_whitelist
-                    self.tenant_whitelist = tenant_whitelist
+                    self.tenant_whitelist = Whitelist.coerce(tenant_whitelist, self.rekey_admissions, verbose)
+                    if self.tenant_whitelist is not None:
+                        # the app's own tenant is always admitted alongside the listed ones
+                        self.tenant_whitelist.extend([self.authentication_model.azure_cli.tenant_id])
                     log.debug(f"{self}: Initialized tenant_whitelist:\n  - whitelist={self.tenant_whitelist}")
+                    self.admission_epoch = self.admission_digest()
 
         log.debug(f"{self}: Initialized user model as {self.user_model}!")
 
@@ -130,59 +239,75 @@ class SessionedServer(CWD, ThreadedServer):
             # database={}
         )
 
+        self.add_event_handler("startup", self.http.open)
+        if self.is_msft: self.add_event_handler("startup", self.authentication_model.id_tokens.jwks.warm)
+        if self.refresher is not None:
+            self.add_event_handler("startup", self.refresher.start)
+            self.add_event_handler("shutdown", self.refresher.stop)
+        self.add_event_handler("shutdown", self.http.aclose)
+        self.add_event_handler("shutdown", self.sessions.cache.close)
+        for whitelist in (getattr(self, "user_whitelist", None), getattr(self, "tenant_whitelist", None)):
+            if whitelist is not None: self.add_event_handler("shutdown", whitelist.stop)
+        self.bypass = RouteClassifier(self.bypass_paths)
         self.include_router(self.sessions)
         if not self.authentication_model == no_auth: self.include_router(self.authentication_model)
         if getattr(self, "user_model", None): self.include_router(self.users)
 
         self.default_templater = FastJ2(error_method=self.renderer_error, cwd=Path(__file__).parent)
+        self.default_templater.bytecode_cache = BYTECODE_CACHE
+        self.default_templater.auto_reload = False
+        if precompile_templates: self.precompile()
+        self.render_cache = RenderCache(self.default_templater, latency=self.metrics.stages["render"])
+        self.prerender()
 
         if self.verbose: log.success(
             f"Initialized new Sessioned successfully!\n  - host={self.host}\n  - port={self.port}")
 
-        @self.middleware("http")
-        async def middleware(request: Request, call_next):
-            log.info(f"{self}: Got request for '{request.url.path}':\n  - cookies={request.cookies.items()}")
-
-            # Check if we should bypass auth entirely
-            bypass_paths = ["/microsoft_oauth", "/authenticated/", "/favicon.ico", "/logout", "/passkey"]
-
-            # Add custom bypass routes if they exist
-            if getattr(self.authentication_model, "bypass_routes", None):
-                bypass_paths.extend(self.authentication_model.bypass_routes)
-
-            # Check if current path should bypass auth
-            if any(path in request.url.path for path in bypass_paths):
-                log.debug(f"{self}: Bypassing auth middleware for {request.url}")
-                return await call_next(request)
-
-            try:
-                return await self.sessioned_middleware(request, call_next)
-            except Exception as e:
-                log.error(f"{self}: Error processing request: {e}")
-                return self.popup_error(
-                    error_code=500,
-                    message="An unexpected error occurred while processing your request."
-                )
+        if self.sessioned_middleware == self.default_middleware:
+            # ThreadedServer logs requests through a call_next middleware of its own, SessionedMiddleware logs them
+            self.user_middleware = without_dispatch(self.user_middleware, "request_log")
+            self.add_middleware(SessionedMiddleware, server=self)
+        else:
+            @self.middleware("http")
+            async def middleware(request: Request, call_next):
+                if self.verbose and sampled("INFO"): log.opt(lazy=True).info(
+                    "{}: Got request for '{}'", lambda: self, lambda: request.url.path)
+
+                # Check if current path should bypass auth
+                if self.is_bypassed(request.url.path):
+                    if self.verbose and sampled(): log.opt(lazy=True).debug(
+                        "{}: Bypassing auth middleware for {}", lambda: self, lambda: request.url.path)
+                    return await call_next(request)
+
+                try:
+                    return await self.sessioned_middleware(request, call_next)
+                except Exception as e:
+                    log.error(f"{self}: Error processing request: {e}")
+                    return self.popup_error(
+                        error_code=500,
+                        message="An unexpected error occurred while processing your request."
+                    )
 
         @self.get("/me")
-        def me(request: Request):
+        async def me(request: Request):
             cookie = request.cookies.get(self.session_name)
-            session = self.sessions.cache.get(cookie)
+            session = await self.sessions.offload(self.sessions.get, cookie)
             if not session:
                 return self.popup_error(401, "No user found")
+            if getattr(self, "user_model", None): await self.ensure_user(session)
             return self.render_user_profile(session)
 
         @self.get("/logout")
         def logout(request: Request):
             cookie = request.cookies.get(self.session_name)
-            session = self.sessions.cache.get(cookie)
+            session = self.sessions.get(cookie)
             if not session:
                 return self.popup_error(401, "You are already logged out!")
             if session:
-                log.debug(f"Logging out session: {cookie}")
+                log.debug(f"Logging out session: {session.token[:8]}...")
 
                 # Build Microsoft logout request
-                if isinstance(self.authentication_model, MicrosoftOAuth):
+                if self.is_msft:
                     post_logout_redirect_uri = self.logout_uri + "/complete"
                     logout_request = self.authentication_model.build_logout_request(session, post_logout_redirect_uri)
                     response = RedirectResponse(url=logout_request.url, status_code=302)
@@ -190,7 +315,7 @@ class SessionedServer(CWD, ThreadedServer):
                 else:
                     raise NotImplementedError
 
-                del self.sessions.cache[cookie]
+                self.sessions.discard(cookie)
                 return response
 
         @self.get("/logout/complete")
@@ -211,113 +336,248 @@ class SessionedServer(CWD, ThreadedServer):
     def __repr__(self):
         return f"{self.cwd.name.title()}.SessionedServer"
 
+    @property
+    def bypass_paths(self) -> list[str]:
+        bypass_paths = list(BYPASS_PATHS)
+
+        # Add custom bypass routes if they exist
+        if getattr(self.authentication_model, "bypass_routes", None):
+            bypass_paths.extend(self.authentication_model.bypass_routes)
+        if getattr(self.sessions, "bypass_routes", None):
+            bypass_paths.extend(self.sessions.bypass_routes)
+
+        return bypass_paths
+
+    def is_bypassed(self, path: str) -> bool:
+        """Check whether a request path skips the auth gate entirely"""
+        return self.bypass(path)
+
+    def include_router(self, router: APIRouter, prefix: str = None, **kwargs):
+        super().include_router(router, prefix=prefix, **kwargs)
+        if getattr(self, "bypass", None) is not None: self.bypass.compile(self.bypass_paths)
+
     async def default_middleware(self, request, call_next):
-        session = self.session_manager(request)
-        if session.throttle != 0:
-            log.debug(f"{self}: Session '{session.token}' has been throttled for {session.throttle} seconds!")
-            asyncio.wait(session.throttle)
+        session = await self.session_manager(request)
+        response = await self.admit(request, session)
+        if response is not None: return response
+        response = await call_next(request)
+        return self.finalize(request, session, response)
+
+    async def admit(self, request: Request, session: Session) -> Response | None:
+        """Run the session, auth, whitelist and welcome gate, returning a response if the request is stopped"""
+        if session.is_admitted(self.admission_epoch): return None
 
         if not session.authenticated:
-            log.warning(f"{self}: Session is not authenticated!")
+            verbose = self.verbose and sampled("WARNING")
+            if verbose: log.opt(lazy=True).warning("{}: Session is not authenticated!", lambda: self)
+            if not self.is_noauth and (retry_after := self.throttle.check(request, session.token)):
+                if sampled("WARNING"): log.opt(lazy=True).warning(
+                    "{}: Session '{}...' has been throttled for {} seconds!",
+                    lambda: self, lambda: session.token[:8], lambda: retry_after
+                )
+                return self.too_many_requests(retry_after)
             if self.is_noauth:
-                log.warning(f"{self}: 'No authentication' is True! Bypassing authentication!")
+                if verbose: log.opt(lazy=True).warning(
+                    "{}: 'No authentication' is True! Bypassing authentication!", lambda: self)
                 self.authentication_model(session)
             elif self.is_msft:
-                oauth_request = self.authentication_model.build_auth_code_request(session)
-                return self.redirect_html(oauth_request.url)
+                start = time.perf_counter()
+                # the state is stashed in the session backend, which may be a network hop away
+                oauth_request = await self.sessions.offload(
+                    self.authentication_model.build_auth_code_request, session, self.throttle.client_address(request))
+                response = self.sessions.set_cookie(self.redirect_html(oauth_request.url), session, httponly=True)
+                self.metrics.observe("auth_redirect", time.perf_counter() - start)
+                return response
             elif self.is_passkey:
                 return await self.authentication_model.show_passkey_prompt(request)
 
         if getattr(self, "user_model", None):
-            if not session.user:
-                setattr(session, "user", self.users.user_model.create(session))
-                user: User = session.user
-                if not session.user: raise RuntimeError(
-                    "The user model create method does not persist user to session!")
-                if self.is_msft:
-                    metadata: MSFTOAuthTokenResponse = session.oauth_token_data
-                    session.graph = GraphAPI(metadata.access_token)
-                    setattr(user, "me", session.graph.me)
-                    setattr(user, "org", session.graph.organization)
-                    if (user.me is None) or (user.org is None): raise RuntimeError(
-                        "Error fetching user's information!")
-            if self.is_msft:
-                if self.tenant_whitelist is not None or self.user_whitelist is not None:
+            # parallel first requests with the same cookie share one hydration, whitelist check and welcome
+            (response, denied, established), shared = await self.flights.do(
+                session.token, lambda: self.establish(session)
+            )
+            if shared:
+                for attr in ("user", "whitelisted", "welcomed"):
+                    setattr(session, attr, getattr(established, attr, None))
+                if denied: return response
+            elif response is not None:
+                return response
+
+        if self.refresher is not None: self.refresher.track(session)
+        setattr(session, "admitted_until", session.expires_at)
+        setattr(session, "admission_epoch", self.admission_epoch)
+        await self.sessions.offload(self.sessions.update, session)
+        return None
+
+    async def establish(self, session: Session) -> tuple[Response | None, bool, Session]:
+        """Hydrate, whitelist and welcome a freshly authenticated session, returning (response, denied, session)"""
+        if self.eager_hydration or not all(self.identity(session)):
+            await self.ensure_user(session)
+        if self.is_msft:
+            if self.tenant_whitelist is not None or self.user_whitelist is not None:
+                # sessions admitted before the lists last changed are checked again
+                if not session.whitelisted or session.admission_epoch != self.admission_epoch:
+                    start = time.perf_counter()
+                    whitelisted = self.is_whitelisted(session)
+                    self.metrics.observe("whitelist_check", time.perf_counter() - start)
+                    if not whitelisted:
+                        if session.whitelisted:
+                            setattr(session, "whitelisted", False)
+                            await self.sessions.acommit(session)
+                        return self.popup_unauthorized(UNAUTHORIZED_MESSAGE), True, session
                     if not session.whitelisted:
-                        log.warning(f"{self}: Whitelist status is {session.whitelisted} for {session.token}!")
-                        log.debug(f"{self}: Tenant whitelist:\n  - whitelist={self.tenant_whitelist}")
-                        log.debug(f"{self}: User whitelist:\n  - whitelist={self.user_whitelist}")
-                        user: User = session.user
-                        if not session.user: raise RuntimeError(
-                            "Can't check if user is whitelisted if users aren't persisted to session!")
-                        tenant = user.org.id
-                        email = user.me.userPrincipalName
-                        if not (tenant and email): raise RuntimeError(
-                            "TenantID and email weren't correctly retrieved using GraphAPI!")
-                        log.debug(
-                            f"{self}: Successfully found user's whitelist details!\n  - tenant={tenant}\n  - email={email}")
-                        try:
-                            # Check user's tenant
-                            if getattr(self, 'tenant_whitelist', None) is not None:
-                                log.debug(f"{self}: Checking tenant id...")
-                                log.debug(
-                                    f"{self}: Found tenant {tenant} for {session.user.me.userPrincipalName}")
-                                if tenant not in self.tenant_whitelist:
-                                    log.warning(
-                                        f"{self}: Unauthorized tenant {tenant} attempted to access the website!")
-                                    raise PermissionError
-                            else:
-                                log.debug(f"{self}: No tenant whitelist. Skipping...")
-
-                            # Then check user whitelist
-                            if getattr(self, 'user_whitelist', None) is not None:
-                                log.debug(f"{self}: Checking user's email...")
-                                if email not in self.user_whitelist:
-                                    log.warning(
-                                        f"{self}: Unauthorized user {email} attempted to access the website!")
-                                    raise PermissionError
-                            else:
-                                log.debug(f"{self}: No user whitelist. Skipping...")
-
-                        except PermissionError:
-                            return self.popup_unauthorized("You're not authorized to access this website.\n"
-                                                           "Either log into a different account or contact a system administrator.")
                         setattr(session, "whitelisted", True)
+                        await self.sessions.acommit(session)
 
-                if not session.welcomed:
-                    log.warning(f"{self}: User has yet to be welcomed!")
-                    if isinstance(self.authentication_model, MicrosoftOAuth):
-                        setattr(session, "welcomed", True)
-                        return self.authentication_model.welcome(session.user.me.displayName)
-
-        response = await call_next(request)
-
-        # Handle 404s with animated popup
+            if not session.welcomed:
+                log.warning(f"{self}: User has yet to be welcomed!")
+                if self.is_msft:
+                    setattr(session, "welcomed", True)
+                    await self.sessions.acommit(session)
+                    response = self.authentication_model.welcome(self.display_name(session))
+                    return self.sessions.set_cookie(response, session, httponly=True), False, session
+        return None, False, session
+
+    async def ensure_user(self, session: Session) -> User | None:
+        """Hydrate a session's user on first need, when there is a token to fetch the profile with"""
+        if session.user is None and (session.oauth_token_data is not None or not self.is_msft):
+            await self.hydrate(session)
+        return session.user
+
+    async def hydrate(self, session: Session) -> User:
+        setattr(session, "user", self.users.user_model.create(session))
+        user: User = session.user
+        if not session.user: raise RuntimeError(
+            "The user model create method does not persist user to session!")
+        if self.is_msft:
+            metadata: MSFTOAuthTokenResponse = session.oauth_token_data
+            start = time.perf_counter()
+            me, org = await self.fetch_profile(metadata.access_token, session.claims)
+            self.metrics.observe("graph_hydration", time.perf_counter() - start)
+            setattr(user, "me", me)
+            setattr(user, "org", org)
+            if (user.me is None) or (user.org is None): raise RuntimeError(
+                "Error fetching user's information!")
+        # anonymous provisional sessions stay unpersisted, hydrating them is not real work
+        await self.sessions.offload(self.sessions.update, session)
+        return user
+
+    def is_whitelisted(self, session: Session) -> bool:
+        verbose = self.verbose and enabled("DEBUG")
+        if verbose: log.opt(lazy=True).debug(
+            "{}: Checking whitelists for session {}...\n  - tenant_whitelist={}\n  - user_whitelist={}",
+            lambda: self, lambda: session.token[:8], lambda: self.tenant_whitelist, lambda: self.user_whitelist
+        )
+        tenant, email = self.identity(session)
+        if not (tenant and email): raise RuntimeError(
+            "TenantID and email weren't correctly retrieved for this session!")
+        if verbose: log.debug(
+            f"{self}: Successfully found user's whitelist details!\n  - tenant={tenant}\n  - email={email}")
+
+        # Check user's tenant
+        if getattr(self, 'tenant_whitelist', None) is not None:
+            if tenant not in self.tenant_whitelist:
+                log.warning(
+                    f"{self}: Unauthorized tenant {tenant} attempted to access the website!")
+                return False
+        elif verbose:
+            log.debug(f"{self}: No tenant whitelist. Skipping...")
+
+        # Then check user whitelist
+        if getattr(self, 'user_whitelist', None) is not None:
+            if email not in self.user_whitelist:
+                log.warning(
+                    f"{self}: Unauthorized user {email} attempted to access the website!")
+                return False
+        elif verbose:
+            log.debug(f"{self}: No user whitelist. Skipping...")
+        return True
+
+    async def fetch_profile(self, access_token: str, claims: dict = None) -> tuple["Me", "Organization"]:
+        """Fetch a user's profile and organization, cached by object/tenant id or in one Graph $batch round trip"""
+        return await self.graph_client.profile(access_token, claims)
+
+    def admission_digest(self) -> int:
+        """Epoch derived from the whitelists' contents, so it agrees across workers and restarts and is never 0"""
+        return admission_epoch(
+            self.admission_generation, getattr(self, "user_whitelist", None), getattr(self, "tenant_whitelist", None))
+
+    def rekey_admissions(self):
+        """Re-derive the epoch after a whitelist reload, sending sessions admitted under the old lists back through the gate"""
+        self.admission_epoch = self.admission_digest()
+        log.debug(f"{self}: Admissions now at epoch {self.admission_epoch:x}")
+
+    def invalidate_admissions(self):
+        """Force every session back through the full gate, e.g. after the whitelists change"""
+        self.admission_generation += 1
+        self.rekey_admissions()
+
+    def finalize(self, request: Request, session: Session, response: Response) -> Response:
+        # Handle 404s with the pre-rendered animated popup
         if response.status_code == 404:
-            return self.popup_404(
-                message=f"The page '{request.url.path}' could not be found."
-            )
+            response = self.render_cache.not_modified(request, self.popup_404())
+
+        if self.sessions.stateless and self.sessions.changed(session, getattr(request.state, "cookie_state", None)):
+            self.sessions.set_cookie(response, session, httponly=True)
 
         return response
 
-    def session_manager(self, request: Request) -> Session | Response:
-        if "/microsoft_oauth/callback" in request.url.path:
-            token = request.query_params.get("state")
-            log.warning(token)
-            if not token:
-                return Response("Missing state parameter", status_code=400)
-        else:
-            token = request.cookies.get(self.session_name)  # "session":
-            if not token:
-                token = secrets.token_urlsafe(32)
-        session = self.sessions[token]
-        setattr(session, "request", request)
-        session.request.cookies[self.session_name] = session.token
-        log.debug(f"{self}: Associated session with request, {request}\n  - cookies={request.cookies}")
-        if session.authenticated:
-            log.debug(f"{self}: This session was marked as authenticated!")
+    def cookie_headers(self, request: Request, session: Session) -> list[tuple[bytes, bytes]]:
+        """Raw Set-Cookie headers needed to sync a stateless session cookie onto a passthrough response"""
+        if not self.sessions.stateless: return []
+        if not self.sessions.changed(session, getattr(request.state, "cookie_state", None)): return []
+        response = self.sessions.set_cookie(Response(), session, httponly=True)
+        return [(k, v) for k, v in response.raw_headers if k == b"set-cookie"]
+
+    @staticmethod
+    def identity(session: Session) -> tuple[str | None, str | None]:
+        """Return the (tenant id, user principal name) of a session, from its validated claims or else from Graph"""
+        claims = session.claims or {}
+        if claims.get("tid") and claims.get("upn"): return claims["tid"], claims["upn"]
+        user: User = session.user
+        if user is not None and user.org is not None and user.me is not None:
+            return user.org.id, user.me.userPrincipalName
+        return claims.get("tid"), claims.get("upn")
+
+    @staticmethod
+    def display_name(session: Session) -> str | None:
+        user: User = session.user
+        if user is not None and user.me is not None:
+            return user.me.displayName
+        return (session.claims or {}).get("name")
+
+    async def session_manager(self, request: Request) -> Session:
+        start = time.perf_counter()
+        # the OAuth callback's state is resolved by the pending store, never used to look up or create a session
+        cookie = request.cookies.get(self.session_name)  # "session":
+        session, request.state.cookie_state = await self.sessions.for_cookie(cookie)
+        # the request only references the session, never the other way round, so idle sessions pin no scopes
+        request.state.session = session
+        if not self.sessions.stateless: request.cookies[self.session_name] = session.token
+        self.metrics.observe("session_lookup", time.perf_counter() - start)
+        if self.verbose and sampled(): log.opt(lazy=True).debug(
+            "{}: Associated session {}... with request for '{}' (authenticated={})",
+            lambda: self, lambda: session.token[:8], lambda: request.url.path, lambda: session.authenticated
+        )
         return session
 
+    def precompile(self):
+        """Compile every bundled template up front, through the shared bytecode cache, instead of on first request"""
+        start = time.perf_counter()
+        compiled = compile_templates(self.default_templater, CWD_TEMPLATER)
+        log.opt(lazy=True).debug(
+            "{}: Precompiled {} templates in {:.1f}ms",
+            lambda: self, lambda: compiled, lambda: (time.perf_counter() - start) * 1000
+        )
+
+    def prerender(self):
+        """Render the constant popup variants once at startup so they are served straight from the cache"""
+        pin = self.render_cache.pin
+        pin("popup_404", self.popup_404)
+        pin(("popup_unauthorized", None), self.popup_unauthorized)
+        pin(("popup_unauthorized", UNAUTHORIZED_MESSAGE), lambda: self.popup_unauthorized(UNAUTHORIZED_MESSAGE))
+        for error_code in ERROR_MESSAGES: pin(("popup_error", error_code), lambda code=error_code: self.popup_error(code))
+
     def redirect_html(self, target_url):
         """Generate HTML that redirects to OAuth URL"""
         return self.default_templater.safe_render('redirect.html', redirect_url=target_url)
@@ -328,7 +588,9 @@ class SessionedServer(CWD, ThreadedServer):
 
     def popup_404(self, message=None, redirect_delay=5000):
         """Generate 404 popup HTML"""
-        return self.default_templater.safe_render(
+        if message is None and redirect_delay == 5000 and (page := self.render_cache.pinned("popup_404")):
+            return page
+        return self.render_cache.render(
             'popup.html',
             title="Page Not Found - 404",
             header="404 - Page Not Found",
@@ -354,20 +616,12 @@ class SessionedServer(CWD, ThreadedServer):
 
     def popup_error(self, error_code=500, message=None):
         """Generate generic error popup HTML"""
-        error_messages = {
-            400: "Bad request - something went wrong with your request.",
-            401: "Unauthorized - you need to log in to access this.",
-            403: "Forbidden - you don't have permission to access this.",
-            404: "Page not found - this page doesn't exist.",
-            500: "Internal server error - something went wrong on our end.",
-            503: "Service unavailable - we're temporarily down for maintenance."
-        }
-
-        return self.default_templater.safe_render(
+        if message is None and (page := self.render_cache.pinned(("popup_error", error_code))): return page
+        return self.render_cache.render(
             'popup.html',
             title=f"Error {error_code}",
             header=f"Error {error_code}",
-            text=message or error_messages.get(error_code, "An unexpected error occurred."),
+            text=message or ERROR_MESSAGES.get(error_code, "An unexpected error occurred."),
             icon_content="⚠",
             icon_color="linear-gradient(135deg, #f59e0b, #d97706)",
             buttons=[
@@ -385,9 +639,17 @@ class SessionedServer(CWD, ThreadedServer):
             footer_text="Contact support if this problem persists"
         )
 
+    def too_many_requests(self, retry_after: int):
+        """Generate a 429 popup that tells the client when to retry"""
+        response = self.popup_error(429)
+        response.status_code = 429
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+
     def popup_unauthorized(self, message=None):
         """Generate unauthorized popup HTML"""
-        return self.default_templater.safe_render(
+        if page := self.render_cache.pinned(("popup_unauthorized", message)): return page
+        return self.render_cache.render(
             'popup.html',
             title="Unauthorized Access",
             header="Unauthorized Access",
@@ -414,9 +676,7 @@ class SessionedServer(CWD, ThreadedServer):
                       auto_close_ms=None, redirect_url=None, redirect_delay_ms=None,
                       show_loading_dots=False):
         """Generate generic popup HTML with customizable styling and content"""
-        from loguru import logger as log
-
-        log.debug(f"Generating {popup_type} popup with title: {title}")
+        if self.verbose and enabled("DEBUG"): log.debug(f"Generating {popup_type} popup with title: {title}")
 
         # Default configurations for different popup types
         popup_configs = {
@@ -476,7 +736,7 @@ class SessionedServer(CWD, ThreadedServer):
                 }
             ]
 
-        return self.default_templater.safe_render(
+        return self.render_cache.render(
             'popup.html',
             title=title or config["title"],
             header=header or config["header"],
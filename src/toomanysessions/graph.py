@@ -0,0 +1,86 @@
+import time
+from typing import Any
+
+import httpx
+from loguru import logger as log
+
+from . import DEBUG
+from .clients import HTTPPool
+from .metrics import Histogram
+from .store import TTLCache
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+
+
+class GraphClient:
+    """Long-lived, pooled Microsoft Graph client that hydrates profiles with a single JSON $batch request"""
+
+    def __init__(
+            self,
+            base_url: str = GRAPH_URL,
+            pool: HTTPPool = None,
+            me_ttl: float = 3600.0,
+            org_ttl: float = 3600.0 * 12,
+            cache_size: int = 100_000,
+            verbose: bool = DEBUG
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.pool = pool or HTTPPool(verbose=verbose)
+        self.verbose = verbose
+        self.latency = Histogram()
+        self.me_cache = TTLCache(ttl=me_ttl, max_size=cache_size)
+        self.org_cache = TTLCache(ttl=org_ttl, max_size=cache_size)
+
+    def __repr__(self):
+        return "[TooManySessions.GraphClient]"
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.pool.client
+
+    async def batch(self, access_token: str, requests: list[dict]) -> dict[str, dict]:
+        """Send several Graph requests as one $batch call, returning each response by request id"""
+        response = await self.client.post(
+            f"{self.base_url}/$batch",
+            json={"requests": requests},
+            headers={"Authorization": f"Bearer {access_token}"}
+        )
+        if response.status_code != 200:
+            raise PermissionError(f"{self}: Graph $batch failed with status {response.status_code}: {response.text}")
+        return {each["id"]: each for each in response.json()["responses"]}
+
+    async def profile(self, access_token: str, claims: dict = None) -> tuple[Any, Any]:
+        """Fetch the signed-in user's Me and Organization, from the shared caches or in a single round trip"""
+        claims = claims or {}
+        oid, tid = claims.get("oid"), claims.get("tid")
+        me, org = self.me_cache.get(oid), self.org_cache.get(tid)
+
+        requests = []
+        if me is None: requests.append({"id": "me", "method": "GET", "url": "/me"})
+        if org is None: requests.append({"id": "org", "method": "GET", "url": "/organization"})
+        if not requests:
+            if self.verbose: log.debug(f"{self}: Served profile for {oid} entirely from cache")
+            return me, org
+
+        start = time.perf_counter()
+        try:
+            responses = await self.batch(access_token, requests)
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+        for each in responses.values():
+            if each.get("status") != 200:
+                message = (each.get("body") or {}).get("error", {}).get("message", "Got unexpected status code")
+                raise PermissionError(f"{self}: Graph request '{each['id']}' failed: {message}")
+        if org is None and not (responses["org"].get("body") or {}).get("value"):
+            # a token that can't see its own tenant gets an empty list back, which is as much a failure as a 403
+            raise PermissionError(f"{self}: Graph request 'org' failed: No organization returned")
+        if self.verbose: log.debug(f"{self}: Hydrated profile in {self.latency.mean:.3f}s on average")
+
+        from pyzurecli import Me, Organization
+        if me is None:
+            me = Me(**responses["me"]["body"])
+            self.me_cache.set(me.get("id") or oid, me)
+        if org is None:
+            org = Organization(**responses["org"]["body"]["value"][0])
+            self.org_cache.set(org.get("id") or tid, org)
+        return me, org
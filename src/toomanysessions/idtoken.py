@@ -0,0 +1,124 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+from loguru import logger as log
+
+from . import DEBUG
+from .clients import HTTPPool
+
+# DER prefix of a PKCS#1 v1.5 DigestInfo for SHA-256 (RFC 8017, section 9.2)
+SHA256_DIGEST_INFO = bytes.fromhex("3031300d060960864801650304020105000420")
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def b64int(data: str) -> int:
+    return int.from_bytes(b64decode(data), "big")
+
+
+def verify_rs256(signing_input: bytes, signature: bytes, n: int, e: int) -> bool:
+    """RSASSA-PKCS1-v1_5 verification with SHA-256, in pure Python"""
+    k = (n.bit_length() + 7) // 8
+    if len(signature) != k: return False
+    s = int.from_bytes(signature, "big")
+    if s >= n: return False
+    encoded = pow(s, e, n).to_bytes(k, "big")
+    t = SHA256_DIGEST_INFO + hashlib.sha256(signing_input).digest()
+    if k < len(t) + 11: return False
+    expected = b"\x00\x01" + b"\xff" * (k - len(t) - 3) + b"\x00" + t
+    return hmac.compare_digest(encoded, expected)
+
+
+class JWKS:
+    """Signing keys published by the identity provider, cached and refetched every `ttl` seconds or on an unknown kid"""
+
+    def __init__(self, url: str, pool: HTTPPool, ttl: float = 6 * 3600, min_interval: float = 300.0, verbose: bool = DEBUG):
+        self.url = url
+        self.pool = pool
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.verbose = verbose
+        self.keys: dict[str, tuple[int, int]] = {}
+        self.fetched_at = 0.0
+        self._lock: asyncio.Lock | None = None
+
+    def __repr__(self):
+        return f"[TooManySessions.JWKS.{len(self.keys)}]"
+
+    @property
+    def stale(self) -> bool:
+        return time.monotonic() - self.fetched_at > self.ttl
+
+    async def refresh(self) -> None:
+        if self._lock is None: self._lock = asyncio.Lock()
+        async with self._lock:
+            if time.monotonic() - self.fetched_at < self.min_interval and self.keys: return
+            response = await self.pool.client.get(self.url)
+            response.raise_for_status()
+            keys = {}
+            for jwk in response.json().get("keys", []):
+                if jwk.get("kty") != "RSA" or jwk.get("use", "sig") != "sig" or "kid" not in jwk: continue
+                keys[jwk["kid"]] = (b64int(jwk["n"]), b64int(jwk["e"]))
+            self.keys, self.fetched_at = keys, time.monotonic()
+            if self.verbose: log.debug(f"{self}: Fetched {len(keys)} signing keys from {self.url}")
+
+    async def warm(self) -> None:
+        """Fetch the keys ahead of the first login, without failing startup if the provider is unreachable"""
+        try:
+            await self.refresh()
+        except Exception as e:
+            log.warning(f"{self}: Could not prefetch signing keys: {e}")
+
+    async def key(self, kid: str) -> tuple[int, int] | None:
+        if self.stale or kid not in self.keys:
+            try:
+                await self.refresh()
+            except Exception as e:
+                # keep serving the keys we have if the provider is briefly unreachable
+                log.warning(f"{self}: Could not refresh signing keys: {e}")
+        return self.keys.get(kid)
+
+
+class IdTokenValidator:
+    """Local validation of OpenID Connect id_tokens: RS256 signature, audience, issuer and lifetime"""
+
+    def __init__(self, jwks: JWKS, client_id: str, issuer: str, leeway: float = 300.0):
+        self.jwks = jwks
+        self.client_id = client_id
+        self.issuer = issuer  # may contain '{tid}', as multi-tenant issuers name the user's own tenant
+        self.leeway = leeway
+
+    def __repr__(self):
+        return "[TooManySessions.IdTokenValidator]"
+
+    async def validate(self, id_token: str) -> dict:
+        """Return the verified claims of an id_token, raising ValueError if it can't be trusted"""
+        # an access token is never a substitute: without a signed id_token there is no identity to trust
+        if not id_token: raise ValueError("Missing id_token")
+        try:
+            header_b64, payload_b64, signature_b64 = id_token.split(".")
+            header = json.loads(b64decode(header_b64))
+            claims = json.loads(b64decode(payload_b64))
+            signature = b64decode(signature_b64)
+        except Exception as e:
+            raise ValueError(f"Malformed id_token: {e}") from e
+
+        if header.get("alg") != "RS256": raise ValueError(f"Unsupported id_token algorithm {header.get('alg')}")
+        key = await self.jwks.key(header.get("kid"))
+        if key is None: raise ValueError(f"Unknown id_token signing key {header.get('kid')}")
+        if not verify_rs256(f"{header_b64}.{payload_b64}".encode("ascii"), signature, *key):
+            raise ValueError("Invalid id_token signature")
+
+        now = time.time()
+        if claims.get("aud") != self.client_id: raise ValueError("id_token was issued for another audience")
+        if claims.get("iss") != self.issuer.format(tid=claims.get("tid")): raise ValueError("Unexpected id_token issuer")
+        if not isinstance(claims.get("exp"), (int, float)) or claims["exp"] + self.leeway < now:
+            raise ValueError("id_token has expired")
+        if claims.get("nbf", 0) - self.leeway > now: raise ValueError("id_token is not valid yet")
+        return claims
@@ -0,0 +1,45 @@
+import random
+import sys
+from typing import Any
+
+from loguru import logger as log
+
+# loguru's default stderr handler logs everything from DEBUG up
+_state = {"level": 10, "sample_rate": 1.0}
+_levels: dict[str, int] = {}
+
+
+def level_no(level: str | int) -> int:
+    if isinstance(level, int): return level
+    no = _levels.get(level)
+    if no is None: no = _levels[level] = log.level(level).no
+    return no
+
+
+def configure_logging(
+        level: str | int = "INFO",
+        enqueue: bool = True,
+        sample_rate: float = 1.0,
+        sink: Any = sys.stderr,
+        **kwargs
+) -> int:
+    """Replace loguru's handlers with one sink, optionally written from a background thread, and set the
+    fraction of per-request log lines that are kept. Returns the handler id."""
+    if not 0.0 <= sample_rate <= 1.0: raise ValueError("sample_rate must be between 0 and 1")
+    log.remove()
+    handler_id = log.add(sink, level=level, enqueue=enqueue, **kwargs)
+    _state["level"] = level_no(level)
+    _state["sample_rate"] = sample_rate
+    return handler_id
+
+
+def enabled(level: str | int = "DEBUG") -> bool:
+    """Whether a message at this level would reach the configured sink"""
+    return level_no(level) >= _state["level"]
+
+
+def sampled(level: str | int = "DEBUG") -> bool:
+    """Level guard for per-request log lines, which are additionally thinned out to the configured sample rate"""
+    if level_no(level) < _state["level"]: return False
+    rate = _state["sample_rate"]
+    return rate >= 1.0 or random.random() < rate
@@ -0,0 +1,112 @@
+import bisect
+import sys
+from dataclasses import dataclass, field, fields
+from typing import Any, Callable
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGES = ("session_lookup", "auth_redirect", "graph_hydration", "whitelist_check", "render")
+PREFIX = "toomanysessions"
+
+
+@dataclass
+class Histogram:
+    """Fixed-bucket latency histogram in seconds"""
+    buckets: tuple[float, ...] = LATENCY_BUCKETS
+    counts: list[int] = field(default=None)
+    sum: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        if self.counts is None: self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """Prometheus-style (le, count) pairs, ending with +Inf"""
+        total, out = 0, []
+        for le, count in zip([*map(str, self.buckets), "+Inf"], self.counts):
+            total += count
+            out.append((le, total))
+        return out
+
+    def to_dict(self) -> dict:
+        return {"buckets": dict(self.cumulative()), "sum": self.sum, "count": self.count, "mean": self.mean}
+
+
+@dataclass
+class LookupStats:
+    """Hit/miss counters for a keyed lookup; plain increments under the GIL, no locking on the hot path"""
+    hits: int = 0
+    misses: int = 0
+    created: int = 0
+
+    @property
+    def ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def to_dict(self) -> dict:
+        return {**{f.name: getattr(self, f.name) for f in fields(self)}, "hit_ratio": self.ratio}
+
+
+def estimate_size(record: Any) -> int:
+    """Shallow size of a dataclass record plus the sizes of its direct field values"""
+    size = sys.getsizeof(record)
+    for f in fields(record):
+        value = getattr(record, f.name)
+        if value is not None and not isinstance(value, (bool, int, float)): size += sys.getsizeof(value)
+    return size
+
+
+class Metrics:
+    """Session counts, lookup hit ratios and per-stage latency histograms, rendered as Prometheus text or JSON"""
+
+    def __init__(self, stages: tuple[str, ...] = STAGES):
+        self.stages: dict[str, Histogram] = {stage: Histogram() for stage in stages}
+        self.lookups: dict[str, LookupStats] = {}
+        self.gauges: dict[str, Callable[[], dict]] = {}
+
+    def __repr__(self):
+        return "[TooManySessions.Metrics]"
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self.stages[stage].observe(seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            **{name: gauge() for name, gauge in self.gauges.items()},
+            "lookups": {name: stats.to_dict() for name, stats in self.lookups.items()},
+            "stages": {name: histogram.to_dict() for name, histogram in self.stages.items()},
+        }
+
+    def prometheus(self) -> str:
+        lines = []
+        for name, gauge in self.gauges.items():
+            for key, value in gauge().items():
+                if value is None: continue
+                metric = f"{PREFIX}_{name}_{key}"
+                kind = "counter" if key.endswith("_total") else "gauge"
+                lines += [f"# TYPE {metric} {kind}", f"{metric} {value}"]
+        if self.lookups:
+            lines.append(f"# TYPE {PREFIX}_lookups_total counter")
+            for name, stats in self.lookups.items():
+                lines.append(f'{PREFIX}_lookups_total{{cache="{name}",result="hit"}} {stats.hits}')
+                lines.append(f'{PREFIX}_lookups_total{{cache="{name}",result="miss"}} {stats.misses}')
+            lines.append(f"# TYPE {PREFIX}_lookup_hit_ratio gauge")
+            for name, stats in self.lookups.items():
+                lines.append(f'{PREFIX}_lookup_hit_ratio{{cache="{name}"}} {stats.ratio}')
+        metric = f"{PREFIX}_stage_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for stage, histogram in self.stages.items():
+            for le, count in histogram.cumulative():
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,121 @@
+import re
+from typing import Iterable
+
+from loguru import logger as log
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .logs import sampled
+
+
+class RouteClassifier:
+    """Bypass route matcher compiled once into a single prefix regex, with a bounded per-path cache"""
+
+    def __init__(self, prefixes: Iterable[str] = (), cache_size: int = 4096):
+        self.cache_size = cache_size
+        self.cache: dict[str, bool] = {}
+        self.pattern: re.Pattern | None = None
+        self.compile(prefixes)
+
+    def __repr__(self):
+        return f"[TooManySessions.RouteClassifier.{self.pattern.pattern if self.pattern else None}]"
+
+    @staticmethod
+    def _prefix(path: str) -> str:
+        parts = re.split(r"(\{[^}]*})", path.rstrip("/"))
+        return "".join("[^/]+" if part.startswith("{") else re.escape(part) for part in parts)
+
+    def compile(self, prefixes: Iterable[str]):
+        prefixes = sorted({self._prefix(prefix) for prefix in prefixes}, key=len, reverse=True)
+        self.pattern = re.compile(f"(?:{'|'.join(prefixes)})(?:/|$)") if prefixes else None
+        self.cache = {}
+
+    def __call__(self, path: str) -> bool:
+        bypassed = self.cache.get(path)
+        if bypassed is None:
+            bypassed = self.pattern is not None and self.pattern.match(path) is not None
+            if len(self.cache) >= self.cache_size: self.cache = {}
+            self.cache[path] = bypassed
+        return bypassed
+
+
+def without_dispatch(middleware: list[Middleware], name: str) -> list[Middleware]:
+    """Drop the `@app.middleware("http")` function called `name` from a not-yet-built middleware stack"""
+    return [
+        each for each in middleware
+        if not (each.cls is BaseHTTPMiddleware and getattr(each.kwargs.get("dispatch"), "__name__", None) == name)
+    ]
+
+
+class SessionedMiddleware:
+    """Pure ASGI implementation of the `SessionedServer` auth gate, with no call_next streaming hop"""
+
+    def __init__(self, app: ASGIApp, server):
+        self.app = app
+        self.server = server
+
+    def __repr__(self):
+        return f"{self.server}.SessionedMiddleware"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        server = self.server
+        path = scope["path"]
+        if server.verbose and sampled("INFO"): log.opt(lazy=True).info(
+            "{}: Got request for '{}'", lambda: server, lambda: path)
+        if server.is_bypassed(path):
+            if server.verbose and sampled(): log.opt(lazy=True).debug(
+                "{}: Bypassing auth middleware for {}", lambda: self, lambda: path)
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        try:
+            session = await server.session_manager(request)
+            response = await server.admit(request, session)
+        except Exception as e:
+            log.error(f"{server}: Error processing request: {e}")
+            response = server.popup_error(
+                error_code=500,
+                message="An unexpected error occurred while processing your request."
+            )
+        if response is not None:
+            await response(scope, receive, send)
+            return
+
+        cookie_headers = server.cookie_headers(request, session)
+        started = False
+        not_found = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal started, not_found
+            if message["type"] == "http.response.start":
+                started = True
+                if message["status"] == 404:
+                    not_found = True
+                    return
+                if cookie_headers:
+                    message = {**message, "headers": [*message.get("headers", []), *cookie_headers]}
+            elif not_found:
+                if not message.get("more_body", False):
+                    popup = server.finalize(request, session, Response(status_code=404))
+                    await popup(scope, receive, send)
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            if started: raise
+            log.error(f"{server}: Error processing request: {e}")
+            popup = server.popup_error(
+                error_code=500,
+                message="An unexpected error occurred while processing your request."
+            )
+            await popup(scope, receive, send)
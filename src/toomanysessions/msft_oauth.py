@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field, fields
 from functools import cached_property
 from pathlib import Path
 from urllib.parse import urlencode
@@ -9,20 +10,26 @@ from fastapi import APIRouter
 from loguru import logger as log
 from pyzurecli import AzureCLI
 from starlette.requests import Request
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, HTMLResponse, Response
 from toomanyconfigs import CWD
 from toomanyconfigs.core import TOMLConfig
 
+from . import DEBUG
+from .logs import sampled
+from .idtoken import JWKS, IdTokenValidator
 from .sessions import Session
 
-DEBUG = True
-
 
 # noinspection PyUnresolvedReferences
 class MSFTOAuthCFG(TOMLConfig):
     client_id: str = None
     tenant_id: str = "common"
-    scopes: str = "User.Read Organization.Read.All"
+    scopes: str = "openid profile User.Read Organization.Read.All offline_access"
+
+
+AUTHORITY = "https://login.microsoftonline.com"
+# openid returns the id_token we validate locally, profile puts preferred_username in it, offline_access a refresh token
+REQUIRED_SCOPES = ("openid", "profile", "offline_access")
 
 
 @dataclass
@@ -38,13 +45,38 @@ class MSFTOAuthTokenResponse:
     scope: str
     expires_in: int
     ext_expires_in: int
-    access_token: str
+    # bearer credentials never show up in a repr, so a stray log line can't leak them
+    access_token: str = field(repr=False)
+    refresh_token: str = field(default=None, repr=False)
+    id_token: str = field(default=None, repr=False)
+    expires_at: float = None
+
+    @classmethod
+    def from_response(cls, data: dict) -> 'MSFTOAuthTokenResponse':
+        """Build from a token endpoint reply, ignoring fields we don't keep and stamping the absolute expiry"""
+        known = {f.name for f in fields(cls)}
+        creds = cls(**{k: v for k, v in data.items() if k in known})
+        if creds.expires_at is None: creds.expires_at = time.time() + int(creds.expires_in)
+        return creds
+
+
+def identity_claims(claims: dict) -> dict:
+    """Reduce a token's claims to the identity fields sessions keep"""
+    return {
+        "oid": claims.get("oid"),
+        "tid": claims.get("tid"),
+        "upn": claims.get("upn") or claims.get("preferred_username") or claims.get("unique_name"),
+        "name": claims.get("name")
+    }
 
 
 class MicrosoftOAuth(CWD, APIRouter):
+    authority: str = AUTHORITY
+
     def __init__(
             self,
             server,
+            verbose: bool = DEBUG,
             **cfg_kwargs
     ):
         from . import SessionedServer
@@ -52,6 +84,7 @@ class MicrosoftOAuth(CWD, APIRouter):
         if not isinstance(server, SessionedServer): raise TypeError(
             "Passed server is not an instance of Sessioned Server")
         self.sessions = self.server.sessions
+        self.verbose = verbose
         self.url = self.server.url
         self.prefix = "/microsoft_oauth"
         self.redirect_uri = self.url + self.prefix + "/callback"
@@ -65,6 +98,9 @@ class MicrosoftOAuth(CWD, APIRouter):
         _ = self.cfg
         self.tenant_id = self.cfg.tenant_id  # Now that we're doing auth by getting tenants from user's all urls should be common
         self.scopes = self.cfg.scopes
+        # configs written by older releases lack the OpenID and refresh scopes
+        missing = [scope for scope in REQUIRED_SCOPES if scope not in self.scopes.split()]
+        if missing: self.scopes = " ".join([*missing, self.scopes])
 
         APIRouter.__init__(
             self,
@@ -77,60 +113,48 @@ class MicrosoftOAuth(CWD, APIRouter):
 
         @self.get("/callback")
         async def callback(request: Request):
+            if retry_after := self.server.throttle.check(request):
+                return self.server.too_many_requests(retry_after)
             params = request.query_params
-            log.debug(f"{self}: Received auth callback with params: ")
-            for param in params:
-                log.debug(f"  - {param}={str(params[param])[:10]}...")
+            if self.verbose and sampled(): log.opt(lazy=True).debug(
+                "{}: Received auth callback with params {}", lambda: self, lambda: sorted(params))
             try:
                 params = MSFTOAuthCallback(**params)
-                session = self.sessions[params.state]
-
-                if not session:
-                    log.error("Session not found for state")
-                    raise ValueError("Invalid session state")
-
-                log.debug(f"Retrieved session: {session}")
-
-                if not hasattr(session, 'verifier'):
-                    log.error(f"{self}: Session missing verifier attribute")
-                    log.debug(
-                        f"{self}: Session attributes: {[attr for attr in dir(session) if not attr.startswith('_')]}")
-                    raise ValueError("OAuth session missing PKCE verifier")
-
-                if not session.verifier:
-                    log.error("Session verifier is empty")
-                    raise ValueError("OAuth session verifier is empty")
-
-                log.debug(f"Using verifier: {session.verifier[:10]}...")
-
             except Exception as e:
                 log.error(f"OAuth callback failed: {type(e).__name__}: {str(e)}")
                 from . import SessionedServer
                 server: SessionedServer = self.server
                 return server.popup_error(500, e)
 
+            cookie = request.cookies.get(self.sessions.session_name)
+            session = await self.sessions.offload(self.sessions.for_state, params.state, cookie)
+            if session is None or not session.verifier:
+                # forged, replayed or expired states are turned away without allocating anything
+                return Response("Invalid or expired state parameter", status_code=400)
+            if self.verbose: log.debug(f"{self}: Resolved callback state to session {session.token[:8]}...")
+
             session.code = params.code
 
             token_request = self.build_access_token_request(session)  # type: ignore
-            async with httpx.AsyncClient() as client:
-                response = await client.send(token_request)
-                if response.status_code == 200:
-                    creds = MSFTOAuthTokenResponse(**response.json())
-                    setattr(session, "oauth_token_data", creds)
-                    log.debug(f"{self}: Successfully exchanged code for token")
-                    setattr(session, "authenticated", True)
-                    log.debug(f"{self}: Updated session:\n  - {session}")
-                    key = self.sessions.session_name
-                    response = self.login_successful
-                    response.set_cookie(
-                        key=key,
-                        value=session.token,
-                        httponly=True
-                    )
-                    return response
-                else:
-                    log.error(f"Token exchange failed: {response.status_code} - {response.text}")
-                    raise Exception(f"Token exchange failed: {response.status_code}")
+            response = await self.server.http.client.send(token_request)
+            if response.status_code == 200:
+                creds = MSFTOAuthTokenResponse.from_response(response.json())
+                claims = await self.verified_claims(creds)
+                if claims is None:
+                    return self.server.popup_error(401, "We couldn't verify your sign-in. Please try again.")
+                setattr(session, "oauth_token_data", creds)
+                log.debug(f"{self}: Successfully exchanged code for token")
+                setattr(session, "authenticated", True)
+                setattr(session, "claims", claims)
+                setattr(session, "verifier", None)
+                await self.sessions.acommit(session)
+                if getattr(self.server, "refresher", None) is not None: self.server.refresher.schedule(session)
+                if self.verbose: log.debug(f"{self}: Signed in session {session.token[:8]}...")
+                response = HTMLResponse(self.login_successful.body)
+                return self.sessions.set_cookie(response, session, httponly=True)
+            else:
+                log.error(f"Token exchange failed: {response.status_code} - {response.text}")
+                raise Exception(f"Token exchange failed: {response.status_code}")
 
         self.bypass_routes = []
         for route in self.routes:
@@ -163,17 +187,27 @@ class MicrosoftOAuth(CWD, APIRouter):
     def client_id(self):
         return self.cfg.client_id
 
-    def build_auth_code_request(self, session: Session) -> httpx.Request:
-        """Build Microsoft OAuth authorization URL with fresh PKCE"""
+    @cached_property
+    def id_tokens(self) -> IdTokenValidator:
+        jwks = JWKS(f"{self.authority}/{self.tenant_id}/discovery/v2.0/keys", self.server.http)
+        return IdTokenValidator(jwks, client_id=self.client_id, issuer=self.authority + "/{tid}/v2.0")
+
+    async def verified_claims(self, creds: MSFTOAuthTokenResponse) -> dict | None:
+        """Identity claims from the locally validated id_token, or None if it is missing or fails validation"""
+        try:
+            return identity_claims(await self.id_tokens.validate(creds.id_token))
+        except ValueError as e:
+            log.warning(f"{self}: Rejected id_token: {e}")
+            return None
+
+    def build_auth_code_request(self, session: Session, client: str = None) -> httpx.Request:
+        """Build Microsoft OAuth authorization URL with fresh PKCE, for the client address that asked for it"""
         code_verifier = pkce.generate_code_verifier(length=43)
         code_challenge = pkce.get_code_challenge(code_verifier)
 
-        session.verifier = code_verifier  # Direct assignment instead of setattr
-        log.debug(f"{self}: Stored verifier in session: {session.verifier}...")
-        log.debug(f"{self}: Session after storing verifier: {session}")
-        log.debug(f"{self}: Generated code_challenge: {code_challenge}")
+        state = self.sessions.authorization_state(session, code_verifier, client)
 
-        base_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/authorize"
+        base_url = f"{self.authority}/{self.tenant_id}/oauth2/v2.0/authorize"
 
         params = {
             "client_id": self.client_id,
@@ -181,26 +215,22 @@ class MicrosoftOAuth(CWD, APIRouter):
             "redirect_uri": self.redirect_uri,
             "response_mode": "query",
             "scope": self.scopes,
-            "state": session.token,
+            "state": state,
             "code_challenge": code_challenge,
             "code_challenge_method": "S256"
         }
 
-        log.debug(f"{self}: Building request with the following params:")
-        for param in params:
-            log.debug(f"  -{param}={params.get(param)[:10]}")
-
         url = f"{base_url}?{urlencode(params)}"
-        log.debug(f"Built OAuth URL: {url}")
-
-        client = httpx.Client()
-        request = client.build_request("GET", url)
-
-        return request
+        # runs for every anonymous request, and the URL carries the state, so only a sampled summary is logged
+        if self.verbose and sampled(): log.opt(lazy=True).debug(
+            "{}: Built authorization request for session {}... with scopes '{}'",
+            lambda: self, lambda: session.token[:8], lambda: self.scopes
+        )
+        return httpx.Request("GET", url)
 
     def build_access_token_request(self, session) -> httpx.Request:
         """Build the POST request to exchange authorization code for access token"""
-        url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
+        url = self.token_url
 
         try:
             data = {
@@ -218,13 +248,29 @@ class MicrosoftOAuth(CWD, APIRouter):
         headers = {
             "Content-Type": "application/x-www-form-urlencoded"
         }
-        client = httpx.Client()
-        return client.build_request("POST", url, data=data, headers=headers)
+        return httpx.Request("POST", url, data=data, headers=headers)
+
+    @property
+    def token_url(self) -> str:
+        return f"{self.authority}/{self.tenant_id}/oauth2/v2.0/token"
+
+    def build_refresh_request(self, creds: MSFTOAuthTokenResponse) -> httpx.Request:
+        """Build the POST request that trades a refresh token for a new access token"""
+        data = {
+            "client_id": self.client_id,
+            "scope": self.scopes,
+            "refresh_token": creds.refresh_token,
+            "grant_type": "refresh_token",
+        }
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        return httpx.Request("POST", self.token_url, data=data, headers=headers)
 
     def build_logout_request(self, session: Session, redirect_uri: str) -> httpx.Request:
         """Build Microsoft OAuth logout URL"""
 
-        base_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/logout"
+        base_url = f"{self.authority}/{self.tenant_id}/oauth2/v2.0/logout"
 
         params = {
             "post_logout_redirect_uri": redirect_uri
@@ -243,10 +289,7 @@ class MicrosoftOAuth(CWD, APIRouter):
         url = f"{base_url}?{urlencode(params)}"
         log.debug(f"Built logout URL: {url}")
 
-        client = httpx.Client()
-        request = client.build_request("GET", url)
-
-        return request
+        return httpx.Request("GET", url)
 
     @cached_property
     def login_successful(self):
@@ -1,5 +1,6 @@
 import asyncio
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 
 import bcrypt
@@ -10,6 +11,8 @@ from starlette.responses import JSONResponse
 from toomanyconfigs import CWD, TOMLConfig, REPR
 
 from . import Session
+from .logs import sampled
+from .throttle import PASSKEY_LIMITS, Throttle
 
 
 def prompt_and_hash_password():
@@ -36,6 +39,9 @@ class Passkey(APIRouter):
     def __init__(
             self,
             server,
+            max_workers: int = 4,
+            max_pending: int = 32,
+            throttle: Throttle = None,
     ):
         # server type-checking
         from . import SessionedServer
@@ -53,6 +59,15 @@ class Passkey(APIRouter):
         # ensure hashed password is set
         _ = self.hashed_password
 
+        # bcrypt releases the GIL, so verification runs on a small bounded pool off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="toomanysessions-bcrypt")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.throttle = throttle or Throttle(
+            **PASSKEY_LIMITS,
+            trusted_proxies=[str(network) for network in server.throttle.trusted_proxies]
+        )
+
         # initialize api router
         super().__init__(prefix="/passkey")
 
@@ -65,15 +80,33 @@ class Passkey(APIRouter):
                 return JSONResponse({"success": True, "message": "There was an issue retrieving your session. "
                                                                  "If the error persists, Please contact a "
                                                                  "system administrator."})
-            session = self.server.session_manager(request)
+            session = await self.server.session_manager(request)
+            if retry_after := self.throttle.check(request, session.token):
+                log.warning(f"{self}: Throttled passkey attempts for {retry_after} seconds")
+                return JSONResponse(
+                    {"success": False, "message": f"Too many attempts. Please wait {retry_after} seconds."},
+                    status_code=429,
+                    headers={"Retry-After": str(retry_after)}
+                )
+            await self.server.sessions.acommit(session)
             data = await request.json()
             input_password = data["passkey"]
 
+            if self.saturated:
+                log.warning(f"{self}: Passkey verification queue is full, rejecting attempt")
+                return JSONResponse(
+                    {"success": False, "message": "Too many login attempts are being processed. Please try again."},
+                    status_code=503,
+                    headers={"Retry-After": "1"}
+                )
+
             # Pass it to your validate method
             try:
                 if await self.validate(session, input_password):
                     setattr(session, "authenticated", True)
-                    return JSONResponse({"success": True, "message": "Successfully authenticated!"})
+                    await self.server.sessions.acommit(session)
+                    response = JSONResponse({"success": True, "message": "Successfully authenticated!"})
+                    return self.server.sessions.set_cookie(response, session)
                 else:
                     return JSONResponse({"success": False, "message": "Invalid passkey"})
             except Exception as e:
@@ -103,15 +136,26 @@ class Passkey(APIRouter):
         log.debug(f"{self}: Password validation result: {is_valid}")
         return is_valid
 
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
     async def validate(self, session: Session, input_password):
-        throttle = session.throttle
-        await asyncio.sleep(throttle)
-        return self._validate(input_password)
+        if self.saturated: raise RuntimeError("Passkey verification queue is full")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self._validate, input_password)
+        finally:
+            self.pending -= 1
 
     async def show_passkey_prompt(self, request: Request):
         forward = self.server.url + request.url.path
-        log.debug(
-            f"{self}: Showing passkey prompt for request:\n  - cookies={request.cookies}\n  - redirect_url={forward}\n  - callback_url={self.callback_url}")
+        verbose = self.server.verbose and sampled()
+        if verbose: log.opt(lazy=True).debug(
+            "{}: Showing passkey prompt for request:\n  - redirect_url={}\n  - callback_url={}",
+            lambda: self, lambda: forward, lambda: self.callback_url
+        )
         response = self.server.default_templater.safe_render(
             'prompt_for_passkey.html',
             redirect_url=forward,
@@ -120,5 +164,5 @@ class Passkey(APIRouter):
         name = self.server.session_name
         cookie = request.cookies.get(name)
         response.set_cookie(self.server.session_name, cookie)
-        log.debug(f"{self}: Response has been prepared with cookie '{name}: {cookie}'")
+        if verbose: log.opt(lazy=True).debug("{}: Response has been prepared with cookie '{}'", lambda: self, lambda: name)
         return response
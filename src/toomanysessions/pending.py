@@ -0,0 +1,131 @@
+import json
+import math
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from loguru import logger as log
+
+from . import DEBUG
+from .metrics import LookupStats
+from .store import SessionBackend
+
+
+@dataclass(slots=True)
+class PendingAuthorization:
+    token: str
+    verifier: str
+    expires_at: float
+    client: str = None
+
+
+class PendingAuthorizations:
+    """In-flight authorization requests keyed by their OAuth state, single use, expiring and size-bounded"""
+
+    def __init__(
+            self,
+            ttl: float = 600.0,
+            max_pending: int = 10_000,
+            max_per_client: int = 16,
+            backend: SessionBackend = None,
+            verbose: bool = DEBUG
+    ):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.max_per_client = max_per_client
+        self.verbose = verbose
+        # a shared backend, so a callback can land on a different worker than the one that started the login
+        self.backend = backend
+        self.stats = LookupStats()
+        self.expired = 0
+        self.evicted = 0
+        # every entry lives for the same ttl, so insertion order is also expiry order
+        self._pending: OrderedDict[str, PendingAuthorization] = OrderedDict()
+        # a session holds one outstanding state and a client address a few, so a flood can only evict its own logins
+        self._by_token: dict[str, str] = {}
+        self._by_client: dict[str, list[str]] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[TooManySessions.PendingAuthorizations.{len(self._pending)}]"
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def __contains__(self, state: object) -> bool:
+        return state in self._pending
+
+    def _drop(self, state: str) -> PendingAuthorization | None:
+        """Remove a state from every index; call with the lock held"""
+        entry = self._pending.pop(state, None)
+        if entry is None: return None
+        if self._by_token.get(entry.token) == state: del self._by_token[entry.token]
+        if entry.client is not None:
+            states = self._by_client[entry.client]
+            states.remove(state)
+            if not states: del self._by_client[entry.client]
+        return entry
+
+    def prune(self, now: float = None) -> int:
+        """Drop expired entries from the oldest end; call with the lock held"""
+        now = time.monotonic() if now is None else now
+        pruned = 0
+        while self._pending:
+            state, entry = next(iter(self._pending.items()))
+            if entry.expires_at > now: break
+            self._drop(state)
+            pruned += 1
+        self.expired += pruned
+        return pruned
+
+    def add(self, token: str, verifier: str, client: str = None) -> str:
+        """Remember the PKCE verifier for a session's login and return the fresh state to send with it
+
+        The state replaces any the session still had outstanding, and past `max_per_client` states from one client
+        address its oldest is dropped. Shared backends expire records on their own and evict nothing.
+        """
+        state = secrets.token_urlsafe(32)
+        self.stats.created += 1
+        if self.backend is not None:
+            self.backend.stash(state, json.dumps([token, verifier]).encode("utf-8"), self.ttl)
+            return state
+        now = time.monotonic()
+        with self._lock:
+            self.prune(now)
+            if (previous := self._by_token.get(token)) is not None: self._drop(previous)
+            self._pending[state] = PendingAuthorization(token, verifier, now + self.ttl, client)
+            self._by_token[token] = state
+            if client is not None:
+                states = self._by_client.setdefault(client, [])
+                states.append(state)
+                if len(states) > self.max_per_client:
+                    self._drop(states[0])
+                    self.evicted += 1
+            if len(self._pending) > self.max_pending:
+                self._drop(next(iter(self._pending)))
+                self.evicted += 1
+        return state
+
+    def pop(self, state: str | None) -> PendingAuthorization | None:
+        """Claim the entry for a callback's state, or None if it is unknown, expired or already used"""
+        if not state: return None
+        if self.backend is not None:
+            raw = self.backend.claim(state)  # the backend expires its own records
+            entry = None if raw is None else PendingAuthorization(*json.loads(raw), expires_at=math.inf)
+        else:
+            with self._lock:
+                entry = self._drop(state)
+        if entry is None or entry.expires_at <= time.monotonic():
+            self.stats.misses += 1
+            if self.verbose: log.warning(f"{self}: Rejected unknown or expired OAuth state")
+            return None
+        self.stats.hits += 1
+        return entry
+
+    def census(self) -> dict:
+        if self.backend is not None: return {"pending": None, "expired_total": None, "evicted_total": None}
+        with self._lock:
+            self.prune()
+        return {"pending": len(self._pending), "expired_total": self.expired, "evicted_total": self.evicted}
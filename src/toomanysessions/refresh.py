@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import time
+from typing import Any
+
+from loguru import logger as log
+
+from . import DEBUG
+from .clients import HTTPPool
+from .metrics import Histogram
+from .throttle import RateLimiter
+
+
+class TokenRefresher:
+    """Background refresh of OAuth access tokens ahead of their expiry, in rate-limited batches over the shared pool"""
+
+    def __init__(
+            self,
+            oauth,
+            sessions,
+            pool: HTTPPool,
+            lead: float = 300.0,
+            batch_size: int = 20,
+            rate: float = 5.0,
+            retry_delay: float = 60.0,
+            verbose: bool = DEBUG
+    ):
+        self.oauth = oauth
+        self.sessions = sessions
+        self.pool = pool
+        self.lead = lead
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.verbose = verbose
+        self.limiter = RateLimiter(rate, max(batch_size, 1), max_keys=1)
+        self.latency = Histogram()
+        self.refreshed = 0
+        self.failed = 0
+        self._queue: list[tuple[float, str]] = []
+        self._scheduled: dict[str, float] = {}
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def __repr__(self):
+        return f"[TooManySessions.TokenRefresher.{len(self._scheduled)}]"
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
+
+    def schedule(self, session: Any, at: float = None) -> bool:
+        """Queue a session's token for refresh `lead` seconds before it expires; call from the event loop"""
+        creds = session.oauth_token_data
+        if creds is None or not getattr(creds, "refresh_token", None) or not creds.expires_at: return False
+        at = creds.expires_at - self.lead if at is None else at
+        self._scheduled[session.token] = at
+        heapq.heappush(self._queue, (at, session.token))
+        if self._wake is not None: self._wake.set()
+        return True
+
+    def track(self, session: Any) -> None:
+        """Schedule a session that isn't queued yet, e.g. one restored from a backend after a restart"""
+        if session.token not in self._scheduled: self.schedule(session)
+
+    def due(self, now: float) -> list[str]:
+        tokens = []
+        while self._queue and self._queue[0][0] <= now and len(tokens) < self.batch_size:
+            at, token = heapq.heappop(self._queue)
+            if self._scheduled.get(token) != at: continue  # superseded by a later schedule
+            del self._scheduled[token]
+            tokens.append(token)
+        return tokens
+
+    async def start(self):
+        if self._task is not None: return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self.run(), name="toomanysessions-refresher")
+
+    async def stop(self):
+        if self._task is None: return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            tokens = self.due(time.time())
+            if tokens:
+                while retry_after := self.limiter.hit("refresh", len(tokens)):
+                    await asyncio.sleep(retry_after)
+                await asyncio.gather(*(self.refresh(token) for token in tokens), return_exceptions=True)
+                continue
+            timeout = max(0.0, self._queue[0][0] - time.time()) if self._queue else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refresh(self, token: str) -> bool:
+        """Trade one session's refresh token for a new access token and reschedule it, never raising"""
+        session = await self.sessions.offload(self.sessions.get, token)
+        if session is None: return False
+        creds = session.oauth_token_data
+        if creds is None or not creds.refresh_token: return False
+        if session.expires_at is not None and session.expires_at <= creds.expires_at: return False
+
+        start = time.perf_counter()
+        try:
+            response = await self.pool.client.send(self.oauth.build_refresh_request(creds))
+        except Exception as e:
+            response = None
+            log.warning(f"{self}: Refresh for session {token[:8]}... failed: {e}")
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+
+        new = None
+        if response is not None and response.status_code == 200:
+            try:
+                new = type(creds).from_response(response.json())  # the stored credentials' own class
+            except Exception as e:
+                log.warning(f"{self}: Unreadable refresh response for session {token[:8]}...: {e}")
+        if new is not None:
+            if not new.refresh_token: new.refresh_token = creds.refresh_token
+            session.oauth_token_data = new
+            await self.sessions.acommit(session)
+            self.schedule(session)
+            self.refreshed += 1
+            if self.verbose: log.debug(f"{self}: Refreshed access token for session {token[:8]}...")
+            return True
+
+        self.failed += 1
+        if response is not None and 400 <= response.status_code < 500:
+            # the grant was revoked or expired, only an interactive login can recover it
+            log.warning(f"{self}: Refresh token rejected for session {token[:8]}... ({response.status_code})")
+            creds.refresh_token = None
+            await self.sessions.acommit(session)
+            return False
+        retry_at = time.time() + self.retry_delay
+        if retry_at < creds.expires_at: self.schedule(session, at=retry_at)
+        return False
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from loguru import logger as log
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, Response
+
+from .metrics import Histogram
+from .store import StoreStats
+
+
+def compile_templates(*templaters) -> int:
+    """Compile every html template of each templater into its cache up front, returning how many compiled"""
+    compiled = 0
+    for templater in templaters:
+        for name in templater.list_templates(extensions=["html"]):
+            try:
+                templater.get_template(name)
+                compiled += 1
+            except Exception as e:
+                log.warning(f"Could not precompile template '{name}': {e}")
+    return compiled
+
+
+class RenderCache:
+    """Bounded cache of rendered pages keyed on template name and a hash of the render context"""
+
+    def __init__(self, templater, max_size: int = 256, cache_control: str = "no-cache", latency: Histogram = None):
+        self.templater = templater
+        self.max_size = max_size
+        self.cache_control = cache_control
+        self.stats = StoreStats()
+        self.latency = latency or Histogram()
+        self._pages: OrderedDict[tuple[str, str], tuple[bytes, str]] = OrderedDict()
+        # constant pages rendered once at startup, outside the LRU and looked up without building a context
+        self._pinned: dict[Hashable, tuple[bytes, str]] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[TooManySessions.RenderCache.{len(self._pages)}/{self.max_size}]"
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    @staticmethod
+    def fingerprint(context: dict[str, Any]) -> str:
+        encoded = json.dumps(context, sort_keys=True, default=str, separators=(",", ":")).encode("utf-8")
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+    def pin(self, key: Hashable, render: Callable[[], Response]) -> None:
+        """Keep a page rendered by `render` under a constant key, for `pinned` to serve"""
+        response = render()
+        if response.status_code == 200 and "etag" in response.headers:
+            self._pinned[key] = (bytes(response.body), response.headers["etag"])
+
+    def pinned(self, key: Hashable) -> Response | None:
+        page = self._pinned.get(key)
+        if page is None: return None
+        self.stats.hits += 1
+        return HTMLResponse(page[0], headers={"ETag": page[1], "Cache-Control": self.cache_control})
+
+    def render(self, template_name: str, **context) -> Response:
+        start = time.perf_counter()
+        try:
+            return self._render(template_name, **context)
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+
+    def _render(self, template_name: str, **context) -> Response:
+        key = (template_name, self.fingerprint(context))
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                self.stats.hits += 1
+        if page is None:
+            self.stats.misses += 1
+            response = self.templater.safe_render(template_name, **context)
+            if not isinstance(response, Response): return HTMLResponse(response, status_code=500)
+            if response.status_code != 200: return response
+            page = (bytes(response.body), f'"{key[1]}"')
+            with self._lock:
+                self._pages[key] = page
+                self.stats.inserts += 1
+                while len(self._pages) > self.max_size:
+                    self._pages.popitem(last=False)
+                    self.stats.evicted += 1
+        body, etag = page
+        return HTMLResponse(body, headers={"ETag": etag, "Cache-Control": self.cache_control})
+
+    @staticmethod
+    def not_modified(request: Request, response: Response) -> Response:
+        """Answer 304 when the client already holds this exact page"""
+        etag = response.headers.get("etag")
+        if etag and etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": response.headers["cache-control"]})
+        return response
@@ -0,0 +1,45 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+
+@dataclass(slots=True)
+class Session:
+    token: str
+    created_at: float = None
+    expires_at: float = None
+    authenticated: bool = False
+    user: Any = None
+    code: str = None
+    oauth_token_data: Any = None
+    whitelisted: bool = False
+    welcomed: bool = False
+    claims: dict = None
+    admitted_until: float = 0.0
+    admission_epoch: int = 0
+    verifier: str = field(default=None, repr=False)
+
+    @classmethod
+    def create(cls, token: str, max_age: int = 3600 * 8) -> 'Session':
+        if not isinstance(token, str): raise TypeError(f"Token must be a string!")
+        now = time.time()
+        return cls(
+            token=token,
+            created_at=now,
+            expires_at=now + max_age,
+            authenticated=False
+        )
+
+    @property
+    def graph(self) -> Any:
+        """A Graph API handle on the current access token, built on access so no session keeps one around"""
+        if self.oauth_token_data is None: return None
+        from pyzurecli import GraphAPI
+        return GraphAPI(self.oauth_token_data.access_token)
+
+    @property
+    def is_expired(self) -> bool:
+        return time.time() > self.expires_at
+
+    def is_admitted(self, epoch: int) -> bool:
+        return self.admission_epoch == epoch and self.admitted_until > time.time()
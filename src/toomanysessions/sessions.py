@@ -1,53 +1,38 @@
-import time
-from dataclasses import dataclass
-from typing import Type, Any
+import hmac
+import secrets
+from typing import Type, Any, Callable, TYPE_CHECKING
 
-import httpx
+from anyio import to_thread
 from fastapi import APIRouter
 from loguru import logger as log
+from starlette.responses import Response, PlainTextResponse, JSONResponse
 
 from . import DEBUG
+from .logs import sampled
+from .metrics import LookupStats, Metrics
+from .pending import PendingAuthorizations
+from .session import Session
+from .store import SessionBackend, SessionStore
 
+if TYPE_CHECKING:
+    import httpx
 
-@dataclass
-class Session:
-    token: str
-    request: Any = None
-    created_at: float = None
-    expires_at: float = None
-    authenticated: bool = False
-    throttle: int = 0
-    user: Any = None
-    code: str = None
-    oauth_token_data: Any = None
-    whitelisted: bool = False
-    welcomed: bool = False
-
-    @classmethod
-    def create(cls, token: str, max_age: int = 3600 * 8) -> 'Session':
-        if not isinstance(token, str): raise TypeError(f"Token must be a string!")
-        now = time.time()
-        return cls(
-            token=token,
-            created_at=now,
-            expires_at=now + max_age,
-            authenticated=False
-        )
-
-    @property
-    def is_expired(self) -> bool:
-        return time.time() > self.expires_at
 
-
-async def authenticate(session: Session, session_name: str, redirect_uri: str) -> Session:
+async def authenticate(
+        session: Session,
+        session_name: str,
+        redirect_uri: str,
+        client: "httpx.AsyncClient" = None
+) -> Session:
+    import httpx  # only this helper needs it, so importing Session stays free of the HTTP stack
     log.debug(f"[TooManySessions] Attempting to authenticate session {session.token}")
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                redirect_uri,
-                params={f"{session_name}": f"{session.token}"},
-                timeout=5.0  # Add explicit timeout
-            )
+        params = {f"{session_name}": f"{session.token}"}
+        if client is None:
+            async with httpx.AsyncClient() as client:
+                response = await client.get(redirect_uri, params=params, timeout=5.0)
+        else:
+            response = await client.get(redirect_uri, params=params, timeout=5.0)  # Reuse the pooled connection
         log.debug(response)
     except httpx.TimeoutException:
         log.error(f"Authentication timeout for session {session.token}")
@@ -59,33 +44,162 @@ async def authenticate(session: Session, session_name: str, redirect_uri: str) -
 
 
 class Sessions(APIRouter):
+    stateless = False
+
     def __init__(
             self,
             session_model: Type[Session] = Session,
             session_name: str = "session",
+            max_age: int = 3600 * 8,
+            max_sessions: int = 100_000,
+            sweep_interval: float = 60.0,
+            lazy: bool = False,
+            backend: SessionBackend = None,
+            public_metrics: bool = False,
+            pending_ttl: float = 600.0,
+            max_pending: int = 10_000,
+            max_pending_per_client: int = 16,
             verbose: bool = DEBUG
     ):
         super().__init__(prefix="/sessions")
         self.session_model = session_model
         self.verbose = verbose
-        self.cache: dict[str, Session] = {}
+        self.max_age = max_age
+        self.lazy = lazy
+        # compared against None, an empty backend is falsy like any other empty mapping
+        self.cache: SessionBackend = backend if backend is not None else SessionStore(
+            max_size=max_sessions,
+            sweep_interval=sweep_interval,
+            verbose=self.verbose
+        )
         self.session_name = session_name
+        self.stats = LookupStats()
+        self.metrics = Metrics()
+        self.metrics.lookups["sessions"] = self.stats
+        self.metrics.gauges["sessions"] = self.census
+        # half-finished logins wait here, keyed by their OAuth state, instead of in the session store
+        self.pending = None
+        if not self.stateless:
+            self.pending = PendingAuthorizations(
+                ttl=pending_ttl,
+                max_pending=max_pending,
+                max_per_client=max_pending_per_client,
+                backend=self.cache if self.cache.shared else None,
+                verbose=verbose
+            )
+            self.metrics.lookups["oauth_state"] = self.pending.stats
+            self.metrics.gauges["oauth"] = self.pending.census
+        # let scrapers through the auth gate only when asked to
+        self.bypass_routes = ["/sessions/metrics"] if public_metrics else []
+        self.add_api_route("/metrics", self.prometheus_metrics, methods=["GET"], include_in_schema=False)
+        self.add_api_route("/metrics/json", self.json_metrics, methods=["GET"], include_in_schema=False)
+
+    def __repr__(self):
+        return "[TooManySessions.Sessions]"
+
+    def census(self) -> dict:
+        return {
+            **self.cache.census(),
+            "created_total": self.stats.created,
+            "evicted_total": self.cache.stats.evictions
+        }
+
+    def prometheus_metrics(self):
+        return PlainTextResponse(self.metrics.prometheus(), media_type="text/plain; version=0.0.4")
+
+    def json_metrics(self):
+        return JSONResponse(self.metrics.snapshot())
 
     def __getitem__(self, session_or_token: Any):
         if isinstance(session_or_token, Session): session_or_token: str = session_or_token.token
         token = session_or_token
         if isinstance(token, str):
-            if self.verbose: log.debug(
-                f"{self}: Attempting to retrieve cached session object by token:\n  - key={token}"
+            verbose = self.verbose and sampled()
+            if verbose: log.opt(lazy=True).debug(
+                "{}: Attempting to retrieve cached session object by token:\n  - key={}", lambda: self, lambda: token[:8]
             )
             cached = self.cache.get(token)
             if cached is None:
-                if self.verbose: log.warning(f"{self}: Could not get session! Attempting to create...")
-                new_session = self.session_model.create(token)
+                self.stats.misses += 1
+                self.stats.created += 1
+                if verbose: log.opt(lazy=True).warning("{}: Could not get session! Attempting to create...", lambda: self)
+                new_session = self.session_model.create(token, max_age=self.max_age)
+                if self.lazy:
+                    if verbose: log.opt(lazy=True).debug(
+                        "{}: Lazy sessions enabled, returning provisional session", lambda: self)
+                    return new_session
                 self.cache[token] = new_session
                 cached = self.cache[token]
+            else:
+                self.stats.hits += 1
             if cached is None: raise RuntimeError
-            if self.verbose: log.success(f"{self}: Successfully located:\nsession={cached}!")
+            if verbose: log.opt(lazy=True).success(
+                "{}: Successfully located session {}...", lambda: self, lambda: cached.token[:8])
             return cached
         else:
             raise TypeError(f"Expected token, got {type(session_or_token)}")
+
+    async def offload(self, func: Callable, *args: Any) -> Any:
+        """Run a store call on a worker thread when the backend blocks on I/O, so the event loop never waits on it"""
+        if not self.cache.blocking: return func(*args)
+        return await to_thread.run_sync(func, *args)
+
+    async def resolve(self, token: str) -> Session:
+        return await self.offload(self.__getitem__, token)
+
+    async def acommit(self, session: Session) -> Session:
+        return await self.offload(self.commit, session)
+
+    async def for_cookie(self, cookie: str | None) -> tuple[Session, Any]:
+        """The session a request's cookie names, created if needed, and what the cookie held for `changed`"""
+        return await self.resolve(cookie or secrets.token_urlsafe(32)), cookie
+
+    def changed(self, session: Session, cookie_state: Any) -> bool:
+        """Whether the browser's cookie no longer matches the session, so a Set-Cookie has to go out"""
+        return self.cookie_value(session) != cookie_state
+
+    def is_provisional(self, session: Session) -> bool:
+        # only lazy mode hands out sessions that were never written to the store
+        return self.lazy and session.token not in self.cache
+
+    def update(self, session: Session) -> None:
+        """Write back a session that is already stored, leaving provisional sessions unpersisted"""
+        if not self.is_provisional(session): self.commit(session)
+
+    def commit(self, session: Session) -> Session:
+        """Persist a session to the backend, materializing it if it was provisional"""
+        if self.verbose and sampled(): log.opt(lazy=True).debug(
+            "{}: Committing session {}...", lambda: self, lambda: session.token[:8])
+        self.cache.save(session)
+        return session
+
+    def get(self, token: str | None) -> Session | None:
+        """Look up an existing session without creating one"""
+        if not token: return None
+        return self.cache.get(token)
+
+    def authorization_state(self, session: Session, verifier: str, client: str = None) -> str:
+        """Hold a login's PKCE verifier until its callback, returning the OAuth state that identifies it"""
+        return self.pending.add(session.token, verifier, client)
+
+    def for_state(self, state: str, cookie: str | None) -> Session | None:
+        """Resolve a callback's state to its session with the verifier restored, or None for an unknown state"""
+        pending = self.pending.pop(state)  # claimed before the cookie check, so a failed attempt burns the state
+        if pending is None: return None
+        # the login must finish in the browser that started it, or an attacker could plant their own sign-in
+        if not hmac.compare_digest(pending.token.encode("utf-8"), (cookie or "").encode("utf-8")):
+            if self.verbose: log.warning(f"{self}: Rejected OAuth callback whose session cookie does not match its state")
+            return None
+        session = self.get(pending.token) or self.session_model.create(pending.token, max_age=self.max_age)
+        session.verifier = pending.verifier
+        return session
+
+    def discard(self, token: str) -> None:
+        self.cache.pop(token, None)
+
+    def cookie_value(self, session: Session) -> str:
+        return session.token
+
+    def set_cookie(self, response: Response, session: Session, **kwargs) -> Response:
+        response.set_cookie(self.session_name, self.cookie_value(session), **kwargs)
+        return response
@@ -0,0 +1,40 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key onto a single in-flight coroutine"""
+
+    def __init__(self):
+        self._flights: dict[Hashable, asyncio.Future] = {}
+
+    def __repr__(self):
+        return f"[TooManySessions.SingleFlight.{len(self._flights)}]"
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """Run fn once per key at a time, returning its result and whether it was shared with a leader"""
+        while (future := self._flights.get(key)) is not None:
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled(): raise  # we were cancelled ourselves, not the leader
+
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._flights[key]
@@ -0,0 +1,174 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Iterable
+
+from loguru import logger as log
+
+from . import DEBUG
+from .backends import SessionCodec, private_file, private_opener
+
+MAGIC = b"TMSSNAP1"
+# token length, expires_at, payload length, flags; a zero-length payload is a tombstone
+HEADER = struct.Struct("<HdIB")
+COMPRESSED = 1
+COMPRESS_OVER = 512  # hydrated users are worth deflating, bare sessions are not
+
+
+class SnapshotLog:
+    """Append-only, length-prefixed binary log of sessions, memory-mapped on startup and decoded lazily per token"""
+
+    def __init__(
+            self,
+            path: Path | str,
+            codec: SessionCodec = None,
+            compact_ratio: float = 2.0,
+            fsync: bool = False,
+            verbose: bool = DEBUG
+    ):
+        self.path = Path(path)
+        self.codec = codec or SessionCodec()
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        self.verbose = verbose
+        self.index: dict[str, tuple[int, int, float, int]] = {}  # records on disk not yet restored into memory
+        self.records = 0
+        self._map: mmap.mmap | None = None
+        self._write_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[TooManySessions.SnapshotLog.{self.path.name}]"
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @staticmethod
+    def record(token: str, expires_at: float | None, payload: bytes, flags: int = 0) -> bytes:
+        token = token.encode("utf-8")
+        return HEADER.pack(len(token), expires_at or 0.0, len(payload), flags) + token + payload
+
+    def payload(self, session: Any) -> tuple[bytes, int]:
+        payload = self.codec.encode(session)
+        if len(payload) > COMPRESS_OVER: return zlib.compress(payload, 1), COMPRESSED
+        return payload, 0
+
+    def open(self, now: float = None) -> list[tuple[float, str]]:
+        """Map the log and index its live records without decoding them, returning (expires_at, token) pairs"""
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        private_file(self.path)  # the log holds bearer tokens, so only the owner may read it
+        if self.path.stat().st_size < len(MAGIC):
+            self.path.write_bytes(MAGIC)
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC: raise ValueError(f"{self}: Not a session snapshot file!")
+
+        data, end, offset = self._map, len(self._map), len(MAGIC)
+        index, records = {}, 0
+        unpack, size = HEADER.unpack_from, HEADER.size
+        while offset + size <= end:
+            token_length, expires_at, length, flags = unpack(data, offset)
+            body = offset + size
+            stop = body + token_length + length
+            if stop > end: break
+            token = data[body:body + token_length].decode("utf-8")
+            if length and expires_at > now:
+                index[token] = (body + token_length, length, expires_at, flags)
+            else:
+                index.pop(token, None)
+            offset = stop
+            records += 1
+        if offset < end:
+            log.warning(f"{self}: Dropping {end - offset} bytes of a torn write at the end of the log")
+            self._map.close()
+            os.truncate(self.path, offset)
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.index, self.records = index, records
+        if self.verbose: log.debug(
+            f"{self}: Indexed {len(index)} live sessions from {records} records in "
+            f"{(time.perf_counter() - start) * 1000:.1f}ms")
+        return [(entry[2], token) for token, entry in index.items()]
+
+    def read(self, token: str) -> Any | None:
+        """Decode and forget one indexed session; callers serialize this against `compact` with their own lock"""
+        entry = self.index.pop(token, None)
+        if entry is None: return None
+        offset, length, expires_at, flags = entry
+        if expires_at <= time.time(): return None
+        try:
+            payload = self._map[offset:offset + length]
+            return self.codec.decode(zlib.decompress(payload) if flags & COMPRESSED else payload)
+        except Exception as e:
+            log.warning(f"{self}: Could not restore session {token[:8]}...: {e}")
+            return None
+
+    def append(self, changes: dict[str, Any | None]) -> None:
+        """Append the latest state of each changed token, writing a tombstone for tokens mapped to None"""
+        if not changes: return
+        now = time.time()
+        out = bytearray()
+        for token, session in changes.items():
+            if session is None or (session.expires_at is not None and session.expires_at <= now):
+                out += self.record(token, now, b"")
+            else:
+                out += self.record(token, session.expires_at, *self.payload(session))
+        with self._write_lock:
+            with open(self.path, "ab", opener=private_opener) as f:
+                f.write(out)
+                f.flush()
+                if self.fsync: os.fsync(f.fileno())
+            self.records += len(changes)
+        if self.verbose: log.debug(f"{self}: Appended {len(changes)} session records ({len(out)} bytes)")
+
+    def needs_compaction(self, live: int) -> bool:
+        return self.records > self.compact_ratio * live + 1024
+
+    def compact(self, sessions: Iterable[Any], lock: threading.RLock) -> None:
+        """Rewrite the log as one record per live session, carrying unrestored records over byte for byte"""
+        start = time.perf_counter()
+        now = time.time()
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with self._write_lock:
+            with lock:
+                unrestored = dict(self.index)
+            new_index, records = {}, 0
+            tmp.unlink(missing_ok=True)  # a leftover from a crash may have a looser mode that os.replace would carry over
+            with open(tmp, "wb", opener=private_opener) as f:
+                f.write(MAGIC)
+                position = len(MAGIC)
+                for session in sessions:
+                    if session.expires_at is not None and session.expires_at <= now: continue
+                    record = self.record(session.token, session.expires_at, *self.payload(session))
+                    f.write(record)
+                    position += len(record)
+                    records += 1
+                for token, (offset, length, expires_at, flags) in unrestored.items():
+                    if expires_at <= now: continue
+                    record = self.record(token, expires_at, self._map[offset:offset + length], flags)
+                    f.write(record)
+                    new_index[token] = (position + len(record) - length, length, expires_at, flags)
+                    position += len(record)
+                    records += 1
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            with open(self.path, "rb") as f:
+                new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with lock:
+                old, self._map = self._map, new_map
+                self.index = {token: new_index[token] for token in self.index if token in new_index}
+                old.close()
+            self.records = records
+        if self.verbose: log.debug(
+            f"{self}: Compacted log to {records} records in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -0,0 +1,324 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import dataclass, fields
+from typing import Any, Iterator
+
+from loguru import logger as log
+
+from . import DEBUG
+from .metrics import estimate_size
+
+# rough per-entry cost of the OrderedDict slot and expiry heap tuple around each stored session
+ENTRY_OVERHEAD = 160
+
+
+@dataclass
+class StoreStats:
+    hits: int = 0
+    misses: int = 0
+    inserts: int = 0
+    expired: int = 0
+    evicted: int = 0
+    swept: int = 0
+
+    @property
+    def evictions(self) -> int:
+        return self.expired + self.evicted + self.swept
+
+    @property
+    def ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def to_dict(self) -> dict:
+        return {**{f.name: getattr(self, f.name) for f in fields(self)}, "hit_ratio": self.ratio}
+
+
+class SessionBackend(MutableMapping):
+    """Mapping of session tokens to sessions that `Sessions` reads from and writes back to"""
+    blocking = False  # whether calls wait on network or disk I/O, and so must stay off the event loop
+    shared = False  # whether other workers see the same sessions, so per-login state has to live here too
+
+    def __init__(self, sweep_interval: float | None = 60.0, verbose: bool = DEBUG):
+        self.sweep_interval = sweep_interval
+        self.verbose = verbose
+        self.stats = StoreStats()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sweeper: threading.Thread | None = None
+
+    def save(self, session: Any) -> None:
+        self[session.token] = session
+
+    def set_many(self, sessions: list[Any]) -> None:
+        for session in sessions: self.save(session)
+
+    def stash(self, key: str, data: bytes, ttl: float) -> None:
+        """Keep a small record for `ttl` seconds where every worker can claim it; shared backends only"""
+        raise NotImplementedError
+
+    def claim(self, key: str) -> bytes | None:
+        """Take a stashed record exactly once, or None if it is unknown, expired or already claimed"""
+        raise NotImplementedError
+
+    def sweep(self, now: float = None) -> int:
+        return 0
+
+    def flush(self) -> None:
+        return None
+
+    def census(self, now: float = None) -> dict:
+        """Live, authenticated and expired-but-not-yet-evicted counts, where the backend can tell cheaply"""
+        return {"live": len(self), "authenticated": None, "expired": None, "memory_bytes": None}
+
+    def close(self) -> None:
+        self.stop()
+
+    def start(self):
+        if self._sweeper is not None or self.sweep_interval is None: return
+
+        def run():
+            while not self._stop.wait(self.sweep_interval):
+                try:
+                    self.sweep()
+                    self.flush()
+                except Exception as e:
+                    log.error(f"{self}: Sweep failed: {e}")
+
+        with self._start_lock:
+            if self._sweeper is not None: return
+            self._sweeper = threading.Thread(target=run, name="toomanysessions-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def stop(self):
+        self.flush()
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join(timeout=self.sweep_interval)
+            self._sweeper = None
+        self._stop.clear()
+
+
+class SessionStore(SessionBackend):
+    """Size-bounded LRU mapping of session tokens to sessions, expiring entries by `expires_at`"""
+
+    def __init__(
+            self,
+            max_size: int = 100_000,
+            sweep_interval: float = 60.0,
+            snapshot: Any = None,
+            verbose: bool = DEBUG
+    ):
+        if max_size < 1: raise ValueError("max_size must be at least 1")
+        super().__init__(sweep_interval=sweep_interval, verbose=verbose)
+        self.max_size = max_size
+        self._data: OrderedDict[str, Any] = OrderedDict()
+        self._expiries: list[tuple[float, str]] = []
+        self._lock = threading.RLock()
+        # a `SnapshotLog` that the sweeper appends changed sessions to, and that misses are restored from
+        self.snapshot = snapshot
+        self._dirty: set[str] = set()
+        if snapshot is not None:
+            self._expiries = snapshot.open()
+            heapq.heapify(self._expiries)
+            self.start()
+
+    def __repr__(self):
+        return f"[TooManySessions.SessionStore.{len(self._data)}/{self.max_size}]"
+
+    def get(self, token: str, default: Any = None) -> Any:
+        with self._lock:
+            session = self._data.get(token)
+            if session is None and self.snapshot is not None and token in self.snapshot.index:
+                session = self._restore(token)
+            if session is None:
+                self.stats.misses += 1
+                return default
+            if session.is_expired:
+                del self._data[token]
+                self.stats.expired += 1
+                self.stats.misses += 1
+                return default
+            self._data.move_to_end(token)
+            self.stats.hits += 1
+            return session
+
+    def save(self, session: Any) -> None:
+        with self._lock:
+            if self._data.get(session.token) is session:
+                if self.snapshot is not None: self._dirty.add(session.token)
+                return
+        self[session.token] = session
+
+    def __getitem__(self, token: str) -> Any:
+        session = self.get(token)
+        if session is None: raise KeyError(token)
+        return session
+
+    def __setitem__(self, token: str, session: Any) -> None:
+        with self._lock:
+            self._insert(token, session)
+            self.stats.inserts += 1
+            if self.snapshot is not None:
+                self.snapshot.index.pop(token, None)
+                self._dirty.add(token)
+        self.start()
+
+    def _insert(self, token: str, session: Any) -> None:
+        self._data[token] = session
+        self._data.move_to_end(token)
+        if session.expires_at is not None:
+            heapq.heappush(self._expiries, (session.expires_at, token))
+        while len(self._data) > self.max_size:
+            evicted, _ = self._data.popitem(last=False)
+            self.stats.evicted += 1
+            if self.snapshot is not None: self._dirty.add(evicted)
+            if self.verbose: log.debug(f"{self}: Evicted least recently used session {evicted[:8]}...")
+        if len(self._expiries) > 2 * len(self) + 1024: self._compact()
+
+    def _restore(self, token: str) -> Any:
+        session = self.snapshot.read(token)
+        if session is None: return None
+        # re-run the full gate once, whitelists may have changed while we were down
+        session.admitted_until = 0.0
+        session.whitelisted = False
+        self._insert(token, session)
+        return session
+
+    def __delitem__(self, token: str) -> None:
+        with self._lock:
+            restorable = self.snapshot is not None and self.snapshot.index.pop(token, None) is not None
+            if self._data.pop(token, None) is None and not restorable: raise KeyError(token)
+            if self.snapshot is not None: self._dirty.add(token)
+
+    def __contains__(self, token: object) -> bool:
+        # a plain membership test, so it neither reorders the LRU nor counts as a lookup
+        with self._lock:
+            return token in self._data or (self.snapshot is not None and token in self.snapshot.index)
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            if self.snapshot is not None: return iter([*self._data, *self.snapshot.index])
+            return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data) + (len(self.snapshot) if self.snapshot is not None else 0)
+
+    def census(self, now: float = None, sample_size: int = 256) -> dict:
+        now = time.time() if now is None else now
+        with self._lock:
+            sessions = list(self._data.values())  # count outside the lock so scrapes don't stall requests
+        live = authenticated = expired = 0
+        for session in sessions:
+            if session.expires_at is not None and session.expires_at <= now:
+                expired += 1
+                continue
+            live += 1
+            if session.authenticated: authenticated += 1
+        step = max(1, len(sessions) // sample_size)
+        sample = sessions[::step][:sample_size]
+        per_session = sum(map(estimate_size, sample)) / len(sample) + ENTRY_OVERHEAD if sample else 0
+        if self.snapshot is not None: live += len(self.snapshot)  # indexed on disk, not yet restored
+        return {
+            "live": live,
+            "authenticated": authenticated,
+            "expired": expired,
+            "memory_bytes": int(per_session * len(sessions))
+        }
+
+    def _compact(self):
+        """Drop heap entries that no longer point at a live session"""
+        self._expiries = [
+            (expires_at, token) for token, session in self._data.items()
+            if (expires_at := session.expires_at) is not None
+        ]
+        if self.snapshot is not None:
+            self._expiries += [(entry[2], token) for token, entry in self.snapshot.index.items()]
+        heapq.heapify(self._expiries)
+
+    def sweep(self, now: float = None) -> int:
+        """Evict every session whose `expires_at` has passed, returning the number removed"""
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock:
+            while self._expiries and self._expiries[0][0] <= now:
+                expires_at, token = heapq.heappop(self._expiries)
+                session = self._data.get(token)
+                if session is None:
+                    entry = self.snapshot.index.get(token) if self.snapshot is not None else None
+                    if entry is not None and entry[2] == expires_at:
+                        del self.snapshot.index[token]
+                        removed += 1
+                    continue
+                if session.expires_at != expires_at: continue
+                del self._data[token]
+                removed += 1
+            self.stats.swept += removed
+        if removed and self.verbose: log.debug(f"{self}: Swept {removed} expired sessions")
+        return removed
+
+    def flush(self) -> None:
+        """Append every session changed since the last flush to the snapshot log, compacting it when it bloats"""
+        if self.snapshot is None: return
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            changes = {token: self._data.get(token) for token in dirty}
+        self.snapshot.append(changes)  # encoded outside the lock so requests aren't held up by serialization
+        if self.snapshot.needs_compaction(len(self)):
+            with self._lock:
+                sessions = list(self._data.values())
+            self.snapshot.compact(sessions, self._lock)
+
+    def close(self) -> None:
+        super().close()
+        if self.snapshot is not None: self.snapshot.close()
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire a fixed time after they are set"""
+
+    def __init__(self, ttl: float, max_size: int = 10_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = StoreStats()
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[TooManySessions.TTLCache.{len(self._data)}/{self.max_size}]"
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key is None: return default
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                self.stats.expired += 1
+                self.stats.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return entry[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        if key is None: return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            self.stats.inserts += 1
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.stats.evicted += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
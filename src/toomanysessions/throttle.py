@@ -0,0 +1,92 @@
+import ipaddress
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Iterable
+
+from starlette.requests import Request
+
+# password guesses are what a throttle is really for: five per session, then one every ten seconds
+PASSKEY_LIMITS = {"session_rate": 0.1, "session_burst": 5, "ip_rate": 0.5, "ip_burst": 20}
+
+
+class RateLimiter:
+    """Token buckets keyed by an arbitrary string, held in a size-bounded LRU"""
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets: OrderedDict[Any, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[TooManySessions.RateLimiter.{self.rate}/s.{self.burst}]"
+
+    def hit(self, key: Any, cost: float = 1.0) -> float:
+        """Spend tokens for a key, returning 0 if allowed or the seconds until it would be"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0.0
+            else:
+                retry_after = (cost - tokens) / self.rate
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys: self._buckets.popitem(last=False)
+        return retry_after
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class Throttle:
+    """Per-session and per-client-address rate limiting for the authentication paths"""
+
+    def __init__(
+            self,
+            session_rate: float = 0.2,
+            session_burst: int = 10,
+            ip_rate: float = 2.0,
+            ip_burst: int = 60,
+            max_keys: int = 100_000,
+            trusted_proxies: Iterable[str] = ()
+    ):
+        self.sessions = RateLimiter(session_rate, session_burst, max_keys)
+        self.clients = RateLimiter(ip_rate, ip_burst, max_keys)
+        # behind a load balancer every peer address is the balancer's, so the client is read from X-Forwarded-For
+        self.trusted_proxies = [ipaddress.ip_network(proxy, strict=False) for proxy in trusted_proxies]
+
+    def __repr__(self):
+        return "[TooManySessions.Throttle]"
+
+    def trusted(self, host: str) -> bool:
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted_proxies)
+
+    def client_address(self, request: Request) -> str | None:
+        """The peer address, or with trusted proxies the nearest X-Forwarded-For hop that isn't one of them"""
+        host = request.client.host if request.client is not None else None
+        if not self.trusted_proxies or host is None or not self.trusted(host): return host
+        forwarded = request.headers.get("x-forwarded-for")
+        if not forwarded: return host
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        # read from the right, as entries left of the first untrusted hop can be forged by the client
+        for hop in reversed(hops):
+            if not self.trusted(hop): return hop
+        return hops[0] if hops else host
+
+    def check(self, request: Request, token: str = None) -> int:
+        """Return 0 if the request may proceed, or the whole seconds to send back in Retry-After"""
+        retry_after = 0.0
+        if (client := self.client_address(request)) is not None: retry_after = self.clients.hit(client)
+        if token and not retry_after: retry_after = self.sessions.hit(token)
+        return math.ceil(retry_after)
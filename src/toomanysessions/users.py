@@ -1,19 +1,22 @@
 from dataclasses import dataclass
-from typing import Any, Type
+from typing import Any, Type, TYPE_CHECKING
 
 from fastapi import APIRouter
 from loguru import logger as log
-from pyzurecli import Organization, Me
 from starlette.responses import Response
 
 from . import DEBUG, Session
+from .logs import sampled
 
+if TYPE_CHECKING:
+    from pyzurecli import Organization, Me
 
-@dataclass
+
+@dataclass(slots=True)
 class User:
     session: Session
-    me: Any | Me = None
-    org: Any | Organization = None
+    me: "Any | Me" = None
+    org: "Any | Organization" = None
 
     @classmethod
     def create(cls, session):
@@ -43,11 +46,12 @@ class Users(APIRouter):
 
     def __getitem__(self, token: Any):
         if isinstance(token, str):
-            if self.verbose: log.debug(
-                f"{self}: Attempting to retrieve user object by session token:\n  - key={token}")
+            verbose = self.verbose and sampled()
+            if verbose: log.opt(lazy=True).debug(
+                "{}: Attempting to retrieve user object by session token:\n  - key={}", lambda: self, lambda: token[:8])
             cached = self.cache.get(token)
             if cached is None:
-                if self.verbose: log.warning(f"{self}: Could not get user! Attempting to create...")
+                if verbose: log.warning(f"{self}: Could not get user! Attempting to create...")
                 try:
                     self.cache[token] = self.user_setup(token)
                 except Exception as e:
@@ -55,7 +59,7 @@ class Users(APIRouter):
                     return Response(content="Login Failed!", status_code=401)
                 cached = self.cache[token]
             if cached is None: raise RuntimeError
-            if self.verbose: log.success(f"{self}: Successfully located:\nsession={cached}!")
+            if verbose: log.opt(lazy=True).success("{}: Successfully located user for {}...", lambda: self, lambda: token[:8])
             return cached
         else:
             raise TypeError(f"Expected token, got {type(token)}")
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+from loguru import logger as log
+
+from . import DEBUG
+
+
+def admission_epoch(generation: int, *whitelists: 'Whitelist | None') -> int:
+    """Fingerprint of a set of whitelists and a manual generation counter, never 0"""
+    digest = hashlib.blake2b(generation.to_bytes(8, "big"), digest_size=6)
+    for whitelist in whitelists:
+        digest.update(b"-" if whitelist is None else whitelist.digest)
+    # sessions restored or decoded with the old default of 0 can then never pass as admitted
+    return int.from_bytes(digest.digest(), "big") or 1
+
+
+class Whitelist:
+    """Case-folded, hash-indexed set of allowed identities, optionally loaded from a file that is watched for changes"""
+
+    def __init__(
+            self,
+            entries: Iterable[str] = (),
+            path: Path | str = None,
+            interval: float = 5.0,
+            on_change: Callable[[], Any] = None,
+            verbose: bool = DEBUG
+    ):
+        self.static = frozenset(self.normalize(entry) for entry in entries if entry)
+        self.path = Path(path) if path is not None else None
+        self.interval = interval
+        self.on_change = on_change
+        self.verbose = verbose
+        self.entries: frozenset[str] = self.static
+        self._stamp: tuple[int, int] | None = None
+        self._digest: tuple[frozenset[str], bytes] | None = None
+        self._stop = threading.Event()
+        self._watcher: threading.Thread | None = None
+        if self.path is not None:
+            self.load()
+            self.start()
+
+    def __repr__(self):
+        return f"[TooManySessions.Whitelist.{self.path.name if self.path else 'static'}.{len(self.entries)}]"
+
+    @staticmethod
+    def normalize(value: str) -> str:
+        return value.strip().casefold()
+
+    @classmethod
+    def coerce(cls, value: Any, on_change: Callable[[], Any] = None, verbose: bool = DEBUG) -> 'Whitelist | None':
+        """Build a whitelist from None, an existing Whitelist, a file path or an iterable of entries"""
+        if value is None: return None
+        if isinstance(value, Whitelist):
+            if value.on_change is None: value.on_change = on_change
+            return value
+        if isinstance(value, (str, Path)): return cls(path=value, on_change=on_change, verbose=verbose)
+        return cls(value, on_change=on_change, verbose=verbose)
+
+    def __contains__(self, value: object) -> bool:
+        return isinstance(value, str) and self.normalize(value) in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    @property
+    def digest(self) -> bytes:
+        """Fingerprint of the current entries, the same in every process that loaded the same list"""
+        entries, cached = self.entries, self._digest
+        if cached is None or cached[0] is not entries:
+            cached = self._digest = (entries, hashlib.blake2b("\n".join(sorted(entries)).encode(), digest_size=16).digest())
+        return cached[1]
+
+    def extend(self, entries: Iterable[str]) -> None:
+        """Permanently add entries that survive every reload of the file"""
+        self.static = self.static | {self.normalize(entry) for entry in entries if entry}
+        self.entries = self.entries | self.static
+
+    def stat(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self) -> bool:
+        """Reread the file and swap in the new set, returning whether its contents changed"""
+        self._stamp = self.stat()
+        if self._stamp is None:
+            log.warning(f"{self}: Whitelist file {self.path} does not exist, allowing only the static entries")
+            entries = self.static
+        else:
+            with open(self.path, encoding="utf-8") as f:
+                lines = (line.split("#", 1)[0] for line in f)
+                entries = self.static | {self.normalize(line) for line in lines if line.strip()}
+        changed = entries != self.entries
+        self.entries = entries  # a single reference swap, so readers never see a half-built set
+        if changed and self.verbose: log.debug(f"{self}: Loaded {len(entries)} entries from {self.path}")
+        return changed
+
+    def start(self):
+        if self._watcher is not None or self.path is None: return
+
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    if self.stat() != self._stamp and self.load() and self.on_change is not None:
+                        self.on_change()
+                except Exception as e:
+                    log.error(f"{self}: Reload failed: {e}")
+
+        self._watcher = threading.Thread(target=run, name="toomanysessions-whitelist", daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=self.interval)
+            self._watcher = None
+        self._stop.clear()
@@ -0,0 +1,176 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs
+
+import pytest
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class StandIn:
+    """Local HTTP/1.1 keep-alive server standing in for the identity provider and Graph in tests
+
+    `routes` maps "METHOD /path" to a callable taking the request (method, path, query, body) and returning
+    (status, json body), with an optional per-route delay to simulate a slow upstream.
+    """
+
+    def __init__(self):
+        self.routes: dict[str, Callable] = {}
+        self.delays: dict[str, float] = {}
+        self.requests: list[tuple[str, str]] = []
+        self.connections: set[tuple[str, int]] = set()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # headers and body go out in separate writes, which Nagle would hold back for a delayed ACK
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def handle_one(self, method: str):
+                path, _, query = self.path.partition("?")
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                key = f"{method} {path}"
+                stand_in.requests.append((method, path))
+                stand_in.connections.add(self.client_address)
+                if delay := stand_in.delays.get(key): time.sleep(delay)
+                route = stand_in.routes.get(key)
+                status, data = route(method, path, parse_qs(query), body) if route else (404, {"error": "not_found"})
+                out = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def do_GET(self):
+                self.handle_one("GET")
+
+            def do_POST(self):
+                self.handle_one("POST")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def route(self, key: str, delay: float = 0.0):
+        def register(func):
+            self.routes[key] = func
+            if delay: self.delays[key] = delay
+            return func
+
+        return register
+
+    def count(self, method: str, path: str) -> int:
+        return self.requests.count((method, path))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    server = StandIn().start()
+    yield server
+    server.stop()
+
+
+class RedisStandIn:
+    """Minimal in-memory RESP2 server with the commands the Redis backend sends, and injectable error replies"""
+
+    def __init__(self):
+        self.data: dict[bytes, tuple[bytes, float | None]] = {}
+        self.fail_keys: set[bytes] = set()  # SET on these keys gets an error reply
+        self.connections = 0
+        self._sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    @staticmethod
+    def encode(value) -> bytes:
+        if value is None: return b"$-1\r\n"
+        if isinstance(value, Exception): return b"-ERR %s\r\n" % str(value).encode()
+        if isinstance(value, int): return b":%d\r\n" % value
+        if isinstance(value, str): return b"+%s\r\n" % value.encode()
+        if isinstance(value, list): return b"*%d\r\n" % len(value) + b"".join(map(RedisStandIn.encode, value))
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def live(self, key: bytes) -> bytes | None:
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            return None
+        return value
+
+    def run(self, args: list[bytes]):
+        command = args[0].upper()
+        if command == b"SET":
+            if args[1] in self.fail_keys: return RuntimeError("injected failure")
+            ttl = float(args[4]) / 1000 if len(args) > 4 and args[3].upper() == b"PX" else None
+            self.data[args[1]] = (args[2], time.time() + ttl if ttl else None)
+            return "OK"
+        if command == b"GET": return self.live(args[1])
+        if command == b"DEL": return int(self.data.pop(args[1], None) is not None)
+        if command == b"EXISTS": return int(self.live(args[1]) is not None)
+        if command == b"SELECT": return "OK"
+        if command == b"SCAN":
+            prefix = args[3].rstrip(b"*")
+            return [b"0", [key for key in list(self.data) if key.startswith(prefix) and self.live(key) is not None]]
+        return RuntimeError(f"unknown command {command!r}")
+
+    def handle(self, conn: socket.socket):
+        self.connections += 1
+        reader, queued = conn.makefile("rb"), None
+        with conn:
+            while line := reader.readline():
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int(reader.readline()[1:])
+                    args.append(reader.read(length + 2)[:-2])
+                if args[0].upper() == b"MULTI":
+                    queued, reply = [], "OK"
+                elif args[0].upper() == b"EXEC":
+                    queued, reply = None, [self.run(command) for command in queued]
+                elif queued is not None:
+                    queued.append(args)
+                    reply = "QUEUED"
+                else:
+                    reply = self.run(args)
+                conn.sendall(self.encode(reply))
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self._sock.close()
+
+
+@pytest.fixture
+def redis_stand_in():
+    server = RedisStandIn()
+    yield server
+    server.close()
@@ -0,0 +1,215 @@
+import dataclasses
+import time
+from types import SimpleNamespace
+
+import anyio
+import pytest
+from starlette.requests import Request
+from starlette.responses import HTMLResponse
+
+from toomanysessions.metrics import Metrics
+from toomanysessions.session import Session
+from toomanysessions.sessions import Sessions
+from toomanysessions.singleflight import SingleFlight
+from toomanysessions.throttle import Throttle
+from toomanysessions.users import User
+from toomanysessions.whitelist import Whitelist
+
+core = pytest.importorskip("toomanysessions.core")  # needs the fastj2/toomanythreads server stack
+SessionedServer = core.SessionedServer
+
+
+class Server:
+    """The state SessionedServer's gate reads, around its real admit, establish and hydrate methods"""
+    admit = SessionedServer.admit
+    ensure_user = SessionedServer.ensure_user
+    hydrate = SessionedServer.hydrate
+    admission_digest = SessionedServer.admission_digest
+    rekey_admissions = SessionedServer.rekey_admissions
+    invalidate_admissions = SessionedServer.invalidate_admissions
+    identity = staticmethod(SessionedServer.identity)
+    display_name = staticmethod(SessionedServer.display_name)
+
+    verbose = False
+    is_msft, is_noauth, is_passkey = True, False, False
+    eager_hydration = False
+    refresher = None
+
+    def __init__(self, users: list[str] = None, tenants: list[str] = None, profile_delay: float = 0.0):
+        self.sessions = Sessions(sweep_interval=None, verbose=False)
+        self.metrics = Metrics()
+        self.throttle = Throttle()
+        self.flights = SingleFlight()
+        self.user_model = CountingUser
+        self.users = SimpleNamespace(user_model=CountingUser)
+        self.authentication_model = SimpleNamespace(welcome=self.welcome)
+        self.admission_generation = 0
+        self.user_whitelist = Whitelist.coerce(users, self.rekey_admissions, verbose=False)
+        self.tenant_whitelist = Whitelist.coerce(tenants, self.rekey_admissions, verbose=False)
+        self.admission_epoch = self.admission_digest()
+        self.profile_delay = profile_delay
+        self.profile_error: Exception | None = None
+        self.gate_runs = self.whitelist_checks = self.welcomes = self.profiles = 0
+        CountingUser.created = 0
+
+    def __repr__(self):
+        return "[Test.SessionedServer]"
+
+    async def establish(self, session: Session):
+        self.gate_runs += 1
+        return await SessionedServer.establish(self, session)
+
+    def is_whitelisted(self, session: Session) -> bool:
+        self.whitelist_checks += 1
+        return SessionedServer.is_whitelisted(self, session)
+
+    def welcome(self, name: str):
+        self.welcomes += 1
+        return HTMLResponse(f"Welcome, {name}!")
+
+    def popup_unauthorized(self, message: str):
+        return HTMLResponse(message, status_code=401)
+
+    async def fetch_profile(self, access_token: str, claims: dict = None):
+        self.profiles += 1
+        await anyio.sleep(self.profile_delay)
+        if self.profile_error is not None: raise self.profile_error
+        return SimpleNamespace(displayName="User", userPrincipalName=claims["upn"]), SimpleNamespace(id=claims["tid"])
+
+
+class CountingUser(User):
+    __slots__ = ()
+    created = 0
+
+    @classmethod
+    def create(cls, session):
+        cls.created += 1
+        return super().create(session)
+
+
+def signed_in(server: Server, token: str = "tok", upn: str = "alice@example.com", welcomed: bool = True) -> Session:
+    session = server.sessions[token]
+    session.authenticated, session.welcomed = True, welcomed
+    session.claims = {"tid": "tenant-id", "upn": upn, "name": "Alice"}
+    session.oauth_token_data = SimpleNamespace(access_token="access")
+    return server.sessions.commit(session)
+
+
+def request() -> Request:
+    return Request({"type": "http", "client": ("127.0.0.1", 50000), "headers": []})
+
+
+@pytest.mark.anyio
+async def test_admitted_sessions_skip_the_gate():
+    server = Server(users=["alice@example.com"])
+    session = signed_in(server)
+    assert await server.admit(request(), session) is None
+    assert (server.gate_runs, server.whitelist_checks) == (1, 1)
+    assert session.is_admitted(server.admission_epoch)
+    for _ in range(10): assert await server.admit(request(), session) is None
+    assert (server.gate_runs, server.whitelist_checks) == (1, 1)
+
+
+@pytest.mark.anyio
+async def test_lapsed_admission_goes_back_through_the_gate():
+    server = Server(users=["alice@example.com"])
+    session = signed_in(server)
+    await server.admit(request(), session)
+    session.admitted_until = time.time() - 1
+    assert not session.is_admitted(server.admission_epoch)
+    assert await server.admit(request(), session) is None
+    assert server.gate_runs == 2
+    assert server.whitelist_checks == 1  # the lists didn't change, so the earlier verdict stands
+    assert session.is_admitted(server.admission_epoch)
+
+
+@pytest.mark.anyio
+async def test_whitelist_edit_revokes_admission(tmp_path):
+    path = tmp_path / "users.txt"
+    path.write_text("alice@example.com\nbob@example.com\n")
+    server = Server(users=path)
+    server.user_whitelist.stop()
+    alice, bob = signed_in(server, "alice"), signed_in(server, "bob", upn="bob@example.com")
+    assert await server.admit(request(), alice) is None and await server.admit(request(), bob) is None
+    epoch = server.admission_epoch
+
+    path.write_text("alice@example.com\n")
+    assert server.user_whitelist.load()
+    server.user_whitelist.on_change()  # what the file watcher does after a reload
+    assert server.admission_epoch != epoch
+    assert not alice.is_admitted(server.admission_epoch) and not bob.is_admitted(server.admission_epoch)
+
+    assert await server.admit(request(), alice) is None
+    response = await server.admit(request(), bob)
+    assert response.status_code == 401 and not bob.whitelisted
+    assert server.whitelist_checks == 4
+    assert not bob.is_admitted(server.admission_epoch)
+    assert (await server.admit(request(), bob)).status_code == 401  # and it stays out
+
+
+@pytest.mark.anyio
+async def test_invalidating_admissions_rechecks_everyone():
+    server = Server(users=["alice@example.com"])
+    session = signed_in(server)
+    await server.admit(request(), session)
+    server.invalidate_admissions()
+    assert not session.is_admitted(server.admission_epoch)
+    await server.admit(request(), session)
+    assert (server.gate_runs, server.whitelist_checks) == (2, 2)
+
+
+FIRST_REQUESTS = 10
+
+
+async def first_requests(server: Server, session: Session) -> list:
+    """Parallel first requests carrying one cookie, each with its own copy of the session as a remote backend gives"""
+    results = []
+
+    async def one():
+        copy = dataclasses.replace(session)
+        try:
+            results.append((await server.admit(request(), copy), copy))
+        except Exception as e:
+            results.append((e, copy))
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(FIRST_REQUESTS): tg.start_soon(one)
+    return results
+
+
+@pytest.mark.anyio
+async def test_parallel_first_requests_share_one_hydration_check_and_welcome():
+    server = Server(users=["alice@example.com"], profile_delay=0.05)
+    server.eager_hydration = True
+    results = await first_requests(server, signed_in(server, welcomed=False))
+    assert (CountingUser.created, server.profiles, server.whitelist_checks, server.welcomes) == (1, 1, 1, 1)
+    responses = [response for response, _ in results if response is not None]
+    assert len(responses) == 1 and responses[0].body == b"Welcome, User!"
+    for _, session in results:
+        assert session.user is not None and session.whitelisted and session.welcomed
+    assert len(server.flights) == 0
+
+
+@pytest.mark.anyio
+async def test_parallel_first_requests_are_all_denied_together():
+    server = Server(users=["bob@example.com"], profile_delay=0.05)
+    server.eager_hydration = True
+    results = await first_requests(server, signed_in(server, welcomed=False))
+    assert server.whitelist_checks == 1 and server.welcomes == 0
+    assert [response.status_code for response, _ in results] == [401] * FIRST_REQUESTS
+
+
+@pytest.mark.anyio
+async def test_a_failed_hydration_reaches_every_request_and_is_retried():
+    server = Server(users=["alice@example.com"], profile_delay=0.05)
+    server.eager_hydration = True
+    server.profile_error = PermissionError("Graph request 'me' failed")
+    session = signed_in(server, welcomed=False)
+    results = await first_requests(server, session)
+    assert server.profiles == 1
+    assert all(isinstance(error, PermissionError) for error, _ in results)
+    assert len(server.flights) == 0  # nothing stuck for the next request to wait on
+
+    server.profile_error = None
+    assert (await server.admit(request(), session)).body == b"Welcome, User!"
+    assert server.profiles == 2
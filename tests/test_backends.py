@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+import anyio
+import pytest
+
+from toomanysessions.backends import RedisBackend, RedisError, SessionCodec, SQLiteBackend
+from toomanysessions.session import Session
+from toomanysessions.sessions import Sessions
+
+
+@pytest.fixture
+def db(tmp_path):
+    return tmp_path / "sessions.db"
+
+
+def signed_in(token: str) -> Session:
+    session = Session.create(token)
+    session.authenticated = True
+    session.claims = {"oid": "object-id"}
+    return session
+
+
+def test_sqlite_is_shared_between_workers(db):
+    a, b = SQLiteBackend(db, verbose=False), SQLiteBackend(db, verbose=False)
+    a["tok"] = signed_in("tok")
+    assert "tok" in b
+    assert b.get("tok").authenticated and b.get("tok").claims == {"oid": "object-id"}
+    del b["tok"]
+    assert "tok" not in a and a.get("tok") is None
+    a.close(), b.close()
+
+
+def test_sqlite_buffered_writes(db):
+    a, b = SQLiteBackend(db, flush_interval=60.0, verbose=False), SQLiteBackend(db, verbose=False)
+    a["tok"] = signed_in("tok")
+    assert "tok" in a and "tok" not in b  # visible to its own worker straight away, to others after a flush
+    a.flush()
+    assert "tok" in b
+    a.close(), b.close()
+
+
+def test_sqlite_expiry_and_sweep(db):
+    backend = SQLiteBackend(db, verbose=False)
+    backend["live"] = Session.create("live")
+    backend["stale"] = Session.create("stale", max_age=1)
+    later = time.time() + 2
+    assert backend.sweep(now=later) == 1
+    assert "live" in backend and backend.census()["expired"] == 0
+    backend.close()
+
+
+@pytest.mark.skipif(os.name != "posix", reason="file modes are POSIX only")
+def test_sqlite_files_are_owner_only(db):
+    old = os.umask(0o022)
+    try:
+        backend = SQLiteBackend(db, verbose=False)
+        backend["tok"] = Session.create("tok")
+        backend.close()
+    finally:
+        os.umask(old)
+    assert stat.S_IMODE(db.stat().st_mode) == 0o600
+
+
+def test_redis_round_trip(redis_stand_in):
+    backend = RedisBackend(port=redis_stand_in.port, verbose=False)
+    backend.set_many([signed_in("a"), signed_in("b")])
+    assert "a" in backend and "missing" not in backend
+    assert backend.get("b").claims == {"oid": "object-id"}
+    assert sorted(backend) == ["a", "b"]
+    del backend["a"]
+    assert backend.get("a") is None
+    backend.close()
+
+
+def test_redis_error_in_the_middle_of_a_pipeline(redis_stand_in):
+    backend = RedisBackend(port=redis_stand_in.port, verbose=False)
+    backend["before"] = signed_in("before")
+    redis_stand_in.fail_keys.add(b"toomanysessions:b")
+    with pytest.raises(RedisError, match="injected failure"):
+        backend.set_many([signed_in("a"), signed_in("b"), signed_in("c")])
+    # the replies after the error were drained, so the next command reads its own reply
+    assert backend.get("before").token == "before"
+    assert backend.get("c").token == "c"
+    assert redis_stand_in.connections == 2  # the connection is dropped after an error reply
+    backend.close()
+
+
+def test_records_from_older_releases_still_load():
+    session = SessionCodec().load({"token": "tok", "expires_at": time.time() + 60, "throttle": 3, "request": None})
+    assert session.token == "tok"
+
+
+def test_sessions_use_an_empty_backend(db):
+    backend = SQLiteBackend(db, verbose=False)
+    assert Sessions(backend=backend, verbose=False).cache is backend
+    backend.close()
+
+
+@pytest.mark.anyio
+async def test_blocking_backend_stays_off_the_event_loop(db):
+    sessions = Sessions(backend=SQLiteBackend(db, verbose=False), verbose=False)
+    holder = sqlite3.connect(db, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")  # another worker holds the write lock
+    threading.Timer(0.3, holder.execute, args=("COMMIT",)).start()
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await anyio.sleep(0.01)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(tick)
+        session = await sessions.resolve("new-token")
+        tg.cancel_scope.cancel()
+    assert session.token == "new-token"
+    assert ticks >= 10
+    holder.close()
+    sessions.cache.close()
@@ -0,0 +1,71 @@
+import time
+
+import httpx
+import pytest
+
+from toomanysessions.clients import HTTPPool
+from toomanysessions.session import Session
+from toomanysessions.sessions import authenticate
+
+EXCHANGES = 50
+
+
+@pytest.fixture
+def token_endpoint(stand_in):
+    @stand_in.route("POST /token")
+    def token(*_):
+        return 200, {"token_type": "Bearer", "access_token": "access", "expires_in": 3600, "ext_expires_in": 3600}
+
+    return stand_in
+
+
+@pytest.mark.anyio
+async def test_pooled_token_exchange(token_endpoint, record_property):
+    url = token_endpoint.url + "/token"
+    data = {"grant_type": "authorization_code", "code": "code"}
+
+    start = time.perf_counter()
+    for _ in range(EXCHANGES):
+        async with httpx.AsyncClient() as client:  # what every login used to do
+            assert (await client.post(url, data=data)).status_code == 200
+    fresh = (time.perf_counter() - start) / EXCHANGES
+    fresh_connections = len(token_endpoint.connections)
+
+    token_endpoint.connections.clear()
+    pool = HTTPPool(verbose=False)
+    await pool.open()
+    start = time.perf_counter()
+    for _ in range(EXCHANGES):
+        assert (await pool.client.post(url, data=data)).status_code == 200
+    pooled = (time.perf_counter() - start) / EXCHANGES
+    await pool.aclose()
+
+    record_property("fresh_ms", round(fresh * 1000, 2))
+    record_property("pooled_ms", round(pooled * 1000, 2))
+    print(f"\nfresh client {fresh * 1000:.2f}ms, pooled {pooled * 1000:.2f}ms per token exchange")
+    assert fresh_connections == EXCHANGES
+    assert len(token_endpoint.connections) == 1
+    # without TLS the handshake saved is only TCP's, so only require the pool not to be slower
+    assert pooled < fresh * 1.2
+
+
+@pytest.mark.anyio
+async def test_authenticate_reuses_the_pool(stand_in):
+    stand_in.route("GET /auth")(lambda *_: (200, {}))
+    pool = HTTPPool(verbose=False)
+    for _ in range(3):
+        session = await authenticate(Session.create("tok"), "session", stand_in.url + "/auth", client=pool.client)
+        assert session.token == "tok"
+    assert stand_in.count("GET", "/auth") == 3
+    assert len(stand_in.connections) == 1
+    await pool.aclose()
+
+
+@pytest.mark.anyio
+async def test_pool_reopens_after_close():
+    pool = HTTPPool(max_connections=7, verbose=False)
+    first = pool.client
+    assert pool.client is first
+    await pool.aclose()
+    assert first.is_closed and pool.client is not first
+    await pool.aclose()
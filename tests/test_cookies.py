@@ -0,0 +1,131 @@
+import time
+
+import pytest
+
+from toomanysessions.cookies import CookieCodec, StatelessSessions, b64decode, b64encode
+from toomanysessions.session import Session
+
+OLD, NEW = "old-cookie-key", "new-cookie-key"
+
+
+@pytest.fixture(params=[False, True], ids=["signed", "encrypted"])
+def encrypt(request):
+    if request.param: pytest.importorskip("cryptography")
+    return request.param
+
+
+def signed_in(token: str = "tok") -> Session:
+    session = Session.create(token)
+    session.authenticated = True
+    session.whitelisted = True
+    session.admission_epoch = 12345
+    session.claims = {"oid": "object-id", "tid": "tenant-id", "upn": "user@example.com", "name": "User"}
+    return session
+
+
+def test_round_trip(encrypt):
+    codec = CookieCodec([NEW], encrypt=encrypt)
+    session = codec.decode(codec.encode(signed_in()))
+    assert session.token == "tok"
+    assert session.authenticated and session.whitelisted and not session.welcomed
+    assert session.admission_epoch == 12345
+    assert session.claims["upn"] == "user@example.com"
+
+
+def test_encrypted_cookie_hides_its_fields():
+    pytest.importorskip("cryptography")
+    value = CookieCodec([NEW], encrypt=True).encode(signed_in())
+    assert b"user@example.com" not in b64decode(value.split(".")[2])
+    assert CookieCodec([NEW]).decode(value) is None  # a signing-only server refuses encrypted cookies
+
+
+def test_tampered_cookie_is_rejected(encrypt):
+    codec = CookieCodec([NEW], encrypt=encrypt)
+    fmt, kid, body, mac = codec.encode(signed_in()).split(".")
+    raw = bytearray(b64decode(body))
+    raw[-1] ^= 1
+    assert codec.decode(".".join([fmt, kid, b64encode(bytes(raw)), mac])) is None
+    assert codec.decode(".".join([fmt, kid, body, mac[:-2]])) is None
+    assert codec.decode("garbage") is None
+
+
+def test_cookie_signed_with_an_unknown_key_is_rejected(encrypt):
+    forged = CookieCodec(["attacker-key"], encrypt=encrypt).encode(signed_in())
+    assert CookieCodec([NEW], encrypt=encrypt).decode(forged) is None
+
+
+def test_key_rotation(encrypt):
+    old_cookie = CookieCodec([OLD], encrypt=encrypt).encode(signed_in())
+    rotated = CookieCodec([NEW, OLD], encrypt=encrypt)
+    # cookies from before the rotation stay valid, new ones are signed with the first key
+    assert rotated.decode(old_cookie).token == "tok"
+    new_cookie = rotated.encode(signed_in())
+    assert new_cookie.split(".")[1] == CookieCodec.key_id(NEW.encode())
+    # once the old key is retired its cookies stop working
+    assert CookieCodec([NEW], encrypt=encrypt).decode(old_cookie) is None
+    assert CookieCodec([NEW], encrypt=encrypt).decode(new_cookie).token == "tok"
+
+
+def test_expired_cookie_is_rejected(encrypt):
+    codec = CookieCodec([NEW], encrypt=encrypt)
+    session = signed_in()
+    session.expires_at = time.time() - 1
+    assert codec.decode(codec.encode(session)) is None
+
+
+def test_size_bound():
+    codec = CookieCodec([NEW], max_size=200)
+    session = signed_in()
+    session.verifier = "v" * 300
+    with pytest.raises(ValueError, match="byte limit"):
+        codec.encode(session)
+    assert codec.decode("j.kid." + "a" * 300 + ".mac") is None
+
+
+def test_oversized_claims_are_truncated():
+    codec = CookieCodec([NEW])
+    session = signed_in()
+    session.claims["name"] = "n" * 10_000
+    assert len(codec.decode(codec.encode(session)).claims["name"]) == 128
+
+
+@pytest.mark.anyio
+async def test_unchanged_cookie_is_not_reissued(encrypt):
+    sessions = StatelessSessions(keys=[NEW], encrypt=encrypt, verbose=False)
+    cookie = sessions.codec.encode(signed_in())
+    session, state = await sessions.for_cookie(cookie)
+    assert not sessions.changed(session, state)
+    session.welcomed = True
+    assert sessions.changed(session, state)
+
+
+@pytest.mark.anyio
+async def test_cookie_under_a_retired_key_is_reissued(encrypt):
+    old_cookie = CookieCodec([OLD], encrypt=encrypt).encode(signed_in())
+    sessions = StatelessSessions(keys=[NEW, OLD], encrypt=encrypt, verbose=False)
+    session, state = await sessions.for_cookie(old_cookie)
+    assert session.token == "tok" and session.authenticated
+    assert sessions.changed(session, state)  # nothing else changed, the cookie is re-signed with the new key
+    reissued = sessions.cookie_value(session)
+    assert sessions.codec.is_primary(reissued) and not sessions.codec.is_primary(old_cookie)
+    session, state = await sessions.for_cookie(reissued)
+    assert not sessions.changed(session, state)
+
+
+@pytest.mark.anyio
+async def test_missing_or_invalid_cookie_issues_a_session():
+    sessions = StatelessSessions(keys=[NEW], verbose=False)
+    session, state = await sessions.for_cookie("garbage")
+    assert state is None and not session.authenticated
+    assert sessions.changed(session, state)
+    assert sessions.stats.created == 1
+
+
+def test_callback_state_must_match_the_cookie():
+    sessions = StatelessSessions(keys=[NEW], verbose=False)
+    session = Session.create("tok")
+    state = sessions.authorization_state(session, "verifier")
+    cookie = sessions.codec.encode(session)
+    assert sessions.for_state(state, cookie).verifier == "verifier"
+    assert sessions.for_state(state, sessions.codec.encode(Session.create("other"))) is None
+    assert sessions.for_state(state, None) is None
@@ -0,0 +1,116 @@
+import json
+import time
+
+import anyio
+import pytest
+
+from toomanysessions.clients import HTTPPool
+from toomanysessions.graph import GraphClient
+
+PROFILE_DELAY = 0.3
+ME = {"id": "object-id", "userPrincipalName": "user@example.com", "displayName": "User"}
+ORG = {"id": "tenant-id", "displayName": "Example"}
+
+
+@pytest.fixture
+def graph_stand_in(stand_in):
+    """Stand-in Graph answering $batch after PROFILE_DELAY, like a slow profile fetch"""
+
+    @stand_in.route("POST /$batch", delay=PROFILE_DELAY)
+    def batch(method, path, query, body):
+        bodies = {"/me": ME, "/organization": {"value": [ORG]}}
+        requests = json.loads(body)["requests"]
+        return 200, {"responses": [{"id": r["id"], "status": 200, "body": bodies[r["url"]]} for r in requests]}
+
+    return stand_in
+
+
+@pytest.fixture
+async def graph(graph_stand_in):
+    pool = HTTPPool(verbose=False)
+    yield GraphClient(base_url=graph_stand_in.url, pool=pool, verbose=False)
+    await pool.aclose()
+
+
+PROFILE_REQUESTS = [{"id": "me", "method": "GET", "url": "/me"}, {"id": "org", "method": "GET", "url": "/organization"}]
+
+
+@pytest.mark.anyio
+async def test_other_requests_keep_flowing_during_profile_fetches(graph):
+    ticks = 0
+
+    async def other_requests():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await anyio.sleep(0.01)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(other_requests)
+        await graph.batch("access-token", PROFILE_REQUESTS)
+        tg.cancel_scope.cancel()
+    # a blocking fetch would have frozen the loop for the whole delay and left only a tick or two
+    assert ticks >= PROFILE_DELAY / 0.01 / 2
+
+
+@pytest.mark.anyio
+async def test_concurrent_profile_fetches_overlap(graph):
+    start = time.perf_counter()
+    async with anyio.create_task_group() as tg:
+        for _ in range(5): tg.start_soon(graph.batch, "access-token", PROFILE_REQUESTS)
+    elapsed = time.perf_counter() - start
+    # five logins hydrate in about one fetch's time, not five
+    assert elapsed < PROFILE_DELAY * 3
+
+
+@pytest.mark.anyio
+async def test_profile_requests_share_one_round_trip_and_connection(graph, graph_stand_in):
+    graph_stand_in.delays.clear()
+    for _ in range(3):
+        responses = await graph.batch("access-token", PROFILE_REQUESTS)
+        assert responses["me"]["body"] == ME
+        assert responses["org"]["body"]["value"] == [ORG]
+    assert graph_stand_in.requests == [("POST", "/$batch")] * 3
+    assert len(graph_stand_in.connections) == 1  # kept alive by the pool across logins
+
+
+@pytest.mark.anyio
+async def test_failed_batch_raises(graph, graph_stand_in):
+    graph_stand_in.routes["POST /$batch"] = lambda *_: (401, {"error": {"message": "expired"}})
+    with pytest.raises(PermissionError, match="401"):
+        await graph.batch("access-token", PROFILE_REQUESTS)
+
+
+@pytest.mark.anyio
+async def test_profile_is_hydrated_once_then_served_from_cache(graph, graph_stand_in):
+    pytest.importorskip("pyzurecli")
+    graph_stand_in.delays.clear()
+    claims = {"oid": "object-id", "tid": "tenant-id"}
+    me, org = await graph.profile("access-token", claims)
+    assert me.userPrincipalName == "user@example.com" and org.id == "tenant-id"
+    assert graph.latency.count == 1
+    await graph.profile("access-token", claims)
+    assert graph_stand_in.count("POST", "/$batch") == 1
+    assert graph.me_cache.stats.hits == 1 and graph.org_cache.stats.hits == 1
+
+
+@pytest.mark.anyio
+async def test_failed_sub_request_raises(graph, graph_stand_in):
+    pytest.importorskip("pyzurecli")
+    graph_stand_in.routes["POST /$batch"] = lambda *_: (200, {"responses": [
+        {"id": "me", "status": 403, "body": {"error": {"message": "Insufficient privileges"}}},
+        {"id": "org", "status": 200, "body": {"value": [ORG]}},
+    ]})
+    with pytest.raises(PermissionError, match="Insufficient privileges"):
+        await graph.profile("access-token", {"oid": "object-id", "tid": "tenant-id"})
+
+
+@pytest.mark.anyio
+async def test_empty_organization_list_raises(graph, graph_stand_in):
+    graph_stand_in.routes["POST /$batch"] = lambda *_: (200, {"responses": [
+        {"id": "me", "status": 200, "body": ME},
+        {"id": "org", "status": 200, "body": {"value": []}},
+    ]})
+    with pytest.raises(PermissionError, match="No organization"):
+        await graph.profile("access-token", {"oid": "object-id", "tid": "tenant-id"})
+    assert len(graph.org_cache) == 0
@@ -0,0 +1,176 @@
+import base64
+import json
+import time
+
+import pytest
+
+from toomanysessions.clients import HTTPPool
+from toomanysessions.idtoken import JWKS, IdTokenValidator, verify_rs256
+
+rsa = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.rsa")
+from cryptography.hazmat.primitives import hashes  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import padding  # noqa: E402
+
+CLIENT_ID = "client-id"
+TENANT = "tenant-id"
+ISSUER = "https://login.example/{tid}/v2.0"
+
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64json(data: dict) -> str:
+    return b64(json.dumps(data).encode("utf-8"))
+
+
+def jwk(kid: str, key) -> dict:
+    numbers = key.public_key().public_numbers()
+    n = numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, "big")
+    return {"kty": "RSA", "use": "sig", "kid": kid, "n": b64(n), "e": b64(numbers.e.to_bytes(3, "big"))}
+
+
+def sign(key, kid: str, **overrides) -> str:
+    now = time.time()
+    claims = {
+        "aud": CLIENT_ID,
+        "iss": ISSUER.format(tid=TENANT),
+        "tid": TENANT,
+        "oid": "object-id",
+        "exp": now + 3600,
+        "nbf": now - 60,
+        **overrides
+    }
+    signing_input = f"{b64json({'alg': 'RS256', 'kid': kid})}.{b64json(claims)}"
+    signature = key.sign(signing_input.encode("ascii"), padding.PKCS1v15(), hashes.SHA256())
+    return f"{signing_input}.{b64(signature)}"
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return {kid: rsa.generate_private_key(public_exponent=65537, key_size=2048) for kid in ("k1", "k2", "rogue")}
+
+
+@pytest.fixture
+def published(stand_in, keys):
+    """The kids the stand-in provider currently publishes"""
+    kids = ["k1"]
+
+    @stand_in.route("GET /keys")
+    def serve(*_):
+        return 200, {"keys": [jwk(kid, keys[kid]) for kid in kids]}
+
+    return kids
+
+
+@pytest.fixture
+async def validator(stand_in, published):
+    pool = HTTPPool(verbose=False)
+    jwks = JWKS(f"{stand_in.url}/keys", pool, min_interval=0.0, verbose=False)
+    yield IdTokenValidator(jwks, client_id=CLIENT_ID, issuer=ISSUER)
+    await pool.aclose()
+
+
+def test_verify_rs256_matches_a_reference_signature(keys):
+    key = keys["k1"]
+    signature = key.sign(b"payload", padding.PKCS1v15(), hashes.SHA256())
+    numbers = key.public_key().public_numbers()
+    assert verify_rs256(b"payload", signature, numbers.n, numbers.e)
+    assert not verify_rs256(b"payloaD", signature, numbers.n, numbers.e)
+    assert not verify_rs256(b"payload", signature[:-1], numbers.n, numbers.e)
+
+
+@pytest.mark.anyio
+async def test_valid_token(validator, keys):
+    claims = await validator.validate(sign(keys["k1"], "k1"))
+    assert claims["oid"] == "object-id"
+
+
+@pytest.mark.anyio
+async def test_tampered_payload_is_rejected(validator, keys):
+    header, _, signature = sign(keys["k1"], "k1").split(".")
+    forged_claims = b64json({"aud": CLIENT_ID, "iss": ISSUER.format(tid=TENANT), "tid": TENANT, "oid": "admin",
+                             "exp": time.time() + 3600})
+    with pytest.raises(ValueError, match="signature"):
+        await validator.validate(f"{header}.{forged_claims}.{signature}")
+
+
+@pytest.mark.anyio
+async def test_token_forged_with_another_key_is_rejected(validator, keys):
+    with pytest.raises(ValueError, match="signature"):
+        await validator.validate(sign(keys["rogue"], "k1"))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("overrides, message", [
+    ({"exp": time.time() - 3600}, "expired"),
+    ({"exp": "never"}, "expired"),
+    ({"nbf": time.time() + 3600}, "not valid yet"),
+    ({"aud": "someone-else"}, "audience"),
+    ({"iss": "https://evil.example/v2.0"}, "issuer"),
+])
+async def test_claims_are_checked(validator, keys, overrides, message):
+    with pytest.raises(ValueError, match=message):
+        await validator.validate(sign(keys["k1"], "k1", **overrides))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("alg", ["none", "HS256"])
+async def test_only_rs256_is_accepted(validator, keys, alg):
+    _, payload, signature = sign(keys["k1"], "k1").split(".")
+    with pytest.raises(ValueError, match="algorithm"):
+        await validator.validate(f"{b64json({'alg': alg, 'kid': 'k1'})}.{payload}.{signature}")
+
+
+@pytest.mark.anyio
+async def test_malformed_token_is_rejected(validator):
+    with pytest.raises(ValueError, match="Malformed"):
+        await validator.validate("not-a-jwt")
+
+
+@pytest.mark.anyio
+async def test_key_rotation_refetches_the_jwks(validator, keys, published, stand_in):
+    await validator.validate(sign(keys["k1"], "k1"))
+    published[:] = ["k2"]  # the provider rotates its signing key
+    claims = await validator.validate(sign(keys["k2"], "k2"))
+    assert claims["oid"] == "object-id"
+    assert stand_in.count("GET", "/keys") == 2
+
+
+@pytest.mark.anyio
+async def test_unknown_kid_is_rejected_and_refetches_are_rate_limited(validator, keys, stand_in):
+    validator.jwks.min_interval = 300.0
+    await validator.validate(sign(keys["k1"], "k1"))
+    for _ in range(3):
+        with pytest.raises(ValueError, match="Unknown"):
+            await validator.validate(sign(keys["rogue"], "rogue"))
+    assert stand_in.count("GET", "/keys") == 1
+
+
+@pytest.mark.anyio
+async def test_unreachable_provider_keeps_serving_cached_keys(validator, keys, stand_in):
+    await validator.validate(sign(keys["k1"], "k1"))
+    validator.jwks.ttl = 0.0  # stale, so the next lookup tries to refresh
+    stand_in.routes["GET /keys"] = lambda *_: (503, {})
+    claims = await validator.validate(sign(keys["k1"], "k1"))
+    assert claims["oid"] == "object-id"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("id_token", [None, ""])
+async def test_missing_token_is_rejected(validator, id_token):
+    with pytest.raises(ValueError, match="Missing"):
+        await validator.validate(id_token)
+
+
+@pytest.mark.anyio
+async def test_sign_in_without_an_id_token_fails_closed(validator, keys):
+    msft_oauth = pytest.importorskip("toomanysessions.msft_oauth")
+    provider = type("Provider", (), {"id_tokens": validator, "verified_claims": msft_oauth.MicrosoftOAuth.verified_claims})()
+    # the access token carries plausible identity claims, but nothing about it was verified here
+    access_token = f"{b64json({'alg': 'none'})}.{b64json({'oid': 'admin', 'tid': TENANT})}."
+    creds = msft_oauth.MSFTOAuthTokenResponse.from_response({
+        "token_type": "Bearer", "scope": "openid", "expires_in": 3600, "ext_expires_in": 3600, "access_token": access_token})
+    assert await provider.verified_claims(creds) is None
+    creds.id_token = sign(keys["k1"], "k1")
+    assert (await provider.verified_claims(creds))["oid"] == "object-id"
@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC = Path(__file__).parent.parent / "src"
+HEAVY = ("fastapi", "starlette", "httpx", "jinja2", "pyzurecli", "cryptography")
+
+
+def fresh_import(statement: str) -> tuple[float, list[str]]:
+    """Seconds a statement takes in a new interpreter, and which heavy packages it pulled in"""
+    probe = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps([elapsed, [m for m in {HEAVY!r} if m in sys.modules]]))\n"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", probe], capture_output=True, text=True, check=True,
+        env={**os.environ, "PYTHONPATH": str(SRC), "TOOMANYSESSIONS_DEBUG": "0"}
+    )
+    elapsed, loaded = json.loads(out.stdout.splitlines()[-1])
+    return elapsed, loaded
+
+
+@pytest.mark.parametrize("statement, allowed", [
+    ("import toomanysessions", ()),
+    ("from toomanysessions import Session", ()),
+    ("from toomanysessions import Whitelist, SessionStore", ()),
+    ("from toomanysessions import Sessions", ("fastapi", "starlette")),
+])
+def test_import_stays_light(statement, allowed, record_property):
+    elapsed, loaded = fresh_import(statement)
+    record_property("import_ms", round(elapsed * 1000, 1))
+    print(f"\n{statement}: {elapsed * 1000:.1f}ms, loaded {loaded}")
+    assert set(loaded) <= set(allowed)
+
+
+def test_session_import_time():
+    # best of three, so a cold disk cache doesn't fail the run; typically ~15ms against ~400ms with fastapi
+    elapsed = min(fresh_import("from toomanysessions import Session")[0] for _ in range(3))
+    assert elapsed < 0.15
@@ -0,0 +1,43 @@
+import gc
+import secrets
+import tracemalloc
+
+import pytest
+
+from toomanysessions.session import Session
+from toomanysessions.store import SessionStore
+
+SESSIONS = 100_000
+
+
+def test_sessions_are_slotted():
+    session = Session.create("tok")
+    assert not hasattr(session, "__dict__")
+    with pytest.raises(AttributeError):
+        session.request = object()  # nothing can pin a request, its scope or receive channel to a session
+
+
+def test_bytes_per_session_at_100k(record_property):
+    tokens = [secrets.token_urlsafe(32) for _ in range(SESSIONS)]  # allocated up front, cookies own them anyway
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        store = SessionStore(max_size=SESSIONS, sweep_interval=None, verbose=False)
+        for token in tokens:
+            session = Session.create(token)
+            session.authenticated = True
+            store[token] = session
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    per_session = used / SESSIONS
+    estimate = store.census()["memory_bytes"] / SESSIONS
+    record_property("bytes_per_session", round(per_session))
+    print(f"\n{per_session:.0f} bytes per session at {SESSIONS} sessions, census estimates {estimate:.0f}")
+    assert len(store) == SESSIONS
+    # session record, its floats, the LRU slot and the expiry heap entry: ~350 bytes with slots
+    assert per_session < 600
+    # the gauge exported at /sessions/metrics stays within a factor of two of the measured cost
+    assert per_session / 2 < estimate < per_session * 2
@@ -0,0 +1,87 @@
+import pytest
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+from toomanysessions.graph import GraphClient
+from toomanysessions.sessions import Sessions
+
+
+@pytest.fixture
+def sessions():
+    sessions = Sessions(sweep_interval=None, verbose=False)
+    # registered the way the server registers its Graph profile caches
+    graph = GraphClient(base_url="http://graph.invalid", verbose=False)
+    sessions.metrics.lookups["graph_me"] = graph.me_cache.stats
+    sessions.metrics.lookups["graph_org"] = graph.org_cache.stats
+    graph.me_cache.set("object-id", {"id": "object-id"})
+    graph.me_cache.get("object-id")
+    graph.me_cache.get("someone-else")
+    graph.org_cache.get("tenant-id")
+
+    for token in ("a", "b", "c"): sessions[token].authenticated = token == "a"
+    sessions["a"]
+    sessions.metrics.observe("render", 0.003)
+    sessions.metrics.observe("render", 0.2)
+    sessions.metrics.observe("graph_hydration", 30.0)
+    return sessions
+
+
+@pytest.fixture
+def client(sessions):
+    app = FastAPI()
+    app.include_router(sessions)
+    return TestClient(app)
+
+
+def test_prometheus_text(client):
+    response = client.get("/sessions/metrics")
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    # gauges from the store census, counters for anything ending in _total
+    assert "# TYPE toomanysessions_sessions_live gauge" in lines
+    assert "toomanysessions_sessions_live 3" in lines
+    assert "toomanysessions_sessions_authenticated 1" in lines
+    assert "# TYPE toomanysessions_sessions_created_total counter" in lines
+    assert "toomanysessions_sessions_created_total 3" in lines
+    assert "toomanysessions_oauth_pending 0" in lines
+    assert not any(line.startswith("toomanysessions_sessions_memory_bytes None") for line in lines)
+    # lookups and hit ratios per cache
+    assert 'toomanysessions_lookups_total{cache="sessions",result="hit"} 1' in lines
+    assert 'toomanysessions_lookups_total{cache="sessions",result="miss"} 3' in lines
+    assert 'toomanysessions_lookup_hit_ratio{cache="sessions"} 0.25' in lines
+    assert 'toomanysessions_lookups_total{cache="graph_me",result="hit"} 1' in lines
+    assert 'toomanysessions_lookups_total{cache="graph_me",result="miss"} 1' in lines
+    assert 'toomanysessions_lookup_hit_ratio{cache="graph_org"} 0.0' in lines
+    # cumulative histogram buckets, ending at +Inf
+    assert "# TYPE toomanysessions_stage_seconds histogram" in lines
+    assert 'toomanysessions_stage_seconds_bucket{stage="render",le="0.005"} 1' in lines
+    assert 'toomanysessions_stage_seconds_bucket{stage="render",le="0.1"} 1' in lines
+    assert 'toomanysessions_stage_seconds_bucket{stage="render",le="0.25"} 2' in lines
+    assert 'toomanysessions_stage_seconds_bucket{stage="render",le="+Inf"} 2' in lines
+    assert 'toomanysessions_stage_seconds_count{stage="render"} 2' in lines
+    assert 'toomanysessions_stage_seconds_bucket{stage="graph_hydration",le="10.0"} 0' in lines
+    assert 'toomanysessions_stage_seconds_bucket{stage="graph_hydration",le="+Inf"} 1' in lines
+    assert 'toomanysessions_stage_seconds_count{stage="session_lookup"} 0' in lines
+
+
+def test_json_snapshot(client):
+    snapshot = client.get("/sessions/metrics/json").json()
+    assert snapshot["sessions"]["live"] == 3 and snapshot["sessions"]["authenticated"] == 1
+    assert snapshot["sessions"]["memory_bytes"] > 0
+    assert snapshot["oauth"] == {"pending": 0, "expired_total": 0, "evicted_total": 0}
+    assert snapshot["lookups"]["sessions"] == {"hits": 1, "misses": 3, "created": 3, "hit_ratio": 0.25}
+    assert snapshot["lookups"]["graph_me"]["hit_ratio"] == 0.5
+    assert snapshot["lookups"]["graph_org"]["misses"] == 1
+    render = snapshot["stages"]["render"]
+    assert render["count"] == 2 and render["sum"] == pytest.approx(0.203)
+    assert render["mean"] == pytest.approx(0.1015)
+    assert render["buckets"]["0.005"] == 1 and render["buckets"]["+Inf"] == 2
+    assert snapshot["stages"]["graph_hydration"]["buckets"]["10.0"] == 0
+
+
+def test_lookup_counters_follow_the_store(sessions):
+    before = sessions.metrics.snapshot()["lookups"]["sessions"]
+    sessions["a"]
+    sessions["d"]
+    after = sessions.metrics.snapshot()["lookups"]["sessions"]
+    assert (after["hits"] - before["hits"], after["misses"] - before["misses"]) == (1, 1)
@@ -0,0 +1,203 @@
+import time
+
+import pytest
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+
+from toomanysessions.cookies import StatelessSessions
+from toomanysessions.middleware import RouteClassifier, SessionedMiddleware, without_dispatch
+from toomanysessions.sessions import Sessions
+
+REQUESTS = 2000
+
+
+class Gate:
+    """The parts of `SessionedServer` the middleware calls, with an auth gate that admits every session"""
+
+    verbose = False
+
+    def __init__(self, sessions: Sessions):
+        self.sessions = sessions
+        self.bypass = RouteClassifier(["/static", "/sessions/metrics"])
+
+    def is_bypassed(self, path: str) -> bool:
+        return self.bypass(path)
+
+    async def session_manager(self, request: Request):
+        cookie = request.cookies.get(self.sessions.session_name)
+        session, request.state.cookie_state = await self.sessions.for_cookie(cookie)
+        request.state.session = session
+        return session
+
+    async def admit(self, request: Request, session) -> Response | None:
+        session.authenticated = True
+        return None
+
+    def cookie_headers(self, request: Request, session) -> list[tuple[bytes, bytes]]:
+        if not self.sessions.changed(session, getattr(request.state, "cookie_state", None)): return []
+        response = self.sessions.set_cookie(Response(), session, httponly=True)
+        return [(k, v) for k, v in response.raw_headers if k == b"set-cookie"]
+
+    def finalize(self, request: Request, session, response: Response) -> Response:
+        return PlainTextResponse("not found popup", status_code=404) if response.status_code == 404 else response
+
+    def popup_error(self, error_code: int, message: str) -> Response:
+        return PlainTextResponse(message, status_code=error_code)
+
+
+def app() -> Starlette:
+    return Starlette(routes=[Route("/", lambda request: PlainTextResponse("ok"))])
+
+
+async def call(asgi, path: str = "/", cookie: str = None) -> tuple[int, dict, bytes]:
+    headers = [(b"host", b"test")]
+    if cookie: headers.append((b"cookie", f"session={cookie}".encode()))
+    scope = {"type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "query_string": b"",
+             "headers": headers, "scheme": "http", "server": ("test", 80), "client": ("127.0.0.1", 1234),
+             "http_version": "1.1", "root_path": ""}
+    out = {"status": None, "headers": {}, "body": b""}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            out["status"] = message["status"]
+            out["headers"] = {k.decode(): v.decode() for k, v in message.get("headers", [])}
+        else:
+            out["body"] += message.get("body", b"")
+
+    await asgi(scope, receive, send)
+    return out["status"], out["headers"], out["body"]
+
+
+async def per_request(asgi, cookie: str = None) -> float:
+    for _ in range(100): await call(asgi, cookie=cookie)  # warm up
+    start = time.perf_counter()
+    for _ in range(REQUESTS): await call(asgi, cookie=cookie)
+    return (time.perf_counter() - start) / REQUESTS
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("stateless", [False, True], ids=["store", "cookie"])
+async def test_middleware_overhead(stateless, record_property):
+    sessions = StatelessSessions(keys=["k"], verbose=False) if stateless else Sessions(verbose=False)
+    gate = Gate(sessions)
+    gated = SessionedMiddleware(app(), gate)
+    _, headers, _ = await call(gated)
+    cookie = headers["set-cookie"].split(";")[0].split("=", 1)[1]
+
+    bare = await per_request(app())
+    wrapped = await per_request(gated, cookie)
+    overhead = wrapped - bare
+    record_property("overhead_us", round(overhead * 1e6, 1))
+    print(f"\nbare {bare * 1e6:.1f}us, gated {wrapped * 1e6:.1f}us, overhead {overhead * 1e6:.1f}us per request")
+    # a returning browser costs one session lookup and no re-issued cookie; the bound is loose enough for slow CI
+    assert overhead < 1e-3
+    assert sessions.stats.created == 1
+
+
+def call_next_gate(gate: Gate) -> BaseHTTPMiddleware:
+    """The same gate as an `@app.middleware("http")` function, the way it ran before SessionedMiddleware"""
+
+    async def dispatch(request: Request, call_next):
+        if gate.is_bypassed(request.url.path): return await call_next(request)
+        session = await gate.session_manager(request)
+        response = await gate.admit(request, session)
+        if response is not None: return response
+        response = gate.finalize(request, session, await call_next(request))
+        response.raw_headers.extend(gate.cookie_headers(request, session))
+        return response
+
+    return BaseHTTPMiddleware(app(), dispatch=dispatch)
+
+
+@pytest.mark.anyio
+async def test_pure_asgi_gate_beats_call_next(record_property):
+    sessions = Sessions(verbose=False)
+    gated, baseline = SessionedMiddleware(app(), Gate(sessions)), call_next_gate(Gate(sessions))
+    _, headers, _ = await call(gated)
+    cookie = headers["set-cookie"].split(";")[0].split("=", 1)[1]
+    assert await call(baseline, cookie=cookie) == await call(gated, cookie=cookie)
+
+    asgi, call_next = await per_request(gated, cookie), await per_request(baseline, cookie)
+    record_property("asgi_us", round(asgi * 1e6, 1))
+    record_property("call_next_us", round(call_next * 1e6, 1))
+    print(f"\nASGI gate {asgi * 1e6:.1f}us, call_next gate {call_next * 1e6:.1f}us per request")
+    # call_next spawns a task and a memory stream per request, the ASGI gate calls straight through
+    assert asgi < call_next
+
+
+@pytest.mark.anyio
+async def test_request_log_hop_is_dropped():
+    async def request_log(request, call_next):
+        return await call_next(request)
+
+    async def keep(request, call_next):
+        return await call_next(request)
+
+    server = app()
+    # what `@app.middleware("http")` registers, as ThreadedServer does for its request_log
+    for dispatch in (request_log, keep): server.add_middleware(BaseHTTPMiddleware, dispatch=dispatch)
+    server.user_middleware = without_dispatch(server.user_middleware, "request_log")
+    assert [m.kwargs["dispatch"] for m in server.user_middleware] == [keep]
+    assert (await call(server))[0] == 200
+
+
+@pytest.mark.anyio
+async def test_returning_browser_gets_no_set_cookie():
+    gate = Gate(StatelessSessions(keys=["k"], verbose=False))
+    gated = SessionedMiddleware(app(), gate)
+    status, headers, body = await call(gated)
+    assert (status, body) == (200, b"ok") and "set-cookie" in headers
+    cookie = headers["set-cookie"].split(";")[0].split("=", 1)[1]
+    status, headers, _ = await call(gated, cookie=cookie)
+    assert status == 200 and "set-cookie" not in headers
+
+
+@pytest.mark.anyio
+async def test_bypassed_routes_skip_the_session_lookup():
+    sessions = Sessions(verbose=False)
+    gated = SessionedMiddleware(app(), Gate(sessions))
+    status, headers, _ = await call(gated, "/static/app.css")
+    assert status == 404 and "set-cookie" not in headers
+    assert sessions.stats.created == 0 and len(sessions.cache) == 0
+
+
+@pytest.mark.anyio
+async def test_not_found_is_replaced_by_the_popup():
+    gated = SessionedMiddleware(app(), Gate(Sessions(verbose=False)))
+    status, _, body = await call(gated, "/missing")
+    assert (status, body) == (404, b"not found popup")
+
+
+def test_bypass_prefixes_match_whole_segments():
+    bypass = RouteClassifier(["/static", "/sessions/metrics/", "/users/{user_id}/avatar"])
+    assert bypass("/static") and bypass("/static/") and bypass("/static/css/app.css")
+    assert not bypass("/staticfoo") and not bypass("/static.css") and not bypass("/")
+    assert bypass("/sessions/metrics") and not bypass("/sessions/metricsx") and not bypass("/sessions")
+    assert bypass("/users/42/avatar") and bypass("/users/42/avatar/small.png")
+    assert not bypass("/users/42/avatars") and not bypass("/users/42/43/avatar")
+    assert not bypass("/x/static")  # anchored at the start of the path
+    assert not RouteClassifier()("/static")
+
+
+def test_adding_routes_recompiles_and_forgets_cached_answers():
+    bypass = RouteClassifier(["/static"])
+    assert not bypass("/passkey/callback")
+    # what SessionedServer.include_router does once a router brings its own bypass routes
+    bypass.compile(["/static", "/passkey/callback"])
+    assert bypass("/passkey/callback") and bypass("/static/app.css")
+    bypass.compile(["/passkey/callback"])
+    assert not bypass("/static/app.css")
+
+
+def test_path_cache_is_bounded():
+    bypass = RouteClassifier(["/static"], cache_size=100)
+    for i in range(1_000):
+        assert bypass(f"/static/{i}.css") and not bypass(f"/page/{i}")
+        assert len(bypass.cache) <= 100
+    assert bypass.cache  # still caching after being reset
@@ -0,0 +1,102 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import anyio
+import bcrypt
+import pytest
+
+from toomanysessions.session import Session
+
+passkey = pytest.importorskip("toomanysessions.passkey")  # needs the toomanyconfigs stack
+Passkey = passkey.Passkey
+
+PASSWORD = "correct horse battery staple"
+HASHED = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds=10)).decode()  # ~50ms per check
+
+
+class Verifier:
+    """The bcrypt pool of a Passkey router, without its server and config file"""
+    validate, _validate, saturated = Passkey.validate, Passkey._validate, Passkey.saturated
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.cfg = SimpleNamespace(hashed_pass=HASHED)
+
+    def __repr__(self):
+        return "[Test.Passkey]"
+
+
+@pytest.fixture
+def checks(monkeypatch):
+    """Wrap bcrypt.checkpw to record how many checks ran at once"""
+    state = SimpleNamespace(running=0, peak=0, lock=threading.Lock())
+    checkpw = bcrypt.checkpw
+
+    def counted(password, hashed):
+        with state.lock:
+            state.running += 1
+            state.peak = max(state.peak, state.running)
+        try:
+            return checkpw(password, hashed)
+        finally:
+            with state.lock: state.running -= 1
+
+    monkeypatch.setattr(passkey.bcrypt, "checkpw", counted)
+    return state
+
+
+@pytest.mark.anyio
+async def test_checks_run_at_most_max_workers_at_once(checks):
+    verifier = Verifier(max_workers=2, max_pending=8)
+    results = []
+
+    async def attempt(password):
+        results.append(await verifier.validate(Session.create("tok"), password))
+
+    async with anyio.create_task_group() as tg:
+        for i in range(6): tg.start_soon(attempt, PASSWORD if i % 2 else "wrong")
+    assert sorted(results) == [False] * 3 + [True] * 3
+    assert checks.peak == 2
+    assert verifier.pending == 0
+
+
+@pytest.mark.anyio
+async def test_attempts_past_the_queue_bound_are_rejected(checks):
+    verifier = Verifier(max_workers=1, max_pending=2)
+    outcomes = []
+
+    async def attempt():
+        try:
+            outcomes.append(await verifier.validate(Session.create("tok"), PASSWORD))
+        except RuntimeError as e:
+            outcomes.append(str(e))
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(5): tg.start_soon(attempt)
+    assert outcomes.count(True) == 2
+    assert outcomes.count("Passkey verification queue is full") == 3
+    assert not verifier.saturated  # the queue drains once the checks finish
+
+
+@pytest.mark.anyio
+async def test_event_loop_keeps_ticking_during_checks(checks):
+    verifier = Verifier(max_workers=2, max_pending=8)
+    ticks = 0
+
+    async def other_requests():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await anyio.sleep(0.005)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(other_requests)
+        start = anyio.current_time()
+        for _ in range(4): assert await verifier.validate(Session.create("tok"), PASSWORD)
+        elapsed = anyio.current_time() - start
+        tg.cancel_scope.cancel()
+    # a check on the loop itself would have starved the ticker for the whole time
+    assert ticks >= elapsed / 0.005 / 2
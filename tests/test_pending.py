@@ -0,0 +1,75 @@
+import pytest
+
+from toomanysessions.backends import RedisBackend, SQLiteBackend
+from toomanysessions.pending import PendingAuthorizations
+from toomanysessions.sessions import Sessions
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def workers(request, tmp_path):
+    """Two workers' Sessions, sharing their backend where it can be shared"""
+    if request.param == "memory":
+        sessions = Sessions(verbose=False)
+        yield sessions, sessions
+        return
+    if request.param == "sqlite":
+        backends = [SQLiteBackend(tmp_path / "sessions.db", verbose=False) for _ in range(2)]
+    else:
+        redis = request.getfixturevalue("redis_stand_in")
+        backends = [RedisBackend(port=redis.port, verbose=False) for _ in range(2)]
+    yield tuple(Sessions(backend=backend, verbose=False) for backend in backends)
+    for backend in backends: backend.close()
+
+
+def test_callback_lands_on_another_worker(workers):
+    a, b = workers
+    session = a["tok"]
+    state = a.authorization_state(session, "verifier")
+    resolved = b.for_state(state, "tok")
+    assert resolved.token == "tok" and resolved.verifier == "verifier"
+
+
+def test_state_is_single_use(workers):
+    a, b = workers
+    state = a.authorization_state(a["tok"], "verifier")
+    assert b.for_state(state, "tok") is not None
+    assert a.for_state(state, "tok") is None
+    assert b.for_state("made-up-state", "tok") is None
+
+
+def test_state_is_bound_to_the_browser_that_started_the_login(workers):
+    a, b = workers
+    state = a.authorization_state(a["victim"], "verifier")
+    assert b.for_state(state, "attacker") is None
+    assert b.for_state(state, None) is None
+    assert b.for_state(state, "victim") is None  # the failed attempt burned the state
+
+
+def test_expiry_and_bound():
+    pending = PendingAuthorizations(ttl=60.0, max_pending=2, verbose=False)
+    states = [pending.add(f"tok{i}", "verifier") for i in range(3)]
+    assert len(pending) == 2 and pending.pop(states[0]) is None
+    pending.prune(now=float("inf"))
+    assert pending.pop(states[2]) is None
+    assert pending.census() == {"pending": 0, "expired_total": 2, "evicted_total": 1}
+
+
+def test_a_session_holds_one_outstanding_state():
+    pending = PendingAuthorizations(verbose=False)
+    first = pending.add("tok", "first-verifier")
+    second = pending.add("tok", "second-verifier")
+    assert len(pending) == 1
+    assert pending.pop(first) is None
+    assert pending.pop(second).verifier == "second-verifier"
+
+
+def test_a_flood_cannot_evict_another_sessions_login():
+    pending = PendingAuthorizations(max_pending=100, max_per_client=4, verbose=False)
+    state = pending.add("victim", "verifier", client="198.51.100.7")
+    # a cookieless flood mints a new session, and so a new state, on every request
+    for i in range(1_000): pending.add(f"flood{i}", "verifier", client="203.0.113.9")
+    for _ in range(1_000): pending.add("flood", "verifier", client="203.0.113.9")
+    assert len(pending) == 5
+    assert pending.census()["evicted_total"] == 1_000 - 4 + 1  # every one from the flooding address
+    assert pending.pop(state).token == "victim"
+    assert len(pending) == 4
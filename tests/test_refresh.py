@@ -0,0 +1,131 @@
+import time
+from dataclasses import dataclass
+from urllib.parse import parse_qs
+
+import anyio
+import httpx
+import pytest
+
+from toomanysessions.clients import HTTPPool
+from toomanysessions.refresh import TokenRefresher
+from toomanysessions.session import Session
+from toomanysessions.sessions import Sessions
+
+LEAD = 3600.0  # refreshed tokens last 7200s, so each is refreshed once per test
+
+
+@dataclass
+class Creds:
+    """Shaped like MSFTOAuthTokenResponse, whose module needs the Azure CLI stack to import"""
+    access_token: str
+    expires_in: int = 3600
+    refresh_token: str = None
+    expires_at: float = None
+
+    @classmethod
+    def from_response(cls, data: dict) -> 'Creds':
+        return cls(data["access_token"], data["expires_in"], data.get("refresh_token"), time.time() + data["expires_in"])
+
+
+class OAuth:
+    def __init__(self, url: str):
+        self.url = url
+
+    def build_refresh_request(self, creds: Creds) -> httpx.Request:
+        return httpx.Request("POST", self.url, data={"grant_type": "refresh_token", "refresh_token": creds.refresh_token})
+
+
+@pytest.fixture
+def token_endpoint(stand_in):
+    """Stand-in token endpoint that rotates refresh tokens, unless a test swaps the route"""
+    issued = []
+
+    @stand_in.route("POST /token")
+    def token(method, path, query, body):
+        form = parse_qs(body.decode())
+        assert form["grant_type"] == ["refresh_token"]
+        issued.append(form["refresh_token"][0])
+        return 200, {"access_token": f"access-{len(issued)}", "expires_in": 7200, "refresh_token": f"refresh-{len(issued)}"}
+
+    stand_in.issued = issued
+    return stand_in
+
+
+@pytest.fixture
+async def refresher(token_endpoint):
+    pool = HTTPPool(verbose=False)
+    sessions = Sessions(verbose=False)
+    refresher = TokenRefresher(OAuth(token_endpoint.url + "/token"), sessions, pool, lead=LEAD, batch_size=4,
+                               rate=1000.0, retry_delay=0.05, verbose=False)
+    yield refresher
+    await refresher.stop()
+    await pool.aclose()
+
+
+def signed_in(sessions: Sessions, token: str, expires_in: float) -> Session:
+    session = sessions[token]
+    session.oauth_token_data = Creds("access-0", refresh_token="refresh-0", expires_at=time.time() + expires_in)
+    sessions.commit(session)
+    return session
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    with anyio.fail_after(timeout):
+        while not condition(): await anyio.sleep(0.01)
+
+
+@pytest.mark.anyio
+async def test_tokens_are_refreshed_ahead_of_expiry(refresher, token_endpoint):
+    session = signed_in(refresher.sessions, "tok", expires_in=LEAD + 0.1)  # due in 100ms
+    assert refresher.schedule(session)
+    await refresher.start()
+    await wait_for(lambda: refresher.refreshed == 1)
+    creds = refresher.sessions.get("tok").oauth_token_data
+    assert (creds.access_token, creds.refresh_token) == ("access-1", "refresh-1")
+    assert token_endpoint.issued == ["refresh-0"]
+    assert len(refresher) == 1  # rescheduled against the new expiry
+    assert refresher.latency.count == 1
+
+
+@pytest.mark.anyio
+async def test_due_tokens_are_refreshed_in_batches_over_one_pool(refresher, token_endpoint):
+    for i in range(10): refresher.schedule(signed_in(refresher.sessions, f"tok{i}", expires_in=LEAD - 1))
+    await refresher.start()
+    await wait_for(lambda: refresher.refreshed == 10)
+    assert len(token_endpoint.issued) == 10
+    assert len(token_endpoint.connections) <= refresher.batch_size
+
+
+@pytest.mark.anyio
+async def test_requests_never_wait_on_a_refresh(refresher, token_endpoint):
+    token_endpoint.delays["POST /token"] = 0.5
+    refresher.schedule(signed_in(refresher.sessions, "tok", expires_in=LEAD - 1))
+    await refresher.start()
+    await wait_for(lambda: len(token_endpoint.requests) == 1)
+    start = time.perf_counter()
+    session, _ = await refresher.sessions.for_cookie("tok")
+    assert time.perf_counter() - start < 0.05
+    assert session.oauth_token_data.access_token == "access-0"  # the old token stays usable until the new one lands
+    await wait_for(lambda: refresher.refreshed == 1)
+
+
+@pytest.mark.anyio
+async def test_rejected_refresh_token_is_dropped(refresher, token_endpoint):
+    token_endpoint.routes["POST /token"] = lambda *_: (400, {"error": "invalid_grant"})
+    refresher.schedule(signed_in(refresher.sessions, "tok", expires_in=LEAD - 1))
+    await refresher.start()
+    await wait_for(lambda: refresher.failed == 1)
+    assert refresher.sessions.get("tok").oauth_token_data.refresh_token is None
+    assert len(refresher) == 0
+
+
+@pytest.mark.anyio
+async def test_server_errors_are_retried(refresher, token_endpoint):
+    replies = iter([(503, {}), (200, {"access_token": "access-1", "expires_in": 7200})])
+    token_endpoint.routes["POST /token"] = lambda *_: next(replies)
+    refresher.schedule(signed_in(refresher.sessions, "tok", expires_in=LEAD - 1))
+    await refresher.start()
+    await wait_for(lambda: refresher.refreshed == 1)
+    assert refresher.failed == 1
+    creds = refresher.sessions.get("tok").oauth_token_data
+    assert (creds.access_token, creds.refresh_token) == ("access-1", "refresh-0")  # kept when none is returned
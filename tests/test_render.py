@@ -0,0 +1,159 @@
+import time
+
+import pytest
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from starlette.requests import Request
+from starlette.responses import HTMLResponse
+
+from toomanysessions import TEMPLATES
+from toomanysessions.render import RenderCache, compile_templates
+
+
+class Templater:
+    """The safe_render half of FastJ2 over the bundled templates, counting renders"""
+
+    def __init__(self):
+        self.env = Environment(loader=FileSystemLoader(TEMPLATES))
+        self.renders = 0
+
+    def safe_render(self, template_name: str, **context):
+        self.renders += 1
+        return HTMLResponse(self.env.get_template(template_name).render(**context))
+
+
+def popup(cache: RenderCache, text: str = "Nothing here."):
+    return cache.render("popup.html", title="Not Found", header="404", text=text, buttons=[{"text": "Home"}])
+
+
+def request(if_none_match: str = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "headers": headers})
+
+
+def test_identical_contexts_render_once():
+    cache = RenderCache(Templater())
+    first, second = popup(cache), popup(cache)
+    assert first.body == second.body and b"Nothing here." in first.body
+    assert cache.templater.renders == 1
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    assert cache.latency.count == 2
+    assert popup(cache, "Elsewhere.").body != first.body and cache.templater.renders == 2
+
+
+def test_cache_is_bounded():
+    cache = RenderCache(Templater(), max_size=4)
+    for i in range(10): popup(cache, f"page {i}")
+    assert len(cache) == 4 and cache.stats.evicted == 6
+    popup(cache, "page 9")
+    assert cache.templater.renders == 10
+    popup(cache, "page 0")  # evicted long ago, so rendered again
+    assert cache.templater.renders == 11
+
+
+def test_etag_and_not_modified():
+    cache = RenderCache(Templater(), cache_control="private, max-age=60")
+    response = popup(cache)
+    etag = response.headers["etag"]
+    assert etag.startswith('"') and popup(cache).headers["etag"] == etag
+    assert popup(cache, "Elsewhere.").headers["etag"] != etag
+    assert response.headers["cache-control"] == "private, max-age=60"
+
+    assert RenderCache.not_modified(request(), response) is response
+    assert RenderCache.not_modified(request('"stale"'), response) is response
+    revalidated = RenderCache.not_modified(request(f'"stale", {etag}'), response)
+    assert revalidated.status_code == 304 and revalidated.body == b""
+    assert revalidated.headers["etag"] == etag and revalidated.headers["cache-control"] == "private, max-age=60"
+
+
+def test_default_cache_control_revalidates():
+    assert popup(RenderCache(Templater())).headers["cache-control"] == "no-cache"
+
+
+def test_failed_renders_are_not_cached():
+    templater = Templater()
+    templater.safe_render = lambda *_, **__: HTMLResponse("error", status_code=500)
+    cache = RenderCache(templater)
+    assert popup(cache).status_code == 500
+    assert len(cache) == 0 and "etag" not in popup(cache).headers
+
+
+def test_pinned_pages_skip_the_context_and_the_lru(monkeypatch):
+    cache = RenderCache(Templater(), max_size=2)
+    cache.pin("popup_404", lambda: popup(cache))
+    assert cache.pinned("missing") is None
+    for i in range(5): popup(cache, f"page {i}")  # churns the LRU copy of the page out
+    monkeypatch.setattr(RenderCache, "fingerprint", pytest.fail)  # no context hashing on the pinned path
+    page = cache.pinned("popup_404")
+    assert b"Nothing here." in page.body and page.headers["etag"].startswith('"')
+    assert page.headers["cache-control"] == "no-cache"
+    assert cache.templater.renders == 6
+
+
+def test_server_popups_are_served_pinned(monkeypatch):
+    core = pytest.importorskip("toomanysessions.core")  # needs the fastj2/toomanythreads server stack
+    server_class = core.SessionedServer
+
+    class Server:
+        popup_404, popup_error = server_class.popup_404, server_class.popup_error
+        popup_unauthorized, too_many_requests = server_class.popup_unauthorized, server_class.too_many_requests
+        prerender = server_class.prerender
+        url, logout_uri = "http://test", "http://test/logout"
+
+        def __init__(self):
+            self.render_cache = RenderCache(Templater())
+
+    server = Server()
+    server.prerender()
+    renders = server.render_cache.templater.renders
+    monkeypatch.setattr(RenderCache, "fingerprint", pytest.fail)
+    assert b"404" in server.popup_404().body
+    assert b"permission" in server.popup_unauthorized().body
+    assert b"authorized" in server.popup_unauthorized(core.UNAUTHORIZED_MESSAGE).body
+    throttled = server.too_many_requests(7)
+    assert throttled.status_code == 429 and throttled.headers["retry-after"] == "7"
+    assert server.popup_error(429).status_code == 200  # the pinned page itself is untouched
+    assert server.render_cache.templater.renders == renders
+
+
+FIRST_REQUEST = [("popup.html", {"title": "Not Found", "text": "Nothing here."}), ("redirect.html", {"redirect_url": "/"})]
+
+
+def first_request(env: Environment) -> float:
+    """Seconds to render what the first 404 and the first login redirect need"""
+    start = time.perf_counter()
+    for name, context in FIRST_REQUEST: env.get_template(name).render(**context)
+    return time.perf_counter() - start
+
+
+def test_precompiled_templates_skip_compilation_on_first_request(tmp_path, monkeypatch, record_property):
+    cold = min(first_request(Environment(loader=FileSystemLoader(TEMPLATES))) for _ in range(3))
+
+    warm = []
+    for i in range(3):
+        (directory := tmp_path / str(i)).mkdir()
+        env = Environment(loader=FileSystemLoader(TEMPLATES), bytecode_cache=FileSystemBytecodeCache(directory))
+        assert compile_templates(env) == len(env.list_templates(extensions=["html"]))
+        monkeypatch.setattr(env, "compile", pytest.fail)  # any compile from here on fails the test
+        warm.append(first_request(env))
+    warm = min(warm)
+
+    record_property("cold_first_request_ms", round(cold * 1000, 2))
+    record_property("precompiled_first_request_ms", round(warm * 1000, 2))
+    print(f"\nfirst request renders: cold {cold * 1000:.2f}ms, precompiled {warm * 1000:.2f}ms")
+    assert warm < cold
+
+
+def test_workers_share_compiled_templates_through_the_bytecode_cache(tmp_path, monkeypatch):
+    compile_templates(Environment(loader=FileSystemLoader(TEMPLATES), bytecode_cache=FileSystemBytecodeCache(tmp_path)))
+    # a second worker on the same host loads the bytecode instead of compiling the sources again
+    worker = Environment(loader=FileSystemLoader(TEMPLATES), bytecode_cache=FileSystemBytecodeCache(tmp_path))
+    monkeypatch.setattr(worker, "compile", pytest.fail)
+    assert compile_templates(worker) > 0
+    first_request(worker)
+
+
+def test_broken_templates_are_skipped(tmp_path):
+    (tmp_path / "ok.html").write_text("{{ 1 + 1 }}")
+    (tmp_path / "broken.html").write_text("{% if %}")
+    (tmp_path / "notes.txt").write_text("{% if %}")
+    assert compile_templates(Environment(loader=FileSystemLoader(tmp_path))) == 1
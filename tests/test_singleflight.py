@@ -0,0 +1,95 @@
+import anyio
+import pytest
+
+from toomanysessions.singleflight import SingleFlight
+
+
+@pytest.mark.anyio
+async def test_concurrent_calls_share_one_run():
+    flights, runs, results = SingleFlight(), 0, []
+
+    async def work():
+        nonlocal runs
+        runs += 1
+        await anyio.sleep(0.05)
+        return "result"
+
+    async def call():
+        results.append(await flights.do("key", work))
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(20): tg.start_soon(call)
+    assert runs == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * 19
+    assert {result for result, _ in results} == {"result"}
+    assert len(flights) == 0
+
+
+@pytest.mark.anyio
+async def test_different_keys_run_independently():
+    flights, runs = SingleFlight(), []
+
+    async def work(key):
+        runs.append(key)
+        await anyio.sleep(0.01)
+        return key
+
+    async with anyio.create_task_group() as tg:
+        for key in ("a", "b", "a", "b"): tg.start_soon(flights.do, key, lambda key=key: work(key))
+    assert sorted(runs) == ["a", "b"]
+
+
+@pytest.mark.anyio
+async def test_errors_reach_every_waiter_and_leave_nothing_behind():
+    flights, runs, errors = SingleFlight(), 0, []
+
+    async def fail():
+        nonlocal runs
+        runs += 1
+        await anyio.sleep(0.05)
+        raise RuntimeError("profile fetch failed")
+
+    async def call():
+        try:
+            await flights.do("key", fail)
+        except RuntimeError as e:
+            errors.append(e)
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(10): tg.start_soon(call)
+    assert runs == 1 and len(errors) == 10
+    assert len(flights) == 0
+
+    async def succeed():
+        return "ok"
+
+    # the next call runs afresh rather than finding a stuck or failed flight
+    assert await flights.do("key", succeed) == ("ok", False)
+
+
+@pytest.mark.anyio
+async def test_a_cancelled_leader_hands_over_to_a_waiter():
+    flights, runs, scopes, results = SingleFlight(), 0, [], []
+
+    async def work():
+        nonlocal runs
+        runs += 1
+        await anyio.sleep(0.05)
+        return runs
+
+    async def leader():
+        with anyio.CancelScope() as scope:
+            scopes.append(scope)
+            await flights.do("key", work)
+
+    async def follower():
+        results.append(await flights.do("key", work))
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(leader)
+        await anyio.sleep(0.01)
+        tg.start_soon(follower)
+        await anyio.sleep(0.01)
+        scopes[0].cancel()  # the request that started the flight went away
+    assert results == [(2, False)]  # the waiter ran it itself instead of inheriting the cancellation
+    assert len(flights) == 0
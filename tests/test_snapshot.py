@@ -0,0 +1,135 @@
+import os
+import stat
+import time
+
+import pytest
+
+from toomanysessions.backends import SessionCodec
+from toomanysessions.session import Session
+from toomanysessions.snapshot import MAGIC, SnapshotLog
+from toomanysessions.store import SessionStore
+
+
+def open_store(path, **kwargs) -> SessionStore:
+    return SessionStore(snapshot=SnapshotLog(path, codec=SessionCodec(), verbose=False), verbose=False, **kwargs)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "sessions.snapshot"
+
+
+def test_sessions_survive_a_restart(path):
+    store = open_store(path)
+    for i in range(10):
+        session = Session.create(f"tok{i}")
+        session.authenticated = True
+        store[session.token] = session
+    store.close()
+
+    store = open_store(path)
+    assert len(store) == 10 and "tok3" in store
+    assert store.get("tok3").authenticated
+    store.close()
+
+
+def test_restored_sessions_go_back_through_the_gate(path):
+    store = open_store(path)
+    session = Session.create("tok")
+    session.whitelisted = True
+    session.admitted_until = time.time() + 3600
+    session.admission_epoch = 7
+    store[session.token] = session
+    store.close()
+
+    restored = open_store(path).get("tok")
+    assert not restored.whitelisted
+    assert not restored.is_admitted(7)
+
+
+def test_torn_tail_is_dropped(path):
+    store = open_store(path)
+    store["tok1"] = Session.create("tok1")
+    store.flush()
+    intact = path.stat().st_size
+    store["tok2"] = Session.create("tok2")
+    store.close()
+    with open(path, "r+b") as f:
+        f.truncate(path.stat().st_size - 5)  # a crash part way through the last append
+
+    store = open_store(path)
+    assert "tok1" in store and "tok2" not in store
+    assert path.stat().st_size == intact
+    # the log stays appendable after the repair
+    store["tok3"] = Session.create("tok3")
+    store.close()
+    assert {"tok1", "tok3"} <= set(open_store(path))
+
+
+def test_deletions_and_expiry_are_tombstoned(path):
+    store = open_store(path)
+    store["kept"] = Session.create("kept")
+    store["deleted"] = Session.create("deleted")
+    store["expired"] = Session.create("expired", max_age=1)
+    store.flush()
+    del store["deleted"]
+    store.close()
+
+    store = open_store(path)
+    assert "kept" in store and "deleted" not in store
+    store.close()
+    log = SnapshotLog(path, codec=SessionCodec(), verbose=False)
+    assert "expired" not in {token for _, token in log.open(now=time.time() + 2)}
+    log.close()
+
+
+def test_compaction_keeps_only_live_records(path):
+    store = open_store(path)
+    for _ in range(20):
+        for i in range(10):
+            store[f"tok{i}"] = Session.create(f"tok{i}")
+        store.flush()
+    store.close()
+
+    store = open_store(path)
+    for i in range(3):
+        store.get(f"tok{i}").welcomed = True  # restored into memory, the other seven stay on disk only
+        store.save(store.get(f"tok{i}"))
+    store.snapshot.records = 10_000  # force the next flush to compact
+    store.flush()
+    assert store.snapshot.records == 10
+    assert store.get("tok5") is not None  # read through the new mapping
+    store.close()
+
+    store = open_store(path)
+    assert store.snapshot.records == 10
+    assert sorted(store) == sorted(f"tok{i}" for i in range(10))
+    assert all(store.get(f"tok{i}").welcomed == (i < 3) for i in range(10))
+    store.close()
+
+
+def test_not_a_snapshot_file_is_refused(path):
+    path.write_bytes(b"something else entirely")
+    with pytest.raises(ValueError):
+        SnapshotLog(path, verbose=False).open()
+
+
+def test_fresh_log_starts_with_magic(path):
+    open_store(path).close()
+    assert path.read_bytes().startswith(MAGIC)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="file modes are POSIX only")
+def test_files_are_owner_only(path):
+    old = os.umask(0o022)
+    try:
+        path.write_bytes(MAGIC)
+        path.chmod(0o644)  # as left behind by an older release
+        store = open_store(path)
+        store["tok"] = Session.create("tok")
+        store.flush()
+        store.snapshot.compact([store.get("tok")], store._lock)
+        store.close()
+    finally:
+        os.umask(old)
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
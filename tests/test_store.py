@@ -0,0 +1,128 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from toomanysessions import store as store_module
+from toomanysessions.session import Session
+from toomanysessions.store import SessionStore, TTLCache
+
+
+@pytest.fixture
+def store():
+    store = SessionStore(max_size=3, sweep_interval=None, verbose=False)
+    yield store
+    store.close()
+
+
+def put(store: SessionStore, token: str, max_age: float = 3600) -> Session:
+    session = Session.create(token, max_age=max_age)
+    store[token] = session
+    return session
+
+
+def test_least_recently_used_is_evicted_first(store):
+    for token in ("a", "b", "c"): put(store, token)
+    store.get("a")  # a read refreshes recency
+    put(store, "d")
+    assert list(store) == ["c", "a", "d"]
+    put(store, "e")
+    assert list(store) == ["a", "d", "e"]
+    assert store.get("b") is None and store.get("c") is None
+    assert store.stats.evicted == 2 and store.stats.evictions == 2
+
+
+def test_expired_sessions_are_dropped_on_get(store):
+    put(store, "old", max_age=-1)
+    put(store, "new")
+    assert store.get("old") is None
+    assert "old" not in store and len(store) == 1
+    assert store.stats.expired == 1 and store.stats.misses == 1
+    assert store.get("new").token == "new"
+    assert store.stats.hits == 1
+
+
+def test_sweep_removes_only_what_is_due(store):
+    put(store, "soon", max_age=10)
+    put(store, "later", max_age=100)
+    now = time.time()
+    assert store.sweep(now) == 0
+    assert store.sweep(now + 50) == 1
+    assert list(store) == ["later"]
+    assert store.sweep(now + 500) == 1
+    assert len(store) == 0 and store.stats.swept == 2
+
+
+def test_sweep_ignores_heap_entries_left_behind_by_a_moved_expiry(store):
+    session = put(store, "tok", max_age=10)
+    session.expires_at = time.time() + 100  # extended, and saved again under the new expiry
+    store["tok"] = session
+    assert len(store._expiries) == 2
+    now = time.time()
+    assert store.sweep(now + 50) == 0  # the stale entry is popped, but the session is not due yet
+    assert store.get("tok") is session
+    assert store.sweep(now + 500) == 1
+    assert store._expiries == []
+
+
+def test_sweep_skips_sessions_already_gone(store):
+    put(store, "evicted", max_age=10)
+    for token in ("a", "b", "c"): put(store, token)
+    put(store, "deleted", max_age=10)
+    del store["deleted"]
+    assert store.sweep(time.time() + 50) == 0
+    assert store.stats.swept == 0 and store.stats.evicted == 2
+
+
+def test_compact_drops_dead_heap_entries():
+    store = SessionStore(max_size=10, sweep_interval=None, verbose=False)
+    session = Session.create("tok")
+    for _ in range(5): store["tok"] = session  # each save pushes another heap entry
+    for token in ("a", "b"): store[token] = Session.create(token)
+    del store["a"]
+    store._compact()
+    assert sorted(token for _, token in store._expiries) == ["b", "tok"]
+    store.close()
+
+
+def test_heap_is_compacted_before_it_bloats():
+    store = SessionStore(max_size=10, sweep_interval=None, verbose=False)
+    session = Session.create("tok")
+    for _ in range(5_000): store["tok"] = session
+    assert len(store._expiries) <= 2 * len(store) + 1024
+    store.close()
+
+
+def test_contains_does_not_touch_recency_or_counters(store):
+    for token in ("a", "b", "c"): put(store, token)
+    assert "a" in store and "z" not in store
+    assert (store.stats.hits, store.stats.misses) == (0, 0)
+    put(store, "d")
+    assert "a" not in store  # still the least recently used, so it went first
+
+
+def test_counters(store):
+    put(store, "a")
+    store.get("a")
+    store.get("missing")
+    assert store.stats.to_dict() == {
+        "hits": 1, "misses": 1, "inserts": 1, "expired": 0, "evicted": 0, "swept": 0, "hit_ratio": 0.5
+    }
+
+
+def test_max_size_must_be_positive():
+    with pytest.raises(ValueError):
+        SessionStore(max_size=0, sweep_interval=None)
+
+
+def test_ttl_cache(monkeypatch):
+    cache = TTLCache(ttl=60.0, max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None and cache.stats.evicted == 1
+    later = time.monotonic() + 61
+    monkeypatch.setattr(store_module, "time", SimpleNamespace(monotonic=lambda: later, time=time.time))
+    assert cache.get("a") is None and cache.stats.expired == 1
+    assert cache.get(None, "default") == "default"
@@ -0,0 +1,108 @@
+import gc
+import tracemalloc
+from types import SimpleNamespace
+
+import pytest
+from starlette.requests import Request
+
+from toomanysessions import throttle
+from toomanysessions.throttle import PASSKEY_LIMITS, RateLimiter, Throttle
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Frozen monotonic clock for the throttle module, advanced by hand"""
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(throttle, "time", SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+def request(peer: str = "203.0.113.9", forwarded: str = None) -> Request:
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded is not None else []
+    return Request({"type": "http", "client": (peer, 50000), "headers": headers})
+
+
+def test_burst_then_refill_rate(clock):
+    limiter = RateLimiter(rate=2.0, burst=5)
+    assert [limiter.hit("key") for _ in range(5)] == [0.0] * 5
+    assert limiter.hit("key") == pytest.approx(0.5)  # one token short at two per second
+    clock.value += 0.5
+    assert limiter.hit("key") == 0.0
+    assert limiter.hit("key") == pytest.approx(0.5)
+    clock.value += 60
+    # idle time refills up to the burst and no further
+    assert [limiter.hit("key") for _ in range(6)][-2:] == [0.0, pytest.approx(0.5)]
+    assert limiter.rejected == 3
+
+
+def test_keys_have_their_own_buckets(clock):
+    limiter = RateLimiter(rate=1.0, burst=1)
+    assert limiter.hit("a") == 0.0
+    assert limiter.hit("a") > 0
+    assert limiter.hit("b") == 0.0
+
+
+def test_retry_after_is_whole_seconds(clock):
+    guard = Throttle(session_rate=0.3, session_burst=1, ip_rate=100.0, ip_burst=100)
+    assert guard.check(request(), "tok") == 0
+    assert guard.check(request(), "tok") == 4  # 3.33s rounded up, never down to an early retry
+    clock.value += 3.4
+    assert guard.check(request(), "tok") == 0
+
+
+def test_client_address_limits_every_session_behind_it(clock):
+    guard = Throttle(session_rate=100.0, session_burst=100, ip_rate=1.0, ip_burst=3)
+    assert [guard.check(request(), f"tok{i}") for i in range(3)] == [0, 0, 0]
+    assert guard.check(request(), "fresh-cookie") == 1
+    assert guard.check(request("198.51.100.7"), "fresh-cookie") == 0
+
+
+def test_passkey_attempts_back_off(clock):
+    guard = Throttle(**PASSKEY_LIMITS)
+    assert [guard.check(request(), "tok") for _ in range(5)] == [0] * 5
+    assert guard.check(request(), "tok") == 10
+    clock.value += 10
+    assert guard.check(request(), "tok") == 0
+    assert guard.check(request(), "tok") == 10
+    # switching cookies doesn't help for long, the address runs dry too
+    retries = [guard.check(request(), f"tok{i}") for i in range(20)]
+    assert retries[-1] > 0
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies():
+    guard = Throttle()
+    assert guard.client_address(request("203.0.113.9", "198.51.100.7")) == "203.0.113.9"
+
+
+def test_forwarded_for_is_read_from_the_right():
+    guard = Throttle(trusted_proxies=["10.0.0.0/8"])
+    # the client wrote the leftmost hop itself, the balancer appended the address it really came from
+    forged = request("10.0.0.2", "1.2.3.4, 198.51.100.7, 10.0.0.1")
+    assert guard.client_address(forged) == "198.51.100.7"
+    assert guard.client_address(request("10.0.0.2", "198.51.100.7")) == "198.51.100.7"
+    assert guard.client_address(request("10.0.0.2", "10.0.0.3, 10.0.0.1")) == "10.0.0.3"
+    assert guard.client_address(request("10.0.0.2")) == "10.0.0.2"
+    # only a trusted peer gets to speak for someone else
+    assert guard.client_address(request("203.0.113.9", "198.51.100.7")) == "203.0.113.9"
+
+
+def test_rotating_the_forged_hop_does_not_reset_the_bucket(clock):
+    guard = Throttle(ip_rate=1.0, ip_burst=2, trusted_proxies=["10.0.0.0/8"])
+    retries = [guard.check(request("10.0.0.2", f"1.2.3.{i}, 198.51.100.7")) for i in range(3)]
+    assert retries == [0, 0, 1]
+
+
+def test_memory_is_bounded_under_a_flood_of_keys():
+    limiter = RateLimiter(rate=1.0, burst=5, max_keys=1_000)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for i in range(1_000): limiter.hit(f"203.0.{i // 256}.{i % 256}")
+        full = tracemalloc.get_traced_memory()[0]
+        for i in range(100_000): limiter.hit(f"flood-{i}")
+        flooded = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(limiter) == 1_000
+    assert flooded < full * 1.5
+    assert "flood-99999" in limiter._buckets and "203.0.0.0" not in limiter._buckets  # least recent went first
@@ -0,0 +1,131 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from toomanysessions.session import Session
+from toomanysessions.whitelist import Whitelist, admission_epoch
+
+APP_TENANT = "app-tenant-id"
+SRC = Path(__file__).parent.parent / "src"
+
+
+def rewrite(path, *lines: str):
+    """Replace a whitelist file, moving its mtime on even on filesystems with coarse timestamps"""
+    stamp = path.stat().st_mtime_ns + 10_000_000 if path.exists() else None
+    path.write_text("".join(f"{line}\n" for line in lines), encoding="utf-8")
+    if stamp is not None: os.utime(path, ns=(stamp, stamp))
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_entries_are_case_folded_and_trimmed():
+    whitelist = Whitelist(["Alice@Example.COM ", "STRASSE@example.com", ""], verbose=False)
+    assert " alice@example.com" in whitelist and "ALICE@EXAMPLE.COM" in whitelist
+    assert "straße@example.com" in whitelist  # casefold, not just lower
+    assert "bob@example.com" not in whitelist and None not in whitelist
+    assert len(whitelist) == 2
+
+
+def test_file_entries_skip_comments_and_blank_lines(tmp_path):
+    path = tmp_path / "users.txt"
+    rewrite(path, "# admins", "Alice@Example.com  # on call", "", "   ")
+    whitelist = Whitelist(path=path, verbose=False)
+    whitelist.stop()
+    assert set(whitelist) == {"alice@example.com"}
+
+
+def test_reload_swaps_the_whole_set_at_once(tmp_path):
+    path = tmp_path / "users.txt"
+    small, large = [f"user{i}@example.com" for i in range(10)], [f"user{i}@example.com" for i in range(5_000)]
+    rewrite(path, *small)
+    whitelist = Whitelist(path=path, verbose=False)
+    whitelist.stop()
+    seen, stop = set(), threading.Event()
+
+    def read():
+        while not stop.is_set(): seen.add(len(whitelist.entries))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for lines in [large, small] * 20:
+            rewrite(path, *lines)
+            whitelist.load()
+    finally:
+        stop.set()
+        reader.join()
+    assert seen <= {len(small), len(large)}  # never a half-built set
+
+
+def test_digest_ignores_order_and_case():
+    assert Whitelist(["a@x.com", "B@x.com"]).digest == Whitelist(["b@x.com", "A@X.com"]).digest
+    assert Whitelist(["a@x.com"]).digest != Whitelist(["a@x.com", "b@x.com"]).digest
+
+
+def test_digest_is_stable_across_processes():
+    entries = [f"user{i}@example.com" for i in range(50)]
+    probe = "from toomanysessions.whitelist import Whitelist; import sys; " \
+            "print(Whitelist(sys.argv[1:]).digest.hex())"
+    digests = set()
+    # set iteration order differs between hash seeds, and so does the order the entries arrive in
+    for seed, ordered in (("1", entries), ("2", entries[::-1])):
+        env = {**os.environ, "PYTHONPATH": str(SRC), "PYTHONHASHSEED": seed}
+        out = subprocess.run([sys.executable, "-c", probe, *ordered], env=env, capture_output=True, text=True, check=True)
+        digests.add(out.stdout.strip())
+    assert digests == {Whitelist(entries).digest.hex()}
+
+
+def test_extended_entries_survive_reloads(tmp_path):
+    path = tmp_path / "tenants.txt"
+    rewrite(path, "tenant-a")
+    whitelist = Whitelist(path=path, verbose=False)
+    whitelist.stop()
+    # what the server does with its own tenant
+    whitelist.extend([APP_TENANT])
+    assert APP_TENANT in whitelist and "tenant-a" in whitelist
+    rewrite(path, "tenant-b")
+    assert whitelist.load()
+    assert APP_TENANT in whitelist and "tenant-b" in whitelist and "tenant-a" not in whitelist
+    path.unlink()
+    whitelist.load()
+    assert set(whitelist) == {APP_TENANT}
+
+
+def test_rewriting_a_watched_file_reevaluates_admission(tmp_path):
+    path = tmp_path / "users.txt"
+    rewrite(path, "alice@example.com", "bob@example.com")
+    epochs = []
+    whitelist = Whitelist(path=path, interval=0.02, on_change=lambda: epochs.append(admission_epoch(0, whitelist)),
+                          verbose=False)
+    try:
+        epoch = admission_epoch(0, whitelist)
+        session = Session.create("tok")
+        session.admitted_until, session.admission_epoch = session.expires_at, epoch
+        assert session.is_admitted(epoch)
+
+        rewrite(path, "alice@example.com")
+        wait_for(lambda: epochs)
+        assert "bob@example.com" not in whitelist
+        assert epochs[-1] != epoch and not session.is_admitted(epochs[-1])
+
+        # touching the file without changing its contents keeps everyone admitted
+        rewrite(path, "alice@example.com")
+        time.sleep(0.1)
+        assert len(epochs) == 1
+    finally:
+        whitelist.stop()
+
+
+def test_coerce():
+    assert Whitelist.coerce(None) is None
+    existing = Whitelist(["a"])
+    assert Whitelist.coerce(existing, on_change=print) is existing and existing.on_change is print
+    assert "A" in Whitelist.coerce(["a"])